@@ -13,7 +13,10 @@ from test_framework.blocktools import (
     create_tx_with_script,
     get_legacy_sigopcount_block,
     MAX_BLOCK_SIGOPS,
+    MAX_BLOCK_SIGOPS_WEIGHT,
+    SigopCounter,
 )
+from test_framework.interpreter import verify_tx
 from test_framework.key import ECKey
 from test_framework.messages import (
     CBlock,
@@ -23,6 +26,8 @@ from test_framework.messages import (
     CTxIn,
     CTxOut,
     MAX_BLOCK_BASE_SIZE,
+    TxBatch,
+    WITNESS_SCALE_FACTOR,
     uint256_from_compact,
     uint256_from_str,
 )
@@ -472,19 +477,21 @@ class FullBlockTest(BitcoinTestFramework):
         b39_outputs += 1
 
         # Until block is full, add tx's with 1 satoshi to p2sh_script, the rest to OP_TRUE
-        tx_new = None
-        tx_last = tx
+        # (built in a TxBatch, one row per transaction)
+        batch = TxBatch()
+        last_txid = tx.sha256
+        last_value = tx.vout[1].nValue
         total_size = len(b39.serialize())
-        while(total_size < MAX_BLOCK_BASE_SIZE):
-            tx_new = self.create_tx(tx_last, 1, 1, p2sh_script)
-            tx_new.vout.append(CTxOut(tx_last.vout[1].nValue - 1, CScript([OP_TRUE])))
-            tx_new.rehash()
-            total_size += len(tx_new.serialize())
+        while True:
+            i = batch.add([(last_txid, 1, b"", 0xffffffff)],
+                          [(1, p2sh_script), (last_value - 1, CScript([OP_TRUE]))])
+            total_size += batch.tx_size(i)
             if total_size >= MAX_BLOCK_BASE_SIZE:
                 break
-            b39.vtx.append(tx_new)  # add tx to block
-            tx_last = tx_new
+            last_txid = batch.txid(i)
+            last_value -= 1
             b39_outputs += 1
+        b39.vtx.extend(batch.tx(j) for j in range(len(batch) - 1))
 
         b39 = self.update_block(39, [])
         self.sync_blocks([b39], True)
@@ -529,6 +536,11 @@ class FullBlockTest(BitcoinTestFramework):
         tx.rehash()
         new_txs.append(tx)
         self.update_block(40, new_txs)
+        sigop_counter = SigopCounter()
+        sigop_counter.add_outputs(out[12])
+        for tx in b39.vtx:
+            sigop_counter.add_outputs(tx)
+        assert_equal(sigop_counter.block_cost(b40), (MAX_BLOCK_SIGOPS + 1) * WITNESS_SCALE_FACTOR)
         self.sync_blocks([b40], success=False, reject_reason='bad-blk-sigops', reconnect=True)
 
         # same as b40, but one less sigop
@@ -542,6 +554,7 @@ class FullBlockTest(BitcoinTestFramework):
         tx.vout.append(CTxOut(1, CScript([OP_CHECKSIG] * b41_sigops_to_fill)))
         tx.rehash()
         self.update_block(41, [tx])
+        assert_equal(sigop_counter.block_cost(b41), MAX_BLOCK_SIGOPS_WEIGHT)
         self.sync_blocks([b41], True)
 
         # Fork off of b39 to create a constant base again
@@ -1304,6 +1317,7 @@ class FullBlockTest(BitcoinTestFramework):
             block = create_block(base_block_hash, coinbase, block_time, version=blockversion)
             tx = self.create_tx(spend, 0, 1, script)  # spend 1 satoshi
             self.sign_tx(tx, spend)
+            assert_equal(verify_tx(tx, [spend.vout[0]]), [])
             self.add_transactions_to_block(block, [tx])
             block.hashMerkleRoot = block.calc_merkle_root()
         if solve:
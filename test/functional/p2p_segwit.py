@@ -9,7 +9,7 @@ import random
 import struct
 import time
 
-from test_framework.blocktools import create_block, create_coinbase, add_witness_commitment, get_witness_script, WITNESS_COMMITMENT_HEADER
+from test_framework.blocktools import create_block, create_coinbase, add_witness_commitment, get_witness_script, SigopCounter, WITNESS_COMMITMENT_HEADER
 from test_framework.key import ECKey
 from test_framework.messages import (
     BIP125_SEQUENCE_NUMBER,
@@ -69,6 +69,7 @@ from test_framework.script import (
     SIGHASH_NONE,
     SIGHASH_SINGLE,
     SegwitVersion1SignatureHash,
+    SighashCache,
     SignatureHash,
     hash160,
 )
@@ -103,9 +104,13 @@ def get_p2pkh_script(pubkeyhash):
     """Get the script associated with a P2PKH."""
     return CScript([CScriptOp(OP_DUP), CScriptOp(OP_HASH160), pubkeyhash, CScriptOp(OP_EQUALVERIFY), CScriptOp(OP_CHECKSIG)])
 
-def sign_p2pk_witness_input(script, tx_to, in_idx, hashtype, value, key):
-    """Add signature for a P2PK witness program."""
-    tx_hash = SegwitVersion1SignatureHash(script, tx_to, in_idx, hashtype, value)
+def sign_p2pk_witness_input(script, tx_to, in_idx, hashtype, value, key, sighash_cache=None):
+    """Add signature for a P2PK witness program.
+
+    Pass the same SighashCache of tx_to when signing several of its inputs."""
+    if sighash_cache is None:
+        sighash_cache = SighashCache(tx_to)
+    tx_hash = sighash_cache.segwit_signature_hash(script, in_idx, hashtype, value)
     signature = key.sign_ecdsa(tx_hash) + chr(hashtype).encode('latin-1')
     tx_to.wit.vtxinwit[in_idx].scriptWitness.stack = [signature, script]
     tx_to.rehash()
@@ -114,11 +119,7 @@ def get_virtual_size(witness_block):
     """Calculate the virtual size of a witness block.
 
     Virtual size is base + witness/4."""
-    base_size = len(witness_block.serialize(with_witness=False))
-    total_size = len(witness_block.serialize(with_witness=True))
-    # the "+3" is so we round up
-    vsize = int((3 * base_size + total_size + 3) / 4)
-    return vsize
+    return witness_block.vsize
 
 def test_transaction_acceptance(node, p2p, tx, with_witness, accepted, reason=None):
     """Send a transaction to the node and check that it's accepted to the mempool
@@ -430,10 +431,9 @@ class SegWitTest(BitcoinTestFramework):
 
             # Test size, vsize, weight
             rpc_details = self.nodes[0].getblock(block.hash, True)
-            assert_equal(rpc_details["size"], len(block.serialize(True)))
-            assert_equal(rpc_details["strippedsize"], len(block.serialize(False)))
-            weight = 3 * len(block.serialize(False)) + len(block.serialize(True))
-            assert_equal(rpc_details["weight"], weight)
+            assert_equal(rpc_details["size"], block.total_size)
+            assert_equal(rpc_details["strippedsize"], block.base_size)
+            assert_equal(rpc_details["weight"], block.weight)
 
             # Upgraded node should not ask for blocks from unupgraded
             block4 = self.build_next_block(version=4)
@@ -1681,13 +1681,14 @@ class SegWitTest(BitcoinTestFramework):
             split_value = total_value // num_outputs
             for i in range(num_outputs):
                 tx.vout.append(CTxOut(split_value, script_pubkey))
+            sighash_cache = SighashCache(tx)
             for i in range(num_inputs):
                 # Now try to sign each input, using a random hashtype.
                 anyonecanpay = 0
                 if random.randint(0, 1):
                     anyonecanpay = SIGHASH_ANYONECANPAY
                 hashtype = random.randint(1, 3) | anyonecanpay
-                sign_p2pk_witness_input(witness_program, tx, i, hashtype, temp_utxos[i].nValue, key)
+                sign_p2pk_witness_input(witness_program, tx, i, hashtype, temp_utxos[i].nValue, key, sighash_cache)
                 if (hashtype == SIGHASH_SINGLE and i >= num_outputs):
                     used_sighash_single_out_of_bounds = True
             tx.rehash()
@@ -2009,6 +2010,9 @@ class SegWitTest(BitcoinTestFramework):
 
         block_2 = self.build_next_block()
         self.update_witness_block_with_transactions(block_2, [tx2])
+        sigop_counter = SigopCounter()
+        sigop_counter.add_outputs(tx)
+        assert_equal(sigop_counter.block_cost(block_2), MAX_SIGOP_COST + 1)
         test_witness_block(self.nodes[0], self.test_node, block_2, accepted=False)
 
         # Try dropping the last input in tx2, and add an output that has
@@ -2045,6 +2049,7 @@ class SegWitTest(BitcoinTestFramework):
         tx2.wit.vtxinwit[-1].scriptWitness.stack = [witness_program_justright]
         tx2.rehash()
         self.update_witness_block_with_transactions(block_5, [tx2])
+        assert_equal(sigop_counter.block_cost(block_5), MAX_SIGOP_COST)
         test_witness_block(self.nodes[0], self.test_node, block_5, accepted=True)
 
         # TODO: test p2sh sigop counting
@@ -4,7 +4,7 @@
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
 """Encode and decode BASE58, P2PKH and P2SH addresses."""
 
-from .script import hash256, hash160, sha256, CScript, OP_0
+from .script import hash256, hash160, sha256, CScript, key_to_p2wpkh_script, script_to_p2wsh_script
 from .util import bytes_to_hex_str, hex_str_to_bytes
 
 from . import segwit_addr
@@ -51,8 +51,7 @@ def script_to_p2sh(script, main = False):
 
 def key_to_p2sh_p2wpkh(key, main = False):
     key = check_key(key)
-    p2shscript = CScript([OP_0, hash160(key)])
-    return script_to_p2sh(p2shscript, main)
+    return script_to_p2sh(key_to_p2wpkh_script(key), main)
 
 def program_to_witness(version, program, main = False):
     if (type(program) is str):
@@ -72,8 +71,7 @@ def key_to_p2wpkh(key, main = False):
 
 def script_to_p2sh_p2wsh(script, main = False):
     script = check_script(script)
-    p2shscript = CScript([OP_0, sha256(script)])
-    return script_to_p2sh(p2shscript, main)
+    return script_to_p2sh(script_to_p2wsh_script(script), main)
 
 def check_key(key):
     if (type(key) is str):
@@ -20,28 +20,48 @@ from .messages import (
     CTxOut,
     FromHex,
     ToHex,
+    WITNESS_SCALE_FACTOR,
     bytes_to_hex_str,
     hash256,
     hex_str_to_bytes,
     ser_string,
     ser_uint256,
-    sha256,
     uint256_from_str,
 )
 from .script import (
     CScript,
+    CScriptInvalidError,
     OP_0,
     OP_1,
+    OP_16,
     OP_CHECKMULTISIG,
+    OP_CHECKMULTISIGVERIFY,
     OP_CHECKSIG,
-    OP_RETURN,
+    OP_CHECKSIGVERIFY,
+    OP_EQUAL,
+    OP_HASH160,
     OP_TRUE,
-    hash160,
+    SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_NONE,
+    SIGHASH_SINGLE,
+    SighashCache,
+    key_to_p2pkh_script,
+    key_to_p2wpkh_script,
+    null_data_script,
+    script_index,
+    script_to_p2wsh_script,
 )
+from .interpreter import verify_tx
+from .key import ECKey
 from .util import assert_equal
+from concurrent.futures import ProcessPoolExecutor
+import functools
 from io import BytesIO
+import unittest
 
 MAX_BLOCK_SIGOPS = 20000
+MAX_BLOCK_SIGOPS_WEIGHT = MAX_BLOCK_SIGOPS * WITNESS_SCALE_FACTOR
 
 # Genesis block time (regtest)
 TIME_GENESIS_BLOCK = 1296688602
@@ -69,7 +89,7 @@ def create_block(hashprev, coinbase, ntime=None, *, version=1):
 def get_witness_script(witness_root, witness_nonce):
     witness_commitment = uint256_from_str(hash256(ser_uint256(witness_root) + ser_uint256(witness_nonce)))
     output_data = WITNESS_COMMITMENT_HEADER + ser_uint256(witness_commitment)
-    return CScript([OP_RETURN, output_data])
+    return null_data_script(output_data)
 
 def add_witness_commitment(block, nonce=0):
     """Add a witness commitment to the block's coinbase transaction.
@@ -160,6 +180,86 @@ def create_raw_transaction(node, txid, to_address, *, amount):
     assert_equal(signresult["complete"], True)
     return signresult['hex']
 
+def sign_tx_inputs(tx, inputs, *, executor=None, chunk_size=16):
+    """Sign the inputs of tx and put the signatures in their scriptSigs or witnesses.
+
+    inputs has a (key, script, amount, hashtype) tuple, or None to leave the
+    input alone, for each input of tx. script is the script code to sign,
+    which must be P2PKH or P2PK (<pubkey> OP_CHECKSIG): only single-key
+    spends are supported, and anything else raises a ValueError before
+    anything is signed. If amount is None the input is signed as a legacy
+    one and its scriptSig set to <sig> <pubkey> for P2PKH, <sig> for P2PK.
+    Otherwise it is signed as a segwit v0 one (BIP143), and its witness set
+    to <sig> <pubkey> for P2PKH (as for P2WPKH), <sig> <script> for P2PK
+    (as for P2WSH); the scriptSig of P2SH-wrapped inputs is left for the
+    caller to set.
+
+    If executor is a concurrent.futures.ProcessPoolExecutor, the sighashes
+    and signatures are computed on it, in chunks of chunk_size inputs."""
+    jobs = [(i,) + tuple(inp) for (i, inp) in enumerate(inputs) if inp is not None]
+    for (i, _, script, _, _) in jobs:
+        if not _is_p2pkh_script(script) and not _is_p2pk_script(script):
+            raise ValueError("input %d: can only sign P2PKH and P2PK scripts, not %s" % (i, bytes_to_hex_str(script)))
+    if executor is None:
+        sigs = _sign_tx_jobs(tx, jobs)
+    else:
+        tx_data = tx.serialize()
+        sigs = []
+        chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+        for chunk_sigs in executor.map(_sign_serialized_tx_jobs, [tx_data] * len(chunks), chunks):
+            sigs.extend(chunk_sigs)
+
+    if any(amount is not None for (_, _, _, amount, _) in jobs):
+        while len(tx.wit.vtxinwit) < len(tx.vin):
+            tx.wit.vtxinwit.append(CTxInWitness())
+    pubkeys = {}
+    for (i, key, script, amount, hashtype), sig in zip(jobs, sigs):
+        if _is_p2pkh_script(script):
+            if id(key) not in pubkeys:
+                pubkeys[id(key)] = key.get_pubkey().get_bytes()
+            stack = [sig, pubkeys[id(key)]]
+        elif amount is None:
+            stack = [sig]
+        else:
+            stack = [sig, script]
+        if amount is None:
+            tx.vin[i].scriptSig = CScript(stack)
+        else:
+            tx.wit.vtxinwit[i].scriptWitness.stack = stack
+    tx.rehash()
+
+def _is_p2pkh_script(script):
+    return len(script) == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac'
+
+def _is_p2pk_script(script):
+    return len(script) in (35, 67) and script[0] == len(script) - 2 and script[-1] == OP_CHECKSIG
+
+def _sign_tx_jobs(tx, jobs):
+    """Return the signatures (with the hashtype appended) for (input index, key, script, amount, hashtype) jobs on tx"""
+    sighash_cache = SighashCache(tx)
+    sighashes = []
+    for (i, key, script, amount, hashtype) in jobs:
+        if amount is None:
+            sighashes.append(sighash_cache.signature_hash(script, i, hashtype)[0])
+        else:
+            sighashes.append(sighash_cache.segwit_signature_hash(script, i, hashtype, amount))
+    # Sign all the sighashes of a key at once
+    by_key = {}
+    for n, job in enumerate(jobs):
+        by_key.setdefault(id(job[1]), []).append(n)
+    sigs = [None] * len(jobs)
+    for ns in by_key.values():
+        key = jobs[ns[0]][1]
+        for n, sig in zip(ns, key.sign_many([sighashes[n] for n in ns])):
+            sigs[n] = sig + bytes([jobs[n][4] & 0xff])
+    return sigs
+
+def _sign_serialized_tx_jobs(tx_data, jobs):
+    """Worker for sign_tx_inputs(): _sign_tx_jobs() on a serialized transaction"""
+    tx = CTransaction()
+    tx.deserialize(BytesIO(tx_data))
+    return _sign_tx_jobs(tx, jobs)
+
 def get_legacy_sigopcount_block(block, accurate=True):
     count = 0
     for tx in block.vtx:
@@ -175,6 +275,121 @@ def get_legacy_sigopcount_tx(tx, accurate=True):
         count += CScript(j.scriptSig).GetSigOpCount(accurate)
     return count
 
+class SigopCounter():
+    """Sigop cost of transactions and blocks, counted as litecoind does.
+
+    Counting P2SH and witness sigops needs the outputs spent by each input:
+    spent_outputs maps (txid, n) to them, and the outputs of every
+    transaction counted by block_cost() or passed to add_outputs() are added
+    to it, so only outputs created outside the blocks being counted need to
+    be provided. p2sh and witness turn counting those sigops on and off, as
+    their script verification flags do."""
+
+    def __init__(self, spent_outputs=None, *, p2sh=True, witness=True):
+        self.spent_outputs = {} if spent_outputs is None else spent_outputs
+        self.p2sh = p2sh
+        self.witness = witness
+
+    def add_outputs(self, tx):
+        """Make the outputs of tx known as spendable by later transactions."""
+        tx.calc_sha256()
+        for n, txout in enumerate(tx.vout):
+            self.spent_outputs[(tx.sha256, n)] = txout
+
+    def legacy_sigops(self, tx):
+        """Sigops in the scriptSigs and scriptPubKeys of tx, as GetLegacySigOpCount()."""
+        return (sum(_script_sigops(txin.scriptSig, False) for txin in tx.vin)
+                + sum(_script_sigops(txout.scriptPubKey, False) for txout in tx.vout))
+
+    def p2sh_sigops(self, tx):
+        """Sigops in the redeem scripts of the P2SH inputs of tx, as GetP2SHSigOpCount()."""
+        n = 0
+        for txin in tx.vin:
+            if _is_p2sh_script(self._spent_script(txin)):
+                redeem_script = _last_push(txin.scriptSig)
+                if redeem_script:
+                    n += _script_sigops(redeem_script, True)
+        return n
+
+    def witness_sigops(self, tx):
+        """Sigops in the witness programs spent by tx, as the sum of CountWitnessSigOps() over its inputs."""
+        n = 0
+        for i, txin in enumerate(tx.vin):
+            script_pubkey = self._spent_script(txin)
+            program = script_pubkey
+            if _is_p2sh_script(script_pubkey):
+                program = _last_push(txin.scriptSig)
+                if program is None:
+                    continue
+            if not _is_witness_program(program) or program[0] != OP_0:
+                continue
+            if len(program) == 22:
+                n += 1
+            elif len(program) == 34 and i < len(tx.wit.vtxinwit) and tx.wit.vtxinwit[i].scriptWitness.stack:
+                n += _script_sigops(tx.wit.vtxinwit[i].scriptWitness.stack[-1], True)
+        return n
+
+    def tx_cost(self, tx):
+        """Sigop cost of tx, as GetTransactionSigOpCost()."""
+        cost = self.legacy_sigops(tx) * WITNESS_SCALE_FACTOR
+        if len(tx.vin) == 1 and tx.vin[0].prevout.hash == 0 and tx.vin[0].prevout.n == 0xffffffff:
+            return cost
+        if self.p2sh:
+            cost += self.p2sh_sigops(tx) * WITNESS_SCALE_FACTOR
+        if self.witness:
+            cost += self.witness_sigops(tx)
+        return cost
+
+    def block_cost(self, block):
+        """Sigop cost of block, to compare with MAX_BLOCK_SIGOPS_WEIGHT."""
+        cost = 0
+        for tx in block.vtx:
+            cost += self.tx_cost(tx)
+            self.add_outputs(tx)
+        return cost
+
+    def _spent_script(self, txin):
+        if not (self.p2sh or self.witness):
+            return b""
+        outpoint = (txin.prevout.hash, txin.prevout.n)
+        if outpoint not in self.spent_outputs:
+            raise AssertionError("SigopCounter doesn't know the output %064x:%d; call add_outputs() with the transaction that created it" % outpoint)
+        return self.spent_outputs[outpoint].scriptPubKey
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _script_sigops(script, accurate):
+    """Count sigops as CScript::GetSigOpCount() does, stopping at an invalid push rather than raising."""
+    n = 0
+    last_opcode = None
+    for opcode in script_index(script)[0]:
+        if opcode == OP_CHECKSIG or opcode == OP_CHECKSIGVERIFY:
+            n += 1
+        elif opcode == OP_CHECKMULTISIG or opcode == OP_CHECKMULTISIGVERIFY:
+            if accurate and last_opcode is not None and OP_1 <= last_opcode <= OP_16:
+                n += last_opcode - OP_1 + 1
+            else:
+                n += 20
+        last_opcode = opcode
+    return n
+
+def _last_push(script):
+    """The data pushed by the last opcode of a push-only script (empty for OP_1NEGATE and OP_1..OP_16), or None if it is not one"""
+    data = None
+    try:
+        for (opcode, data, sop_idx) in CScript(script).raw_iter():
+            if opcode > OP_16:
+                return None
+    except CScriptInvalidError:
+        return None
+    return data or b""
+
+def _is_p2sh_script(script):
+    return len(script) == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL
+
+def _is_witness_program(script):
+    return 4 <= len(script) <= 42 and (script[0] == OP_0 or OP_1 <= script[0] <= OP_16) and script[1] + 2 == len(script)
+
 def witness_script(use_p2wsh, pubkey):
     """Create a scriptPubKey for a pay-to-witness TxOut.
 
@@ -183,13 +398,11 @@ def witness_script(use_p2wsh, pubkey):
     scriptPubKey."""
     if not use_p2wsh:
         # P2WPKH instead
-        pubkeyhash = hash160(hex_str_to_bytes(pubkey))
-        pkscript = CScript([OP_0, pubkeyhash])
+        pkscript = key_to_p2wpkh_script(hex_str_to_bytes(pubkey))
     else:
         # 1-of-1 multisig
         witness_program = CScript([OP_1, hex_str_to_bytes(pubkey), OP_1, OP_CHECKMULTISIG])
-        scripthash = sha256(witness_program)
-        pkscript = CScript([OP_0, scripthash])
+        pkscript = script_to_p2wsh_script(witness_program)
     return bytes_to_hex_str(pkscript)
 
 def create_witness_tx(node, use_p2wsh, utxo, pubkey, encode_p2sh, amount):
@@ -224,3 +437,62 @@ def send_to_witness(use_p2wsh, node, utxo, pubkey, encode_p2sh, amount, sign=Tru
             tx_to_witness = ToHex(tx)
 
     return node.sendrawtransaction(tx_to_witness)
+
+
+class TestFrameworkBlockTools(unittest.TestCase):
+    def test_sign_tx_inputs(self):
+        keys = []
+        for compressed in (False, True, True, False):
+            key = ECKey()
+            key.generate(compressed)
+            keys.append(key)
+        pubkeys = [key.get_pubkey().get_bytes() for key in keys]
+        witness_script = CScript([pubkeys[2], OP_CHECKSIG])
+        p2pk_script = CScript([pubkeys[3], OP_CHECKSIG])
+        # (scriptPubKey, key, script code, whether segwit, hashtype) for
+        # each input, or just the scriptPubKey for one left unsigned
+        spends = [
+            (key_to_p2pkh_script(pubkeys[0]), keys[0], key_to_p2pkh_script(pubkeys[0]), False, SIGHASH_ALL),
+            (key_to_p2wpkh_script(pubkeys[1]), keys[1], key_to_p2pkh_script(pubkeys[1]), True, SIGHASH_ALL),
+            (script_to_p2wsh_script(witness_script), keys[2], witness_script, True, SIGHASH_SINGLE | SIGHASH_ANYONECANPAY),
+            (p2pk_script, keys[3], p2pk_script, False, SIGHASH_NONE),
+            (CScript([OP_TRUE]),),
+            (key_to_p2wpkh_script(pubkeys[1]), keys[1], key_to_p2pkh_script(pubkeys[1]), True, SIGHASH_ALL),
+        ]
+        spent_outputs = [CTxOut(1000 * (n + 1), spend[0]) for n, spend in enumerate(spends)]
+        inputs = []
+        for spend, spent_output in zip(spends, spent_outputs):
+            if len(spend) == 1:
+                inputs.append(None)
+            else:
+                _, key, script, segwit, hashtype = spend
+                inputs.append((key, script, spent_output.nValue if segwit else None, hashtype))
+
+        def build_tx():
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(0x1234, n)) for n in range(len(spends))]
+            tx.vout = [CTxOut(100 * (n + 1), CScript([OP_TRUE])) for n in range(4)]
+            return tx
+
+        serial = build_tx()
+        sign_tx_inputs(serial, inputs)
+        self.assertEqual(verify_tx(serial, spent_outputs), [])
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            parallel = build_tx()
+            sign_tx_inputs(parallel, inputs, executor=executor, chunk_size=2)
+        self.assertEqual(verify_tx(parallel, spent_outputs), [])
+        for tx in (serial, parallel):
+            # Everything but the signatures matches
+            self.assertEqual([len(txin.scriptSig) > 0 for txin in tx.vin], [True, False, False, True, False, False])
+            self.assertEqual([len(w.scriptWitness.stack) for w in tx.wit.vtxinwit], [0, 2, 2, 0, 0, 2])
+            self.assertEqual(tx.wit.vtxinwit[2].scriptWitness.stack[1], witness_script)
+
+        # Changing the first output invalidates the signatures that commit to it
+        parallel.vout[0].nValue += 1
+        self.assertEqual([n for n, _ in verify_tx(parallel, spent_outputs)], [0, 1, 5])
+
+        multisig = CScript([OP_1, pubkeys[0], OP_1, OP_CHECKMULTISIG])
+        tx = build_tx()
+        with self.assertRaises(ValueError):
+            sign_tx_inputs(tx, inputs[:1] + [(keys[0], multisig, None, SIGHASH_ALL)])
+        self.assertEqual(tx.serialize(), build_tx().serialize())
@@ -0,0 +1,1051 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019 The Bitcoin Core developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Test-only script interpreter, to check transactions without a node.
+
+Follows EvalScript() and VerifyScript() in src/script/interpreter.cpp, for
+legacy and segwit v0 scripts (P2PK, P2PKH, P2SH, multisig, P2WPKH, P2WSH
+and anything else built from the enabled opcodes), and fails with the same
+ScriptErrorString() messages. Signatures are checked with key.py, which
+only accepts strictly DER-encoded ones: scripts verified without
+SCRIPT_VERIFY_DERSIG (or STRICTENC/LOW_S) fail on signatures that are not,
+where litecoind parses them laxly."""
+
+import hashlib
+import unittest
+
+from .key import ECKey, ECPubKey
+from .messages import COutPoint, CTransaction, CTxIn, CTxInWitness, CTxOut, sha256
+from .script import (
+    CScript,
+    CScriptInvalidError,
+    FindAndDelete,
+    MAX_SCRIPT_ELEMENT_SIZE,
+    OP_0,
+    OP_0NOTEQUAL,
+    OP_1,
+    OP_16,
+    OP_1ADD,
+    OP_1NEGATE,
+    OP_1SUB,
+    OP_2DIV,
+    OP_2DROP,
+    OP_2DUP,
+    OP_2MUL,
+    OP_2OVER,
+    OP_2ROT,
+    OP_2SWAP,
+    OP_3DUP,
+    OP_ABS,
+    OP_ADD,
+    OP_AND,
+    OP_BOOLAND,
+    OP_BOOLOR,
+    OP_CAT,
+    OP_CHECKLOCKTIMEVERIFY,
+    OP_CHECKMULTISIG,
+    OP_CHECKMULTISIGVERIFY,
+    OP_CHECKSEQUENCEVERIFY,
+    OP_CHECKSIG,
+    OP_CHECKSIGVERIFY,
+    OP_CODESEPARATOR,
+    OP_DEPTH,
+    OP_DIV,
+    OP_DROP,
+    OP_DUP,
+    OP_ELSE,
+    OP_ENDIF,
+    OP_EQUAL,
+    OP_EQUALVERIFY,
+    OP_FROMALTSTACK,
+    OP_GREATERTHAN,
+    OP_GREATERTHANOREQUAL,
+    OP_HASH160,
+    OP_HASH256,
+    OP_IF,
+    OP_IFDUP,
+    OP_INVERT,
+    OP_LEFT,
+    OP_LESSTHAN,
+    OP_LESSTHANOREQUAL,
+    OP_LSHIFT,
+    OP_MAX,
+    OP_MIN,
+    OP_MOD,
+    OP_MUL,
+    OP_NEGATE,
+    OP_NIP,
+    OP_NOP,
+    OP_NOP1,
+    OP_NOP10,
+    OP_NOP4,
+    OP_NOT,
+    OP_NOTIF,
+    OP_NUMEQUAL,
+    OP_NUMEQUALVERIFY,
+    OP_NUMNOTEQUAL,
+    OP_OR,
+    OP_OVER,
+    OP_PICK,
+    OP_PUSHDATA1,
+    OP_PUSHDATA2,
+    OP_PUSHDATA4,
+    OP_RETURN,
+    OP_RIGHT,
+    OP_RIPEMD160,
+    OP_ROLL,
+    OP_ROT,
+    OP_RSHIFT,
+    OP_SHA1,
+    OP_SHA256,
+    OP_SIZE,
+    OP_SUB,
+    OP_SUBSTR,
+    OP_SWAP,
+    OP_TOALTSTACK,
+    OP_TUCK,
+    OP_VERIFY,
+    OP_WITHIN,
+    OP_XOR,
+    SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_SINGLE,
+    SighashCache,
+    SignatureHash,
+    hash160,
+    hash256,
+    keyhash_to_p2pkh_script,
+)
+
+# Script verification flags, see src/script/interpreter.h
+SCRIPT_VERIFY_NONE = 0
+SCRIPT_VERIFY_P2SH = (1 << 0)
+SCRIPT_VERIFY_STRICTENC = (1 << 1)
+SCRIPT_VERIFY_DERSIG = (1 << 2)
+SCRIPT_VERIFY_LOW_S = (1 << 3)
+SCRIPT_VERIFY_NULLDUMMY = (1 << 4)
+SCRIPT_VERIFY_SIGPUSHONLY = (1 << 5)
+SCRIPT_VERIFY_MINIMALDATA = (1 << 6)
+SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS = (1 << 7)
+SCRIPT_VERIFY_CLEANSTACK = (1 << 8)
+SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY = (1 << 9)
+SCRIPT_VERIFY_CHECKSEQUENCEVERIFY = (1 << 10)
+SCRIPT_VERIFY_WITNESS = (1 << 11)
+SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_WITNESS_PROGRAM = (1 << 12)
+SCRIPT_VERIFY_MINIMALIF = (1 << 13)
+SCRIPT_VERIFY_NULLFAIL = (1 << 14)
+SCRIPT_VERIFY_WITNESS_PUBKEYTYPE = (1 << 15)
+SCRIPT_VERIFY_CONST_SCRIPTCODE = (1 << 16)
+
+# See src/policy/policy.h
+MANDATORY_SCRIPT_VERIFY_FLAGS = SCRIPT_VERIFY_P2SH
+STANDARD_SCRIPT_VERIFY_FLAGS = (MANDATORY_SCRIPT_VERIFY_FLAGS
+                                | SCRIPT_VERIFY_DERSIG
+                                | SCRIPT_VERIFY_STRICTENC
+                                | SCRIPT_VERIFY_MINIMALDATA
+                                | SCRIPT_VERIFY_NULLDUMMY
+                                | SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS
+                                | SCRIPT_VERIFY_CLEANSTACK
+                                | SCRIPT_VERIFY_MINIMALIF
+                                | SCRIPT_VERIFY_NULLFAIL
+                                | SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY
+                                | SCRIPT_VERIFY_CHECKSEQUENCEVERIFY
+                                | SCRIPT_VERIFY_LOW_S
+                                | SCRIPT_VERIFY_WITNESS
+                                | SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_WITNESS_PROGRAM
+                                | SCRIPT_VERIFY_WITNESS_PUBKEYTYPE
+                                | SCRIPT_VERIFY_CONST_SCRIPTCODE)
+
+SIGVERSION_BASE = 0
+SIGVERSION_WITNESS_V0 = 1
+
+MAX_SCRIPT_SIZE = 10000
+MAX_OPS_PER_SCRIPT = 201
+MAX_PUBKEYS_PER_MULTISIG = 20
+MAX_STACK_SIZE = 1000
+LOCKTIME_THRESHOLD = 500000000
+SEQUENCE_FINAL = 0xffffffff
+SEQUENCE_LOCKTIME_DISABLE_FLAG = (1 << 31)
+SEQUENCE_LOCKTIME_TYPE_FLAG = (1 << 22)
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
+
+# ScriptErrorString() of each ScriptError_t, see src/script/script_error.cpp
+SCRIPT_ERRORS = {
+    "EVAL_FALSE": "Script evaluated without error but finished with a false/empty top stack element",
+    "VERIFY": "Script failed an OP_VERIFY operation",
+    "EQUALVERIFY": "Script failed an OP_EQUALVERIFY operation",
+    "CHECKMULTISIGVERIFY": "Script failed an OP_CHECKMULTISIGVERIFY operation",
+    "CHECKSIGVERIFY": "Script failed an OP_CHECKSIGVERIFY operation",
+    "NUMEQUALVERIFY": "Script failed an OP_NUMEQUALVERIFY operation",
+    "SCRIPT_SIZE": "Script is too big",
+    "PUSH_SIZE": "Push value size limit exceeded",
+    "OP_COUNT": "Operation limit exceeded",
+    "STACK_SIZE": "Stack size limit exceeded",
+    "SIG_COUNT": "Signature count negative or greater than pubkey count",
+    "PUBKEY_COUNT": "Pubkey count negative or limit exceeded",
+    "BAD_OPCODE": "Opcode missing or not understood",
+    "DISABLED_OPCODE": "Attempted to use a disabled opcode",
+    "INVALID_STACK_OPERATION": "Operation not valid with the current stack size",
+    "INVALID_ALTSTACK_OPERATION": "Operation not valid with the current altstack size",
+    "OP_RETURN": "OP_RETURN was encountered",
+    "UNBALANCED_CONDITIONAL": "Invalid OP_IF construction",
+    "NEGATIVE_LOCKTIME": "Negative locktime",
+    "UNSATISFIED_LOCKTIME": "Locktime requirement not satisfied",
+    "SIG_HASHTYPE": "Signature hash type missing or not understood",
+    "SIG_DER": "Non-canonical DER signature",
+    "MINIMALDATA": "Data push larger than necessary",
+    "SIG_PUSHONLY": "Only non-push operators allowed in signatures",
+    "SIG_HIGH_S": "Non-canonical signature: S value is unnecessarily high",
+    "SIG_NULLDUMMY": "Dummy CHECKMULTISIG argument must be zero",
+    "MINIMALIF": "OP_IF/NOTIF argument must be minimal",
+    "SIG_NULLFAIL": "Signature must be zero for failed CHECK(MULTI)SIG operation",
+    "DISCOURAGE_UPGRADABLE_NOPS": "NOPx reserved for soft-fork upgrades",
+    "DISCOURAGE_UPGRADABLE_WITNESS_PROGRAM": "Witness version reserved for soft-fork upgrades",
+    "PUBKEYTYPE": "Public key is neither compressed or uncompressed",
+    "CLEANSTACK": "Extra items left on stack after execution",
+    "WITNESS_PROGRAM_WRONG_LENGTH": "Witness program has incorrect length",
+    "WITNESS_PROGRAM_WITNESS_EMPTY": "Witness program was passed an empty witness",
+    "WITNESS_PROGRAM_MISMATCH": "Witness program hash mismatch",
+    "WITNESS_MALLEATED": "Witness requires empty scriptSig",
+    "WITNESS_MALLEATED_P2SH": "Witness requires only-redeemscript scriptSig",
+    "WITNESS_UNEXPECTED": "Witness provided for non-witness script",
+    "WITNESS_PUBKEYTYPE": "Using non-compressed keys in segwit",
+    "OP_CODESEPARATOR": "Using OP_CODESEPARATOR in non-witness script",
+    "SIG_FINDANDDELETE": "Signature is found in scriptCode",
+    "UNKNOWN_ERROR": "unknown error",
+}
+
+DISABLED_OPCODES = frozenset((OP_CAT, OP_SUBSTR, OP_LEFT, OP_RIGHT, OP_INVERT, OP_AND, OP_OR, OP_XOR,
+                              OP_2MUL, OP_2DIV, OP_MUL, OP_DIV, OP_MOD, OP_LSHIFT, OP_RSHIFT))
+
+
+class ScriptError(Exception):
+    """Script verification failure; error is the ScriptError_t name (without SCRIPT_ERR_)"""
+    def __init__(self, error):
+        self.error = error
+        super(ScriptError, self).__init__(SCRIPT_ERRORS[error])
+
+
+class ScriptNumError(Exception):
+    """Invalid script number, see scriptnum_error"""
+    pass
+
+
+def decode_script_num(vch, require_minimal, max_size=4):
+    """Decode a stack element as a number, as the CScriptNum constructor"""
+    if len(vch) > max_size:
+        raise ScriptNumError("script number overflow")
+    if require_minimal and len(vch) > 0:
+        # The most significant byte may only be 0x00 or 0x80 if the next one has its top bit set
+        if (vch[-1] & 0x7f) == 0 and (len(vch) <= 1 or (vch[-2] & 0x80) == 0):
+            raise ScriptNumError("non-minimally encoded script number")
+    if len(vch) == 0:
+        return 0
+    result = int.from_bytes(vch, 'little')
+    if vch[-1] & 0x80:
+        return -(result & ~(0x80 << (8 * (len(vch) - 1))))
+    return result
+
+def encode_script_num(n):
+    """Encode a number as a stack element, as CScriptNum::serialize()"""
+    if n == 0:
+        return b""
+    r = bytearray()
+    neg = n < 0
+    absvalue = -n if neg else n
+    while absvalue:
+        r.append(absvalue & 0xff)
+        absvalue >>= 8
+    if r[-1] & 0x80:
+        r.append(0x80 if neg else 0)
+    elif neg:
+        r[-1] |= 0x80
+    return bytes(r)
+
+def cast_to_bool(vch):
+    for i in range(len(vch)):
+        if vch[i] != 0:
+            # Negative zero is still zero
+            return not (i == len(vch) - 1 and vch[i] == 0x80)
+    return False
+
+def check_minimal_push(data, opcode):
+    if len(data) == 0:
+        # Should have used OP_0.
+        return opcode == OP_0
+    elif len(data) == 1 and 1 <= data[0] <= 16:
+        # Should have used OP_1 .. OP_16.
+        return False
+    elif len(data) == 1 and data[0] == 0x81:
+        # Should have used OP_1NEGATE.
+        return False
+    elif len(data) <= 75:
+        # Must have used a direct push (opcode indicating number of bytes pushed + those bytes).
+        return opcode == len(data)
+    elif len(data) <= 255:
+        # Must have used OP_PUSHDATA.
+        return opcode == OP_PUSHDATA1
+    elif len(data) <= 65535:
+        # Must have used OP_PUSHDATA2.
+        return opcode == OP_PUSHDATA2
+    return True
+
+def is_valid_signature_encoding(sig):
+    """Check a signature with hashtype byte for strict DER encoding, see BIP66"""
+    if len(sig) < 9 or len(sig) > 73:
+        return False
+    if sig[0] != 0x30 or sig[1] != len(sig) - 3:
+        return False
+    len_r = sig[3]
+    if 5 + len_r >= len(sig):
+        return False
+    len_s = sig[5 + len_r]
+    if len_r + len_s + 7 != len(sig):
+        return False
+    if sig[2] != 0x02 or len_r == 0 or sig[4] & 0x80:
+        return False
+    if len_r > 1 and sig[4] == 0x00 and not (sig[5] & 0x80):
+        return False
+    if sig[len_r + 4] != 0x02 or len_s == 0 or sig[len_r + 6] & 0x80:
+        return False
+    if len_s > 1 and sig[len_r + 6] == 0x00 and not (sig[len_r + 7] & 0x80):
+        return False
+    return True
+
+def is_low_der_signature(sig):
+    len_r = sig[3]
+    s = int.from_bytes(sig[6 + len_r:-1], 'big')
+    return s <= 0x7FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF5D576E7357A4501DDFE92F46681B20A0
+
+def is_defined_hashtype_signature(sig):
+    if len(sig) == 0:
+        return False
+    hashtype = sig[-1] & ~SIGHASH_ANYONECANPAY
+    return SIGHASH_ALL <= hashtype <= SIGHASH_SINGLE
+
+def check_signature_encoding(sig, flags):
+    # Empty signature. Not strictly DER encoded, but allowed to provide a
+    # compact way to provide an invalid signature for use with CHECK(MULTI)SIG
+    if len(sig) == 0:
+        return
+    if (flags & (SCRIPT_VERIFY_DERSIG | SCRIPT_VERIFY_LOW_S | SCRIPT_VERIFY_STRICTENC)) and not is_valid_signature_encoding(sig):
+        raise ScriptError("SIG_DER")
+    if (flags & SCRIPT_VERIFY_LOW_S) and not is_low_der_signature(sig):
+        raise ScriptError("SIG_HIGH_S")
+    if (flags & SCRIPT_VERIFY_STRICTENC) and not is_defined_hashtype_signature(sig):
+        raise ScriptError("SIG_HASHTYPE")
+
+def check_pubkey_encoding(pubkey, flags, sigversion):
+    compressed = len(pubkey) == 33 and pubkey[0] in (0x02, 0x03)
+    uncompressed = len(pubkey) == 65 and pubkey[0] == 0x04
+    if (flags & SCRIPT_VERIFY_STRICTENC) and not (compressed or uncompressed):
+        raise ScriptError("PUBKEYTYPE")
+    # Only compressed keys are accepted in segwit
+    if (flags & SCRIPT_VERIFY_WITNESS_PUBKEYTYPE) and sigversion == SIGVERSION_WITNESS_V0 and not compressed:
+        raise ScriptError("WITNESS_PUBKEYTYPE")
+
+def is_push_only(script):
+    try:
+        return all(opcode <= OP_16 for (opcode, data, sop_idx) in CScript(script).raw_iter())
+    except CScriptInvalidError:
+        return False
+
+def get_witness_program(script):
+    """Return (version, program) if script is a witness program, None otherwise"""
+    if 4 <= len(script) <= 42 and (script[0] == OP_0 or OP_1 <= script[0] <= OP_16) and script[1] + 2 == len(script):
+        return (0 if script[0] == OP_0 else script[0] - OP_1 + 1, bytes(script[2:]))
+    return None
+
+def is_p2sh(script):
+    return len(script) == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL
+
+
+class BaseSignatureChecker():
+    """Checks signatures and locktimes against nothing: they all fail"""
+
+    def check_sig(self, sig, pubkey, script_code, sigversion):
+        return False
+
+    def check_lock_time(self, lock_time):
+        return False
+
+    def check_sequence(self, sequence):
+        return False
+
+
+class TransactionSignatureChecker(BaseSignatureChecker):
+    """Checks signatures and locktimes for input n of tx, spending amount
+
+    Pass the same SighashCache of tx when checking several of its inputs."""
+
+    def __init__(self, tx, n, amount, sighash_cache=None):
+        self.tx = tx
+        self.n = n
+        self.amount = amount
+        self.sighash_cache = SighashCache(tx) if sighash_cache is None else sighash_cache
+
+    def check_sig(self, sig, pubkey, script_code, sigversion):
+        key = ECPubKey()
+        key.set(pubkey)
+        if not key.is_valid or len(sig) == 0:
+            return False
+        hashtype = sig[-1]
+        if sigversion == SIGVERSION_WITNESS_V0:
+            sighash = self.sighash_cache.segwit_signature_hash(script_code, self.n, hashtype, self.amount)
+        else:
+            sighash = self.sighash_cache.signature_hash(script_code, self.n, hashtype)[0]
+        # litecoind normalizes S before verifying; LOW_S is enforced separately
+        return key.verify_ecdsa(sig[:-1], sighash, low_s=False)
+
+    def check_lock_time(self, lock_time):
+        tx_lock_time = self.tx.nLockTime
+        # Block height and time locks can't be compared
+        if (tx_lock_time < LOCKTIME_THRESHOLD) != (lock_time < LOCKTIME_THRESHOLD):
+            return False
+        if lock_time > tx_lock_time:
+            return False
+        # A final input disables nLockTime
+        if self.tx.vin[self.n].nSequence == SEQUENCE_FINAL:
+            return False
+        return True
+
+    def check_sequence(self, sequence):
+        tx_sequence = self.tx.vin[self.n].nSequence
+        # Relative locktimes need version 2 transactions (nVersion as unsigned)
+        if (self.tx.nVersion & 0xffffffff) < 2:
+            return False
+        if tx_sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+            return False
+        mask = SEQUENCE_LOCKTIME_TYPE_FLAG | SEQUENCE_LOCKTIME_MASK
+        tx_sequence &= mask
+        sequence &= mask
+        if (tx_sequence < SEQUENCE_LOCKTIME_TYPE_FLAG) != (sequence < SEQUENCE_LOCKTIME_TYPE_FLAG):
+            return False
+        if sequence > tx_sequence:
+            return False
+        return True
+
+
+def EvalScript(stack, script, flags, checker=None, sigversion=SIGVERSION_BASE):
+    """Run script on stack (a list of bytes, top last), raising ScriptError if it fails"""
+    try:
+        _eval_script(stack, CScript(script), flags, checker or BaseSignatureChecker(), sigversion)
+    except ScriptNumError:
+        raise ScriptError("UNKNOWN_ERROR")
+
+def _eval_script(stack, script, flags, checker, sigversion):
+    if len(script) > MAX_SCRIPT_SIZE:
+        raise ScriptError("SCRIPT_SIZE")
+    require_minimal = bool(flags & SCRIPT_VERIFY_MINIMALDATA)
+    altstack = []
+    vf_exec = []
+    op_count = 0
+    begin_code_hash = 0
+
+    def top(i):
+        if len(stack) < i:
+            raise ScriptError("INVALID_STACK_OPERATION")
+        return stack[-i]
+
+    def num(vch, max_size=4):
+        return decode_script_num(vch, require_minimal, max_size)
+
+    ops = script.raw_iter()
+    while True:
+        try:
+            opcode, data, sop_idx = next(ops)
+        except StopIteration:
+            break
+        except CScriptInvalidError:
+            raise ScriptError("BAD_OPCODE")
+        f_exec = False not in vf_exec
+
+        if data is not None and len(data) > MAX_SCRIPT_ELEMENT_SIZE:
+            raise ScriptError("PUSH_SIZE")
+        # Note how OP_RESERVED does not count towards the opcode limit.
+        if opcode > OP_16:
+            op_count += 1
+            if op_count > MAX_OPS_PER_SCRIPT:
+                raise ScriptError("OP_COUNT")
+        if opcode in DISABLED_OPCODES:
+            raise ScriptError("DISABLED_OPCODE")
+        # With SCRIPT_VERIFY_CONST_SCRIPTCODE, OP_CODESEPARATOR in non-segwit script is rejected even in an unexecuted branch
+        if opcode == OP_CODESEPARATOR and sigversion == SIGVERSION_BASE and (flags & SCRIPT_VERIFY_CONST_SCRIPTCODE):
+            raise ScriptError("OP_CODESEPARATOR")
+
+        if f_exec and opcode <= OP_PUSHDATA4:
+            if require_minimal and not check_minimal_push(data, opcode):
+                raise ScriptError("MINIMALDATA")
+            stack.append(data)
+        elif f_exec or (OP_IF <= opcode <= OP_ENDIF):
+            # Push value
+            if opcode == OP_1NEGATE or OP_1 <= opcode <= OP_16:
+                stack.append(encode_script_num(opcode - (OP_1 - 1)))
+
+            # Control
+            elif opcode == OP_NOP:
+                pass
+            elif opcode == OP_CHECKLOCKTIMEVERIFY:
+                # Not enabled, it is a NOP2 (and not discouraged)
+                if flags & SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY:
+                    # Up to 5 bytes, as locktimes go up to 2**32 - 1
+                    lock_time = num(top(1), 5)
+                    if lock_time < 0:
+                        raise ScriptError("NEGATIVE_LOCKTIME")
+                    if not checker.check_lock_time(lock_time):
+                        raise ScriptError("UNSATISFIED_LOCKTIME")
+            elif opcode == OP_CHECKSEQUENCEVERIFY:
+                # Not enabled, it is a NOP3 (and not discouraged)
+                if flags & SCRIPT_VERIFY_CHECKSEQUENCEVERIFY:
+                    sequence = num(top(1), 5)
+                    if sequence < 0:
+                        raise ScriptError("NEGATIVE_LOCKTIME")
+                    # The disable flag makes it a NOP
+                    if not (sequence & SEQUENCE_LOCKTIME_DISABLE_FLAG) and not checker.check_sequence(sequence):
+                        raise ScriptError("UNSATISFIED_LOCKTIME")
+            elif opcode == OP_NOP1 or OP_NOP4 <= opcode <= OP_NOP10:
+                if flags & SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS:
+                    raise ScriptError("DISCOURAGE_UPGRADABLE_NOPS")
+            elif opcode in (OP_IF, OP_NOTIF):
+                value = False
+                if f_exec:
+                    if len(stack) < 1:
+                        raise ScriptError("UNBALANCED_CONDITIONAL")
+                    vch = stack[-1]
+                    if sigversion == SIGVERSION_WITNESS_V0 and (flags & SCRIPT_VERIFY_MINIMALIF):
+                        if len(vch) > 1 or (len(vch) == 1 and vch[0] != 1):
+                            raise ScriptError("MINIMALIF")
+                    value = cast_to_bool(vch)
+                    if opcode == OP_NOTIF:
+                        value = not value
+                    stack.pop()
+                vf_exec.append(value)
+            elif opcode == OP_ELSE:
+                if not vf_exec:
+                    raise ScriptError("UNBALANCED_CONDITIONAL")
+                vf_exec[-1] = not vf_exec[-1]
+            elif opcode == OP_ENDIF:
+                if not vf_exec:
+                    raise ScriptError("UNBALANCED_CONDITIONAL")
+                vf_exec.pop()
+            elif opcode == OP_VERIFY:
+                if not cast_to_bool(top(1)):
+                    raise ScriptError("VERIFY")
+                stack.pop()
+            elif opcode == OP_RETURN:
+                raise ScriptError("OP_RETURN")
+
+            # Stack ops
+            elif opcode == OP_TOALTSTACK:
+                altstack.append(top(1))
+                stack.pop()
+            elif opcode == OP_FROMALTSTACK:
+                if len(altstack) < 1:
+                    raise ScriptError("INVALID_ALTSTACK_OPERATION")
+                stack.append(altstack.pop())
+            elif opcode == OP_2DROP:
+                top(2)
+                del stack[-2:]
+            elif opcode == OP_2DUP:
+                stack.extend([top(2), top(1)])
+            elif opcode == OP_3DUP:
+                stack.extend([top(3), top(2), top(1)])
+            elif opcode == OP_2OVER:
+                stack.extend([top(4), top(3)])
+            elif opcode == OP_2ROT:
+                top(6)
+                stack.extend(stack[-6:-4])
+                del stack[-8:-6]
+            elif opcode == OP_2SWAP:
+                top(4)
+                stack[-4:] = stack[-2:] + stack[-4:-2]
+            elif opcode == OP_IFDUP:
+                if cast_to_bool(top(1)):
+                    stack.append(stack[-1])
+            elif opcode == OP_DEPTH:
+                stack.append(encode_script_num(len(stack)))
+            elif opcode == OP_DROP:
+                top(1)
+                stack.pop()
+            elif opcode == OP_DUP:
+                stack.append(top(1))
+            elif opcode == OP_NIP:
+                top(2)
+                del stack[-2]
+            elif opcode == OP_OVER:
+                stack.append(top(2))
+            elif opcode in (OP_PICK, OP_ROLL):
+                n = num(top(1))
+                stack.pop()
+                if n < 0 or n >= len(stack):
+                    raise ScriptError("INVALID_STACK_OPERATION")
+                vch = stack[-n - 1]
+                if opcode == OP_ROLL:
+                    del stack[-n - 1]
+                stack.append(vch)
+            elif opcode == OP_ROT:
+                top(3)
+                stack.append(stack.pop(-3))
+            elif opcode == OP_SWAP:
+                top(2)
+                stack[-2], stack[-1] = stack[-1], stack[-2]
+            elif opcode == OP_TUCK:
+                top(2)
+                stack.insert(-2, stack[-1])
+            elif opcode == OP_SIZE:
+                stack.append(encode_script_num(len(top(1))))
+
+            # Bitwise logic
+            elif opcode in (OP_EQUAL, OP_EQUALVERIFY):
+                equal = top(2) == top(1)
+                del stack[-2:]
+                stack.append(b"\x01" if equal else b"")
+                if opcode == OP_EQUALVERIFY:
+                    if not equal:
+                        raise ScriptError("EQUALVERIFY")
+                    stack.pop()
+
+            # Numeric
+            elif opcode in (OP_1ADD, OP_1SUB, OP_NEGATE, OP_ABS, OP_NOT, OP_0NOTEQUAL):
+                bn = num(top(1))
+                if opcode == OP_1ADD:
+                    bn += 1
+                elif opcode == OP_1SUB:
+                    bn -= 1
+                elif opcode == OP_NEGATE:
+                    bn = -bn
+                elif opcode == OP_ABS:
+                    bn = abs(bn)
+                elif opcode == OP_NOT:
+                    bn = int(bn == 0)
+                else:
+                    bn = int(bn != 0)
+                stack[-1] = encode_script_num(bn)
+            elif opcode in (OP_ADD, OP_SUB, OP_BOOLAND, OP_BOOLOR, OP_NUMEQUAL, OP_NUMEQUALVERIFY,
+                            OP_NUMNOTEQUAL, OP_LESSTHAN, OP_GREATERTHAN, OP_LESSTHANOREQUAL,
+                            OP_GREATERTHANOREQUAL, OP_MIN, OP_MAX):
+                bn1 = num(top(2))
+                bn2 = num(top(1))
+                if opcode == OP_ADD:
+                    bn = bn1 + bn2
+                elif opcode == OP_SUB:
+                    bn = bn1 - bn2
+                elif opcode == OP_BOOLAND:
+                    bn = int(bn1 != 0 and bn2 != 0)
+                elif opcode == OP_BOOLOR:
+                    bn = int(bn1 != 0 or bn2 != 0)
+                elif opcode in (OP_NUMEQUAL, OP_NUMEQUALVERIFY):
+                    bn = int(bn1 == bn2)
+                elif opcode == OP_NUMNOTEQUAL:
+                    bn = int(bn1 != bn2)
+                elif opcode == OP_LESSTHAN:
+                    bn = int(bn1 < bn2)
+                elif opcode == OP_GREATERTHAN:
+                    bn = int(bn1 > bn2)
+                elif opcode == OP_LESSTHANOREQUAL:
+                    bn = int(bn1 <= bn2)
+                elif opcode == OP_GREATERTHANOREQUAL:
+                    bn = int(bn1 >= bn2)
+                elif opcode == OP_MIN:
+                    bn = min(bn1, bn2)
+                else:
+                    bn = max(bn1, bn2)
+                del stack[-2:]
+                stack.append(encode_script_num(bn))
+                if opcode == OP_NUMEQUALVERIFY:
+                    if not cast_to_bool(stack[-1]):
+                        raise ScriptError("NUMEQUALVERIFY")
+                    stack.pop()
+            elif opcode == OP_WITHIN:
+                bn1 = num(top(3))
+                bn2 = num(top(2))
+                bn3 = num(top(1))
+                del stack[-3:]
+                stack.append(b"\x01" if bn2 <= bn1 < bn3 else b"")
+
+            # Crypto
+            elif opcode == OP_RIPEMD160:
+                stack[-1] = hashlib.new('ripemd160', top(1)).digest()
+            elif opcode == OP_SHA1:
+                stack[-1] = hashlib.sha1(top(1)).digest()
+            elif opcode == OP_SHA256:
+                stack[-1] = sha256(top(1))
+            elif opcode == OP_HASH160:
+                stack[-1] = hash160(top(1))
+            elif opcode == OP_HASH256:
+                stack[-1] = hash256(top(1))
+            elif opcode == OP_CODESEPARATOR:
+                # Hash starts after the code separator
+                begin_code_hash = sop_idx + 1
+            elif opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
+                sig = top(2)
+                pubkey = top(1)
+                script_code = CScript(script[begin_code_hash:])
+                # Drop the signature in pre-segwit scripts but not segwit scripts
+                if sigversion == SIGVERSION_BASE:
+                    script_code = _delete_signature(script_code, sig, flags)
+                check_signature_encoding(sig, flags)
+                check_pubkey_encoding(pubkey, flags, sigversion)
+                success = checker.check_sig(sig, pubkey, script_code, sigversion)
+                if not success and (flags & SCRIPT_VERIFY_NULLFAIL) and len(sig):
+                    raise ScriptError("SIG_NULLFAIL")
+                del stack[-2:]
+                stack.append(b"\x01" if success else b"")
+                if opcode == OP_CHECKSIGVERIFY:
+                    if not success:
+                        raise ScriptError("CHECKSIGVERIFY")
+                    stack.pop()
+            elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
+                i = 1
+                keys_count = num(top(i))
+                if keys_count < 0 or keys_count > MAX_PUBKEYS_PER_MULTISIG:
+                    raise ScriptError("PUBKEY_COUNT")
+                op_count += keys_count
+                if op_count > MAX_OPS_PER_SCRIPT:
+                    raise ScriptError("OP_COUNT")
+                i += 1
+                ikey = i
+                # ikey2 is the position of last non-signature item in the stack. Top stack item = 1.
+                # With SCRIPT_VERIFY_NULLFAIL, this is used for cleanup if operation fails.
+                ikey2 = keys_count + 2
+                i += keys_count
+                sigs_count = num(top(i))
+                if sigs_count < 0 or sigs_count > keys_count:
+                    raise ScriptError("SIG_COUNT")
+                i += 1
+                isig = i
+                i += sigs_count
+                if len(stack) < i:
+                    raise ScriptError("INVALID_STACK_OPERATION")
+
+                script_code = CScript(script[begin_code_hash:])
+                # Drop the signature in pre-segwit scripts but not segwit scripts
+                if sigversion == SIGVERSION_BASE:
+                    for k in range(sigs_count):
+                        script_code = _delete_signature(script_code, stack[-isig - k], flags)
+
+                success = True
+                while success and sigs_count > 0:
+                    sig = stack[-isig]
+                    pubkey = stack[-ikey]
+                    # Note how this makes the exact order of pubkey/signature evaluation
+                    # distinguishable by CHECKMULTISIG NOT if the STRICTENC flag is set.
+                    check_signature_encoding(sig, flags)
+                    check_pubkey_encoding(pubkey, flags, sigversion)
+                    if checker.check_sig(sig, pubkey, script_code, sigversion):
+                        isig += 1
+                        sigs_count -= 1
+                    ikey += 1
+                    keys_count -= 1
+                    # If there are more signatures left than keys left,
+                    # then too many signatures have failed. Exit early,
+                    # without checking any further signatures.
+                    if sigs_count > keys_count:
+                        success = False
+
+                # Clean up stack of actual arguments
+                while i > 1:
+                    i -= 1
+                    # If the operation failed, we require that all signatures must be empty vector
+                    if not success and (flags & SCRIPT_VERIFY_NULLFAIL) and not ikey2 and len(stack[-1]):
+                        raise ScriptError("SIG_NULLFAIL")
+                    if ikey2 > 0:
+                        ikey2 -= 1
+                    stack.pop()
+
+                # A bug causes CHECKMULTISIG to consume one extra argument
+                # whose contents were not checked in any way.
+                #
+                # Unfortunately this is a potential source of mutability,
+                # so optionally verify it is exactly equal to zero prior
+                # to removing it from the stack.
+                if len(top(1)) and (flags & SCRIPT_VERIFY_NULLDUMMY):
+                    raise ScriptError("SIG_NULLDUMMY")
+                stack.pop()
+                stack.append(b"\x01" if success else b"")
+                if opcode == OP_CHECKMULTISIGVERIFY:
+                    if not success:
+                        raise ScriptError("CHECKMULTISIGVERIFY")
+                    stack.pop()
+            else:
+                raise ScriptError("BAD_OPCODE")
+
+        # Size limits
+        if len(stack) + len(altstack) > MAX_STACK_SIZE:
+            raise ScriptError("STACK_SIZE")
+
+    if vf_exec:
+        raise ScriptError("UNBALANCED_CONDITIONAL")
+
+def _delete_signature(script_code, sig, flags):
+    deleted = FindAndDelete(script_code, CScript([sig]))
+    if len(deleted) != len(script_code) and (flags & SCRIPT_VERIFY_CONST_SCRIPTCODE):
+        raise ScriptError("SIG_FINDANDDELETE")
+    return deleted
+
+def _verify_witness_program(witness, version, program, flags, checker):
+    if version == 0:
+        if len(program) == 32:
+            # Version 0 segregated witness program: SHA256(CScript) inside the program, CScript + inputs in witness
+            if len(witness) == 0:
+                raise ScriptError("WITNESS_PROGRAM_WITNESS_EMPTY")
+            script_pubkey = CScript(witness[-1])
+            stack = list(witness[:-1])
+            if sha256(script_pubkey) != program:
+                raise ScriptError("WITNESS_PROGRAM_MISMATCH")
+        elif len(program) == 20:
+            # Special case for pay-to-pubkeyhash; signature + pubkey in witness
+            if len(witness) != 2:
+                raise ScriptError("WITNESS_PROGRAM_MISMATCH")
+            script_pubkey = keyhash_to_p2pkh_script(program)
+            stack = list(witness)
+        else:
+            raise ScriptError("WITNESS_PROGRAM_WRONG_LENGTH")
+    elif flags & SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_WITNESS_PROGRAM:
+        raise ScriptError("DISCOURAGE_UPGRADABLE_WITNESS_PROGRAM")
+    else:
+        # Higher version witness scripts return true for future softfork compatibility
+        return
+
+    # Disallow stack item size > MAX_SCRIPT_ELEMENT_SIZE in witness stack
+    for elem in stack:
+        if len(elem) > MAX_SCRIPT_ELEMENT_SIZE:
+            raise ScriptError("PUSH_SIZE")
+
+    EvalScript(stack, script_pubkey, flags, checker, SIGVERSION_WITNESS_V0)
+
+    # Scripts inside witness implicitly require cleanstack behaviour
+    if len(stack) != 1 or not cast_to_bool(stack[-1]):
+        raise ScriptError("EVAL_FALSE")
+
+def VerifyScript(script_sig, script_pubkey, witness, flags, checker=None):
+    """Verify a spend of script_pubkey by script_sig and witness (a list of bytes), raising ScriptError if it fails"""
+    checker = checker or BaseSignatureChecker()
+    witness = list(witness or [])
+    if (flags & SCRIPT_VERIFY_SIGPUSHONLY) and not is_push_only(script_sig):
+        raise ScriptError("SIG_PUSHONLY")
+
+    stack = []
+    EvalScript(stack, script_sig, flags, checker, SIGVERSION_BASE)
+    stack_copy = list(stack) if flags & SCRIPT_VERIFY_P2SH else None
+    EvalScript(stack, script_pubkey, flags, checker, SIGVERSION_BASE)
+    if not stack or not cast_to_bool(stack[-1]):
+        raise ScriptError("EVAL_FALSE")
+
+    # Bare witness programs
+    had_witness = False
+    if flags & SCRIPT_VERIFY_WITNESS:
+        witness_program = get_witness_program(script_pubkey)
+        if witness_program is not None:
+            had_witness = True
+            if len(script_sig) != 0:
+                # The scriptSig must be _exactly_ CScript(), otherwise we reintroduce malleability.
+                raise ScriptError("WITNESS_MALLEATED")
+            _verify_witness_program(witness, witness_program[0], witness_program[1], flags, checker)
+            # Bypass the cleanstack check at the end. The actual stack is obviously not clean
+            # for witness programs.
+            del stack[1:]
+
+    # Additional validation for spend-to-script-hash transactions:
+    if (flags & SCRIPT_VERIFY_P2SH) and is_p2sh(script_pubkey):
+        # scriptSig must be literals-only or validation fails
+        if not is_push_only(script_sig):
+            raise ScriptError("SIG_PUSHONLY")
+
+        # Restore stack.
+        stack = stack_copy
+
+        # stack cannot be empty here, because if it was the
+        # P2SH  HASH <> EQUAL  scriptPubKey would be evaluated with
+        # an empty stack and the EvalScript above would return false.
+        assert stack
+
+        redeem_script = CScript(stack.pop())
+        EvalScript(stack, redeem_script, flags, checker, SIGVERSION_BASE)
+        if not stack or not cast_to_bool(stack[-1]):
+            raise ScriptError("EVAL_FALSE")
+
+        # P2SH witness program
+        if flags & SCRIPT_VERIFY_WITNESS:
+            witness_program = get_witness_program(redeem_script)
+            if witness_program is not None:
+                had_witness = True
+                if script_sig != CScript([redeem_script]):
+                    # The scriptSig must be _exactly_ a single push of the redeemScript. Otherwise we
+                    # reintroduce malleability.
+                    raise ScriptError("WITNESS_MALLEATED_P2SH")
+                _verify_witness_program(witness, witness_program[0], witness_program[1], flags, checker)
+                # Bypass the cleanstack check at the end. The actual stack is obviously not clean
+                # for witness programs.
+                del stack[1:]
+
+    # The CLEANSTACK check is only performed after potential P2SH evaluation,
+    # as the non-P2SH evaluation of a P2SH script will obviously not result in
+    # a clean stack (the P2SH inputs remain). The same holds for witness evaluation.
+    if flags & SCRIPT_VERIFY_CLEANSTACK:
+        # Disallow CLEANSTACK without P2SH, as otherwise a switch CLEANSTACK->P2SH+CLEANSTACK
+        # would be possible, which is not a softfork (and P2SH should be one).
+        assert flags & SCRIPT_VERIFY_P2SH
+        assert flags & SCRIPT_VERIFY_WITNESS
+        if len(stack) != 1:
+            raise ScriptError("CLEANSTACK")
+
+    if flags & SCRIPT_VERIFY_WITNESS:
+        # We can't check for correct unexpected witness data if P2SH was off, so require
+        # that WITNESS implies P2SH. Otherwise, going from WITNESS->P2SH+WITNESS would be
+        # possible, which is not a softfork.
+        assert flags & SCRIPT_VERIFY_P2SH
+        if not had_witness and witness:
+            raise ScriptError("WITNESS_UNEXPECTED")
+
+def verify_tx(tx, spent_outputs, flags=STANDARD_SCRIPT_VERIFY_FLAGS):
+    """Verify the scripts of all inputs of tx, spending the CTxOuts spent_outputs
+
+    Returns a list of (input index, ScriptError) for the inputs that fail,
+    so an empty list means the transaction's scripts are valid."""
+    assert len(spent_outputs) == len(tx.vin)
+    sighash_cache = SighashCache(tx)
+    failures = []
+    for n, (txin, spent_output) in enumerate(zip(tx.vin, spent_outputs)):
+        witness = tx.wit.vtxinwit[n].scriptWitness.stack if n < len(tx.wit.vtxinwit) else []
+        checker = TransactionSignatureChecker(tx, n, spent_output.nValue, sighash_cache)
+        try:
+            VerifyScript(txin.scriptSig, spent_output.scriptPubKey, witness, flags, checker)
+        except ScriptError as e:
+            failures.append((n, e))
+    return failures
+
+
+class TestFrameworkInterpreter(unittest.TestCase):
+    def setUp(self):
+        self.key = ECKey()
+        self.key.generate()
+        self.pubkey = self.key.get_pubkey().get_bytes()
+        self.tx = CTransaction()
+        self.tx.vin = [CTxIn(COutPoint(1, 0))]
+        self.tx.vout = [CTxOut(1000, CScript([OP_1]))]
+
+    def sign(self, script_code):
+        return self.key.sign_ecdsa(SignatureHash(script_code, self.tx, 0, SIGHASH_ALL)[0]) + bytes([SIGHASH_ALL])
+
+    def verify(self, script_sig, script_pubkey, witness=(), flags=STANDARD_SCRIPT_VERIFY_FLAGS):
+        """Return the ScriptError_t name a spend fails with, or None if it is valid"""
+        self.tx.vin[0].scriptSig = script_sig
+        self.tx.wit.vtxinwit = [CTxInWitness()]
+        self.tx.wit.vtxinwit[0].scriptWitness.stack = list(witness)
+        failures = verify_tx(self.tx, [CTxOut(2000, script_pubkey)], flags)
+        return failures[0][1].error if failures else None
+
+    def test_checksig(self):
+        script_pubkey = CScript([self.pubkey, OP_CHECKSIG])
+        sig = self.sign(script_pubkey)
+        self.assertIsNone(self.verify(CScript([sig]), script_pubkey))
+        self.assertEqual(self.verify(CScript([sig[:-2] + sig[-1:]]), script_pubkey), "SIG_DER")
+        self.assertEqual(self.verify(CScript([b""]), script_pubkey), "EVAL_FALSE")
+
+    def test_minimalif(self):
+        witness_script = CScript([OP_IF, OP_1, OP_ELSE, OP_0, OP_ENDIF])
+        p2wsh = CScript([OP_0, sha256(witness_script)])
+        p2sh = CScript([OP_HASH160, hash160(witness_script), OP_EQUAL])
+        self.assertIsNone(self.verify(CScript([]), p2wsh, [b"\x01", witness_script]))
+        self.assertEqual(self.verify(CScript([]), p2wsh, [b"\x02\x00", witness_script]), "MINIMALIF")
+        self.assertIsNone(self.verify(CScript([]), p2wsh, [b"\x02\x00", witness_script], STANDARD_SCRIPT_VERIFY_FLAGS & ~SCRIPT_VERIFY_MINIMALIF))
+        # Only witness v0 scripts are subject to MINIMALIF
+        self.assertIsNone(self.verify(CScript([b"\x02\x00", witness_script]), p2sh))
+
+    def test_nullfail(self):
+        script_pubkey = CScript([self.pubkey, OP_CHECKSIG, OP_NOT])
+        bad_sig = self.sign(CScript([OP_1]))
+        self.assertIsNone(self.verify(CScript([b""]), script_pubkey))
+        self.assertEqual(self.verify(CScript([bad_sig]), script_pubkey), "SIG_NULLFAIL")
+        self.assertIsNone(self.verify(CScript([bad_sig]), script_pubkey, flags=STANDARD_SCRIPT_VERIFY_FLAGS & ~SCRIPT_VERIFY_NULLFAIL))
+
+    def test_nulldummy(self):
+        script_pubkey = CScript([OP_1, self.pubkey, OP_1, OP_CHECKMULTISIG])
+        sig = self.sign(script_pubkey)
+        self.assertIsNone(self.verify(CScript([OP_0, sig]), script_pubkey))
+        self.assertEqual(self.verify(CScript([b"\xab", sig]), script_pubkey), "SIG_NULLDUMMY")
+        self.assertIsNone(self.verify(CScript([b"\xab", sig]), script_pubkey, flags=MANDATORY_SCRIPT_VERIFY_FLAGS))
+
+    def test_findanddelete(self):
+        # The signature commits to the scriptCode with its own push deleted,
+        # so it can be part of the scriptPubKey it signs for.
+        sig = self.sign(CScript([OP_DROP, self.pubkey, OP_CHECKSIG]))
+        script_pubkey = CScript([sig, OP_DROP, self.pubkey, OP_CHECKSIG])
+        self.assertIsNone(self.verify(CScript([sig]), script_pubkey, flags=STANDARD_SCRIPT_VERIFY_FLAGS & ~SCRIPT_VERIFY_CONST_SCRIPTCODE))
+        self.assertEqual(self.verify(CScript([sig]), script_pubkey), "SIG_FINDANDDELETE")
+
+    def test_locktime(self):
+        cltv = CScript([100, OP_CHECKLOCKTIMEVERIFY, OP_DROP, OP_1])
+        csv = CScript([10, OP_CHECKSEQUENCEVERIFY, OP_DROP, OP_1])
+        self.tx.nVersion = 2
+        self.tx.nLockTime = 100
+        self.tx.vin[0].nSequence = 10
+        self.assertIsNone(self.verify(CScript([]), cltv))
+        self.assertIsNone(self.verify(CScript([]), csv))
+        self.assertEqual(self.verify(CScript([]), CScript([-1, OP_CHECKLOCKTIMEVERIFY])), "NEGATIVE_LOCKTIME")
+        self.assertEqual(self.verify(CScript([]), CScript([-1, OP_CHECKSEQUENCEVERIFY])), "NEGATIVE_LOCKTIME")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_CHECKLOCKTIMEVERIFY, OP_1])), "INVALID_STACK_OPERATION")
+        # The disable flag makes OP_CHECKSEQUENCEVERIFY pass
+        self.assertIsNone(self.verify(CScript([]), CScript([1 << 31, OP_CHECKSEQUENCEVERIFY, OP_DROP, OP_1])))
+
+        self.tx.nLockTime = 99
+        self.tx.vin[0].nSequence = 9
+        self.assertEqual(self.verify(CScript([]), cltv), "UNSATISFIED_LOCKTIME")
+        self.assertEqual(self.verify(CScript([]), csv), "UNSATISFIED_LOCKTIME")
+
+        # Without their flags they are NOP2 and NOP3, which unlike the other
+        # NOPs aren't discouraged.
+        flags = STANDARD_SCRIPT_VERIFY_FLAGS & ~(SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY | SCRIPT_VERIFY_CHECKSEQUENCEVERIFY)
+        self.assertIsNone(self.verify(CScript([]), cltv, flags=flags))
+        self.assertIsNone(self.verify(CScript([]), csv, flags=flags))
+        self.assertIsNone(self.verify(CScript([]), CScript([OP_CHECKLOCKTIMEVERIFY, OP_CHECKSEQUENCEVERIFY, OP_1]), flags=flags))
+        self.assertEqual(self.verify(CScript([]), CScript([OP_NOP4, OP_1]), flags=flags), "DISCOURAGE_UPGRADABLE_NOPS")
+        self.assertIsNone(self.verify(CScript([]), CScript([OP_NOP4, OP_1]), flags=MANDATORY_SCRIPT_VERIFY_FLAGS))
+
+    def test_script_errors(self):
+        checksig = CScript([self.pubkey, OP_CHECKSIG])
+        # Stack underflow
+        self.assertEqual(self.verify(CScript([]), CScript([OP_DUP])), "INVALID_STACK_OPERATION")
+        self.assertEqual(self.verify(CScript([OP_1]), CScript([OP_ADD])), "INVALID_STACK_OPERATION")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_FROMALTSTACK])), "INVALID_ALTSTACK_OPERATION")
+        # OP_IF/OP_ELSE/OP_ENDIF imbalance
+        self.assertEqual(self.verify(CScript([]), CScript([OP_1, OP_IF, OP_1])), "UNBALANCED_CONDITIONAL")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_ELSE, OP_1])), "UNBALANCED_CONDITIONAL")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_1, OP_ENDIF])), "UNBALANCED_CONDITIONAL")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_IF, OP_ENDIF, OP_1])), "UNBALANCED_CONDITIONAL")
+        self.assertIsNone(self.verify(CScript([]), CScript([OP_0, OP_IF, OP_ELSE, OP_1, OP_ENDIF])))
+        # Disabled opcodes fail even where they aren't executed
+        self.assertEqual(self.verify(CScript([]), CScript([OP_0, OP_IF, OP_CAT, OP_ENDIF, OP_1])), "DISABLED_OPCODE")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_1, OP_1, OP_MUL])), "DISABLED_OPCODE")
+
+        # CHECKMULTISIG: a non-null dummy, or a failed non-empty signature
+        multisig = CScript([OP_1, self.pubkey, OP_1, OP_CHECKMULTISIG])
+        multisig_not = CScript([OP_1, self.pubkey, OP_1, OP_CHECKMULTISIG, OP_NOT])
+        sig = self.sign(multisig)
+        bad_sig = self.sign(CScript([OP_1]))
+        self.assertIsNone(self.verify(CScript([OP_0, sig]), multisig))
+        self.assertEqual(self.verify(CScript([OP_1, sig]), multisig), "SIG_NULLDUMMY")
+        self.assertEqual(self.verify(CScript([OP_0, bad_sig]), multisig_not), "SIG_NULLFAIL")
+        self.assertIsNone(self.verify(CScript([OP_0, b""]), multisig_not))
+
+        # Witness programs that don't match their witness
+        p2wsh = CScript([OP_0, sha256(checksig)])
+        p2wpkh = CScript([OP_0, hash160(self.pubkey)])
+        sighash = SighashCache(self.tx).segwit_signature_hash(checksig, 0, SIGHASH_ALL, 2000)
+        sig = self.key.sign_ecdsa(sighash) + bytes([SIGHASH_ALL])
+        self.assertIsNone(self.verify(CScript([]), p2wsh, [sig, checksig]))
+        self.assertEqual(self.verify(CScript([]), p2wsh, [b"", checksig]), "EVAL_FALSE")
+        self.assertEqual(self.verify(CScript([]), p2wsh, [b"", CScript([OP_1])]), "WITNESS_PROGRAM_MISMATCH")
+        self.assertEqual(self.verify(CScript([]), p2wsh), "WITNESS_PROGRAM_WITNESS_EMPTY")
+        self.assertEqual(self.verify(CScript([]), p2wpkh, [b"", b"", self.pubkey]), "WITNESS_PROGRAM_MISMATCH")
+        self.assertEqual(self.verify(CScript([]), p2wpkh, [b"", b"\x02" + bytes(32)]), "EQUALVERIFY")
+        self.assertEqual(self.verify(CScript([OP_1]), p2wsh, [b"", checksig]), "WITNESS_MALLEATED")
+        self.assertEqual(self.verify(CScript([]), CScript([OP_0, b"\x01" * 21]), [b""]), "WITNESS_PROGRAM_WRONG_LENGTH")
+
+        # P2SH scriptSigs must be push only
+        p2sh = CScript([OP_HASH160, hash160(CScript([OP_1])), OP_EQUAL])
+        self.assertIsNone(self.verify(CScript([CScript([OP_1])]), p2sh))
+        self.assertEqual(self.verify(CScript([OP_NOP, CScript([OP_1])]), p2sh), "SIG_PUSHONLY")
+        self.assertEqual(self.verify(CScript([OP_NOP, CScript([OP_1])]), p2sh, flags=MANDATORY_SCRIPT_VERIFY_FLAGS), "SIG_PUSHONLY")
@@ -6,7 +6,14 @@
 WARNING: This code is slow, uses bad randomness, does not properly protect
 keys, and is trivially vulnerable to side channel attacks. Do not use for
 anything but tests."""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import hmac
+import os
 import random
+import tempfile
+import unittest
 
 def modinv(a, n):
     """Compute the modular inverse of a modulo n
@@ -25,6 +32,30 @@ def modinv(a, n):
         t1 += n
     return t1
 
+def modinv_many(values, n):
+    """Compute the modular inverses of many values modulo n with a single modinv
+
+    Uses Montgomery's trick: the inverse of the product of all values gives
+    each inverse through a few multiplications. Values that are 0 modulo n
+    get None."""
+    prefix = []
+    acc = 1
+    for a in values:
+        if a % n:
+            acc = (acc * a) % n
+        prefix.append(acc)
+    inv = modinv(acc, n)
+    if inv is None:
+        # n is not prime; invert one by one
+        return [modinv(a, n) if a % n else None for a in values]
+    r = [None] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        a = values[i]
+        if a % n:
+            r[i] = (inv * (prefix[i - 1] if i else 1)) % n
+            inv = (inv * a) % n
+    return r
+
 def jacobi_symbol(n, k):
     """Compute the Jacobi symbol of n modulo k
 
@@ -64,6 +95,24 @@ def modsqrt(a, p):
         return sqrt
     return None
 
+def wnaf(n, w):
+    """Compute the width-w non-adjacent form of n >= 0, least significant digit first
+
+    Every nonzero digit is odd and less than 2**(w-1) in absolute value, and
+    any w consecutive digits have at most one nonzero digit among them."""
+    digits = []
+    while n:
+        if n & 1:
+            d = n & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            n -= d
+        else:
+            d = 0
+        digits.append(d)
+        n >>= 1
+    return digits
+
 class EllipticCurve:
     def __init__(self, p, a, b):
         """Initialize elliptic curve y^2 = x^3 + a*x + b over GF(p)."""
@@ -83,6 +132,19 @@ class EllipticCurve:
         inv_3 = (inv_2 * inv) % self.p
         return ((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1)
 
+    def affine_many(self, ps):
+        """Convert many Jacobian point tuples to affine form (or None if at infinity) with a single inversion."""
+        invs = modinv_many([z1 for (_, _, z1) in ps], self.p)
+        r = []
+        for (x1, y1, z1), inv in zip(ps, invs):
+            if inv is None:
+                r.append(None)
+                continue
+            inv_2 = (inv**2) % self.p
+            inv_3 = (inv_2 * inv) % self.p
+            r.append(((inv_2 * x1) % self.p, (inv_3 * y1) % self.p, 1))
+        return r
+
     def negate(self, p1):
         """Negate a Jacobian point tuple p1."""
         x1, y1, z1 = p1
@@ -199,23 +261,248 @@ class EllipticCurve:
         z3 = (h*z1*z2) % self.p
         return (x3, y3, z3)
 
+    def odd_multiples(self, p1, w):
+        """Compute [p1, 3*p1, 5*p1, ..., (2**(w-1)-1)*p1] as affine tuples, for mul_wnaf
+
+        Returns None if p1 is the point at infinity."""
+        p1 = self.affine(p1)
+        if p1 is None:
+            return None
+        twice = self.affine(self.double(p1))
+        if twice is None:
+            # p1 has order 2: all odd multiples are p1
+            return [p1] * (1 << (w - 2))
+        r = [p1]
+        for i in range(1, 1 << (w - 2)):
+            r.append(self.add_mixed(r[-1], twice))
+        return self.affine_many(r)
+
+    def mul_wnaf(self, ps):
+        """Compute a (multi) point multiplication with interleaved wNAF (Strauss' algorithm)
+
+        ps is a list of (odd multiples, w, scalar) tuples, the odd multiples
+        of each point coming from odd_multiples(point, w). All scalars share
+        the same doublings, and each one costs an addition only for the
+        nonzero digits of its width-w NAF. Scalars may be negative.
+        """
+        nafs = []
+        for (table, w, n) in ps:
+            if table is not None and n:
+                naf = wnaf(abs(n), w)
+                if n < 0:
+                    naf = [-d for d in naf]
+                nafs.append((table, naf))
+        r = (0, 1, 0)
+        for i in range(max((len(naf) for (_, naf) in nafs), default=0) - 1, -1, -1):
+            r = self.double(r)
+            for (table, naf) in nafs:
+                if i < len(naf):
+                    d = naf[i]
+                    if d > 0:
+                        r = self.add_mixed(r, table[d >> 1])
+                    elif d < 0:
+                        r = self.add_mixed(r, self.negate(table[-d >> 1]))
+        return r
+
     def mul(self, ps):
         """Compute a (multi) point multiplication
 
         ps is a list of (Jacobian tuple, scalar) pairs.
         """
+        tables = []
+        for (p, n) in ps:
+            n %= 1 << 256
+            tables.append((self.odd_multiples(p, 4), 4, n))
+        return self.mul_wnaf(tables)
+
+class FixedBaseTable:
+    """Multiplication of a fixed point by scalars, using precomputed multiples
+
+    For a window of w bits, row i of the table holds the affine points
+    j * 2**(w*i) * base for j in 1..2**w-1, so multiplying by a scalar of at
+    most bits bits takes one mixed addition per nonzero w-bit digit instead
+    of a double-and-add over every bit. The table is built the first time
+    it is needed. If cache_path is given, it is read from that file when
+    possible and written there after being built."""
+
+    def __init__(self, curve, base, window=6, bits=256, cache_path=None):
+        self.curve = curve
+        self.base = curve.affine(base)
+        self.window = window
+        self.rows = (bits + window - 1) // window
+        self.cache_path = cache_path
+        self.table = None
+
+    def _build(self):
+        curve = self.curve
+        table = []
+        row_base = self.base
+        for i in range(self.rows):
+            row = [row_base]
+            for j in range(2, 1 << self.window):
+                row.append(curve.add_mixed(row[-1], row_base))
+            # row_base * 2**window = (2**window - 1) * row_base + row_base
+            row.append(curve.add_mixed(row[-1], row_base))
+            row = curve.affine_many(row)
+            row_base = row.pop()
+            table.append(row)
+        return table
+
+    def _load(self):
+        """Read the table from cache_path, returning None if that fails."""
+        try:
+            with open(self.cache_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        row_size = (1 << self.window) - 1
+        if len(data) != self.rows * row_size * 64 + 32:
+            return None
+        # The file ends with the SHA256 of the points, so any damaged entry
+        # is caught.
+        data, checksum = data[:-32], data[-32:]
+        if hashlib.sha256(data).digest() != checksum:
+            return None
+        points = [(int.from_bytes(data[k:k + 32], 'big'), int.from_bytes(data[k + 32:k + 64], 'big'), 1)
+                  for k in range(0, len(data), 64)]
+        # A table computed for another point, window or curve won't start with
+        # our base point.
+        if points[0] != self.base:
+            return None
+        return [points[k:k + row_size] for k in range(0, len(points), row_size)]
+
+    def _save(self, table):
+        data = b"".join(p[0].to_bytes(32, 'big') + p[1].to_bytes(32, 'big') for row in table for p in row)
+        tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data + hashlib.sha256(data).digest())
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # The cache is only an optimization
+            pass
+
+    def get_table(self):
+        if self.table is None:
+            table = self._load() if self.cache_path else None
+            if table is None:
+                table = self._build()
+                if self.cache_path:
+                    self._save(table)
+            self.table = table
+        return self.table
+
+    def mul(self, n):
+        """Compute n * base as a Jacobian tuple."""
+        if n < 0 or n.bit_length() > self.rows * self.window:
+            return self.curve.mul([(self.base, n)])
+        table = self.get_table()
+        mask = (1 << self.window) - 1
         r = (0, 1, 0)
-        for i in range(255, -1, -1):
-            r = self.double(r)
-            for (p, n) in ps:
-                if ((n >> i) & 1):
-                    r = self.add(r, p)
+        i = 0
+        while n:
+            digit = n & mask
+            if digit:
+                r = self.curve.add_mixed(r, table[i][digit - 1])
+            n >>= self.window
+            i += 1
         return r
 
 SECP256K1 = EllipticCurve(2**256 - 2**32 - 977, 0, 7)
 SECP256K1_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798, 0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8, 1)
 SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
+# Multiples of G for get_pubkey() and signing. Set SECP256K1_G_TABLE to a
+# file path to keep the table there between runs.
+SECP256K1_G_TABLE = FixedBaseTable(SECP256K1, SECP256K1_G, cache_path=os.getenv("SECP256K1_G_TABLE"))
+# secp256k1 has an efficiently computable endomorphism:
+# lambda * (x, y) = (beta * x, y)
+SECP256K1_LAMBDA = 0x5363AD4CC05C30E0A5261C028812645A122E22EA20816678DF02967C1B23BD72
+SECP256K1_BETA = 0x7AE96A2B657C07106E64479EAC3434E99CF0497512F58995C1396C28719501EE
+# wNAF widths used by verify_ecdsa() for G, whose odd multiples are computed
+# once per process, and for public keys, which cache their own.
+G_WNAF_WIDTH = 8
+PUBKEY_WNAF_WIDTH = 5
+
+def split_scalar(k):
+    """Split k into (k1, k2), both below 2**129 in absolute value, with k1 + k2 * lambda = k (mod order)
+
+    Multiplying a point by k then takes half as many doublings, as
+    k2 * lambda * P is computed as k2 times the point (beta * x, y).
+    See https://www.iacr.org/archive/crypto2001/21390189.pdf (GLV method)."""
+    a1 = 0x3086D221A7D46BCDE86C90E49284EB15
+    b1 = -0xE4437ED6010E88286F547FA90ABFE4C3
+    a2 = 0x114CA50F7A8E2F3F657C1108D9D44CFD8
+    b2 = a1
+    c1 = (b2 * k + SECP256K1_ORDER // 2) // SECP256K1_ORDER
+    c2 = (-b1 * k + SECP256K1_ORDER // 2) // SECP256K1_ORDER
+    return (k - c1 * a1 - c2 * a2, -c1 * b1 - c2 * b2)
+
+class ParsedPubKey():
+    """An affine point with its serializations, hash160s and odd multiples
+
+    There is one for each point in pubkey_cache, shared by the ECPubKeys
+    for it, so that parsing or serializing the same public key again does
+    not recompute any of them."""
+
+    def __init__(self, p):
+        x, y, _ = p
+        self.p = p
+        self.compressed_bytes = bytes([0x02 + (y & 1)]) + x.to_bytes(32, 'big')
+        self.uncompressed_bytes = bytes([0x04]) + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+        self.hash160s = {}
+        self.wnaf_tables = {}
+
+    def get_bytes(self, compressed):
+        return self.compressed_bytes if compressed else self.uncompressed_bytes
+
+    def get_hash160(self, compressed):
+        if compressed not in self.hash160s:
+            self.hash160s[compressed] = hashlib.new('ripemd160', hashlib.sha256(self.get_bytes(compressed)).digest()).digest()
+        return self.hash160s[compressed]
+
+# ParsedPubKeys by compressed and uncompressed serialization, least recently
+# used first
+PUBKEY_CACHE_SIZE = 1 << 14
+pubkey_cache = OrderedDict()
+
+def parse_pubkey(data):
+    """Return the ParsedPubKey for a serialization in compressed or uncompressed format, or None if it is not valid"""
+    data = bytes(data)
+    parsed = pubkey_cache.get(data)
+    if parsed is not None:
+        pubkey_cache.move_to_end(data)
+        return parsed
+    if (len(data) == 65 and data[0] == 0x04):
+        p = (int.from_bytes(data[1:33], 'big'), int.from_bytes(data[33:65], 'big'), 1)
+        if not SECP256K1.on_curve(p):
+            return None
+    elif (len(data) == 33 and (data[0] == 0x02 or data[0] == 0x03)):
+        x = int.from_bytes(data[1:33], 'big')
+        if not SECP256K1.is_x_coord(x):
+            return None
+        p = SECP256K1.lift_x(x)
+        # if the oddness of the y co-ord isn't correct, find the other
+        # valid y
+        if (p[1] & 1) != (data[0] & 1):
+            p = SECP256K1.negate(p)
+    else:
+        return None
+    return intern_point(p)
+
+def intern_point(p):
+    """Return the ParsedPubKey for an affine point, adding it to pubkey_cache if it is not there yet"""
+    parsed = ParsedPubKey(p)
+    cached = pubkey_cache.get(parsed.compressed_bytes)
+    if cached is not None:
+        parsed = cached
+    pubkey_cache[parsed.compressed_bytes] = parsed
+    pubkey_cache[parsed.uncompressed_bytes] = parsed
+    pubkey_cache.move_to_end(parsed.compressed_bytes)
+    pubkey_cache.move_to_end(parsed.uncompressed_bytes)
+    while len(pubkey_cache) > PUBKEY_CACHE_SIZE:
+        pubkey_cache.popitem(last=False)
+    return parsed
 
 class ECPubKey():
     """A secp256k1 public key"""
@@ -226,27 +513,12 @@ class ECPubKey():
 
     def set(self, data):
         """Construct a public key from a serialization in compressed or uncompressed format"""
-        if (len(data) == 65 and data[0] == 0x04):
-            p = (int.from_bytes(data[1:33], 'big'), int.from_bytes(data[33:65], 'big'), 1)
-            self.valid = SECP256K1.on_curve(p)
-            if self.valid:
-                self.p = p
-                self.compressed = False
-        elif (len(data) == 33 and (data[0] == 0x02 or data[0] == 0x03)):
-            x = int.from_bytes(data[1:33], 'big')
-            if SECP256K1.is_x_coord(x):
-                p = SECP256K1.lift_x(x)
-                # if the oddness of the y co-ord isn't correct, find the other
-                # valid y
-                if (p[1] & 1) != (data[0] & 1):
-                    p = SECP256K1.negate(p)
-                self.p = p
-                self.valid = True
-                self.compressed = True
-            else:
-                self.valid = False
-        else:
-            self.valid = False
+        parsed = parse_pubkey(data)
+        self.valid = parsed is not None
+        if self.valid:
+            self.p = parsed.p
+            self.compressed = data[0] != 0x04
+            self._parsed = parsed
 
     @property
     def is_compressed(self):
@@ -256,15 +528,45 @@ class ECPubKey():
     def is_valid(self):
         return self.valid
 
+    def get_parsed(self):
+        """Return the ParsedPubKey for this key's point, or None if it is the point at infinity"""
+        parsed = getattr(self, '_parsed', None)
+        if parsed is None or parsed.p is not self.p:
+            p = SECP256K1.affine(self.p)
+            if p is None:
+                return None
+            parsed = intern_point(p)
+            self.p = parsed.p
+            self._parsed = parsed
+        return parsed
+
+    def get_wnaf_tables(self, w):
+        """Return the width-w odd multiples of the point and of lambda times it, for verify_ecdsa()
+
+        They are cached with the ParsedPubKey."""
+        parsed = self.get_parsed()
+        if parsed is None:
+            return None, None
+        if w not in parsed.wnaf_tables:
+            table = SECP256K1.odd_multiples(parsed.p, w)
+            lambda_table = [(SECP256K1_BETA * x % SECP256K1.p, y, 1) for (x, y, _) in table]
+            parsed.wnaf_tables[w] = (table, lambda_table)
+        return parsed.wnaf_tables[w]
+
     def get_bytes(self):
         assert(self.valid)
-        p = SECP256K1.affine(self.p)
-        if p is None:
+        parsed = self.get_parsed()
+        if parsed is None:
             return None
-        if self.compressed:
-            return bytes([0x02 + (p[1] & 1)]) + p[0].to_bytes(32, 'big')
-        else:
-            return bytes([0x04]) + p[0].to_bytes(32, 'big') + p[1].to_bytes(32, 'big')
+        return parsed.get_bytes(self.compressed)
+
+    def get_hash160(self):
+        """Return the hash160 of get_bytes(), as used in P2PKH and P2WPKH scripts"""
+        assert(self.valid)
+        parsed = self.get_parsed()
+        if parsed is None:
+            return None
+        return parsed.get_hash160(self.compressed)
 
     def verify_ecdsa(self, sig, msg, low_s=True):
         """Verify a strictly DER-encoded ECDSA signature against this pubkey.
@@ -272,56 +574,171 @@ class ECPubKey():
         See https://en.wikipedia.org/wiki/Elliptic_Curve_Digital_Signature_Algorithm for the
         ECDSA verifier algorithm"""
         assert(self.valid)
-
-        # Extract r and s from the DER formatted signature. Return false for
-        # any DER encoding errors.
-        if (sig[1] + 2 != len(sig)):
-            return False
-        if (len(sig) < 4):
-            return False
-        if (sig[0] != 0x30):
-            return False
-        if (sig[2] != 0x02):
-            return False
-        rlen = sig[3]
-        if (len(sig) < 6 + rlen):
-            return False
-        if rlen < 1 or rlen > 33:
-            return False
-        if sig[4] >= 0x80:
-            return False
-        if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
-            return False
-        r = int.from_bytes(sig[4:4+rlen], 'big')
-        if (sig[4+rlen] != 0x02):
-            return False
-        slen = sig[5+rlen]
-        if slen < 1 or slen > 33:
-            return False
-        if (len(sig) != 6 + rlen + slen):
-            return False
-        if sig[6+rlen] >= 0x80:
-            return False
-        if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
-            return False
-        s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
-
-        # Verify that r and s are within the group order
-        if r < 1 or s < 1 or r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
-            return False
-        if low_s and s >= SECP256K1_ORDER_HALF:
+        rs = parse_der_signature(sig, low_s)
+        if rs is None:
             return False
+        r, s = rs
         z = int.from_bytes(msg, 'big')
 
         # Run verifier algorithm on r, s
         w = modinv(s, SECP256K1_ORDER)
         u1 = z*w % SECP256K1_ORDER
         u2 = r*w % SECP256K1_ORDER
-        R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, u1), (self.p, u2)]))
+        R = SECP256K1.affine(verify_mul(u1, u2, self.get_wnaf_tables(PUBKEY_WNAF_WIDTH)))
         if R is None or R[0] != r:
             return False
         return True
 
+def parse_der_signature(sig, low_s=True):
+    """Extract (r, s) from a strictly DER-encoded ECDSA signature, or None if it is not one with r and s in range"""
+    # Return None for any DER encoding errors.
+    if (len(sig) < 4):
+        return None
+    if (sig[1] + 2 != len(sig)):
+        return None
+    if (sig[0] != 0x30):
+        return None
+    if (sig[2] != 0x02):
+        return None
+    rlen = sig[3]
+    if (len(sig) < 6 + rlen):
+        return None
+    if rlen < 1 or rlen > 33:
+        return None
+    if sig[4] >= 0x80:
+        return None
+    if (rlen > 1 and (sig[4] == 0) and not (sig[5] & 0x80)):
+        return None
+    r = int.from_bytes(sig[4:4+rlen], 'big')
+    if (sig[4+rlen] != 0x02):
+        return None
+    slen = sig[5+rlen]
+    if slen < 1 or slen > 33:
+        return None
+    if (len(sig) != 6 + rlen + slen):
+        return None
+    if sig[6+rlen] >= 0x80:
+        return None
+    if (slen > 1 and (sig[6+rlen] == 0) and not (sig[7+rlen] & 0x80)):
+        return None
+    s = int.from_bytes(sig[6+rlen:6+rlen+slen], 'big')
+
+    # Verify that r and s are within the group order
+    if r < 1 or s < 1 or r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
+        return None
+    if low_s and s >= SECP256K1_ORDER_HALF:
+        return None
+    return (r, s)
+
+def verify_mul(u1, u2, pubkey_tables):
+    """Compute u1 * G + u2 * Q as a Jacobian tuple, given Q's get_wnaf_tables(PUBKEY_WNAF_WIDTH)"""
+    u1_1, u1_2 = split_scalar(u1)
+    u2_1, u2_2 = split_scalar(u2)
+    g, g_lambda = SECP256K1_G_PUBKEY.get_wnaf_tables(G_WNAF_WIDTH)
+    q, q_lambda = pubkey_tables
+    return SECP256K1.mul_wnaf([
+        (g, G_WNAF_WIDTH, u1_1), (g_lambda, G_WNAF_WIDTH, u1_2),
+        (q, PUBKEY_WNAF_WIDTH, u2_1), (q_lambda, PUBKEY_WNAF_WIDTH, u2_2)])
+
+def verify_ecdsa_batch(entries, low_s=True, executor=None, chunk_size=64):
+    """Verify many (pubkey, sig, msg) entries as ECPubKey.verify_ecdsa() would, and return the indices of those that fail.
+
+    The odd multiples of G and of each distinct public key are computed once,
+    the s values are inverted together, and R is checked against r without
+    converting it to affine form. An entry with an invalid pubkey fails.
+
+    If executor is a concurrent.futures.ProcessPoolExecutor (or any other
+    Executor), the entries are verified in chunks of chunk_size on it."""
+    entries = list(entries)
+    if executor is not None:
+        serialized = {}
+        chunks = []
+        for i in range(0, len(entries), chunk_size):
+            chunk = []
+            for pubkey, sig, msg in entries[i:i + chunk_size]:
+                if id(pubkey) not in serialized:
+                    serialized[id(pubkey)] = pubkey.get_bytes() if pubkey.valid else None
+                chunk.append((serialized[id(pubkey)], bytes(sig), bytes(msg)))
+            chunks.append(chunk)
+        failed = []
+        for i, chunk_failed in zip(range(0, len(entries), chunk_size), executor.map(_verify_ecdsa_chunk, chunks, [low_s] * len(chunks))):
+            failed.extend(i + j for j in chunk_failed)
+        return failed
+
+    rs = [parse_der_signature(sig, low_s) if pubkey.valid else None for pubkey, sig, msg in entries]
+    ws = iter(modinv_many([s for (_, s) in filter(None, rs)], SECP256K1_ORDER))
+    failed = []
+    p = SECP256K1.p
+    for i, ((pubkey, sig, msg), r_s) in enumerate(zip(entries, rs)):
+        if r_s is None:
+            failed.append(i)
+            continue
+        r, s = r_s
+        w = next(ws)
+        z = int.from_bytes(msg, 'big')
+        x, _, z1 = verify_mul(z * w % SECP256K1_ORDER, r * w % SECP256K1_ORDER, pubkey.get_wnaf_tables(PUBKEY_WNAF_WIDTH))
+        # The affine x coordinate of R is x / z1**2
+        if z1 % p == 0 or (x - r * z1 * z1) % p:
+            failed.append(i)
+    return failed
+
+def _verify_ecdsa_chunk(entries, low_s):
+    """Worker for verify_ecdsa_batch(): verify (pubkey bytes, sig, msg) entries"""
+    pubkeys = {}
+    parsed = []
+    for data, sig, msg in entries:
+        if data not in pubkeys:
+            pubkeys[data] = ECPubKey()
+            if data is not None:
+                pubkeys[data].set(data)
+        parsed.append((pubkeys[data], sig, msg))
+    return verify_ecdsa_batch(parsed, low_s)
+
+# G as a public key, for the odd multiples verify_ecdsa() caches on it
+SECP256K1_G_PUBKEY = ECPubKey()
+SECP256K1_G_PUBKEY.p = SECP256K1_G
+SECP256K1_G_PUBKEY.valid = True
+SECP256K1_G_PUBKEY.compressed = True
+
+# Whether ECKey signs with RFC6979 nonces by default, see use_rfc6979()
+RFC6979_DEFAULT = False
+# Signatures made with RFC6979 nonces, by (secret, msg, low_s), least recently
+# used first
+SIGNATURE_CACHE_SIZE = 1 << 16
+signature_cache = OrderedDict()
+
+def use_rfc6979(enabled=True):
+    """Make ECKey sign with deterministic RFC6979 nonces unless told otherwise.
+
+    Signatures then only depend on the key and the message, so test runs are
+    reproducible and signing the same message again is a lookup in
+    signature_cache. Tests relying on distinct signatures for the same
+    operation need the default random nonces."""
+    global RFC6979_DEFAULT
+    RFC6979_DEFAULT = enabled
+
+def rfc6979_nonce(secret, msg):
+    """Compute the RFC6979 nonce for signing the hash msg with the integer secret, using HMAC-SHA256.
+
+    See https://tools.ietf.org/html/rfc6979#section-3.2"""
+    z = int.from_bytes(msg, 'big')
+    if len(msg) * 8 > 256:
+        z >>= len(msg) * 8 - 256
+    data = secret.to_bytes(32, 'big') + (z % SECP256K1_ORDER).to_bytes(32, 'big')
+    k = b'\x00' * 32
+    v = b'\x01' * 32
+    k = hmac.new(k, v + b'\x00' + data, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    k = hmac.new(k, v + b'\x01' + data, hashlib.sha256).digest()
+    v = hmac.new(k, v, hashlib.sha256).digest()
+    while True:
+        v = hmac.new(k, v, hashlib.sha256).digest()
+        nonce = int.from_bytes(v, 'big')
+        if 1 <= nonce < SECP256K1_ORDER:
+            return nonce
+        k = hmac.new(k, v + b'\x00', hashlib.sha256).digest()
+        v = hmac.new(k, v, hashlib.sha256).digest()
+
 class ECKey():
     """A secp256k1 private key"""
 
@@ -358,29 +775,206 @@ class ECKey():
         """Compute an ECPubKey object for this secret key."""
         assert(self.valid)
         ret = ECPubKey()
-        p = SECP256K1.mul([(SECP256K1_G, self.secret)])
+        p = SECP256K1_G_TABLE.mul(self.secret)
         ret.p = p
         ret.valid = True
         ret.compressed = self.compressed
         return ret
 
-    def sign_ecdsa(self, msg, low_s=True):
+    @staticmethod
+    def get_pubkeys(secrets, compressed=True):
+        """Compute the ECPubKey objects for many 32-byte secrets, sharing one inversion for all of them."""
+        points = []
+        for secret in secrets:
+            key = ECKey()
+            key.set(secret, compressed)
+            assert(key.valid)
+            points.append(SECP256K1_G_TABLE.mul(key.secret))
+        ret = []
+        for p in SECP256K1.affine_many(points):
+            pubkey = ECPubKey()
+            pubkey.p = p
+            pubkey.valid = True
+            pubkey.compressed = compressed
+            ret.append(pubkey)
+        return ret
+
+    def sign_ecdsa(self, msg, low_s=True, rfc6979=None):
         """Construct a DER-encoded ECDSA signature with this key.
 
+        The nonce is random, or derived from the key and msg as in RFC6979
+        if rfc6979 is true (by default, if use_rfc6979() was called).
+
         See https://en.wikipedia.org/wiki/Elliptic_Curve_Digital_Signature_Algorithm for the
         ECDSA signer algorithm."""
+        return self.sign_many([msg], low_s, rfc6979)[0]
+
+    def sign_many(self, msgs, low_s=True, rfc6979=None):
+        """Construct DER-encoded ECDSA signatures of many messages with this key.
+
+        The same as calling sign_ecdsa() on each in turn (the nonces are drawn
+        in the same order), but the nonce points are converted to affine form
+        and the nonces inverted with one modular inversion for each."""
         assert(self.valid)
-        z = int.from_bytes(msg, 'big')
-        # Note: no RFC6979, but a simple random nonce (some tests rely on distinct transactions for the same operation)
-        k = random.randrange(1, SECP256K1_ORDER)
-        R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, k)]))
-        r = R[0] % SECP256K1_ORDER
-        s = (modinv(k, SECP256K1_ORDER) * (z + self.secret * r)) % SECP256K1_ORDER
-        if low_s and s > SECP256K1_ORDER_HALF:
-            s = SECP256K1_ORDER - s
-        # Represent in DER format. The byte representations of r and s have
-        # length rounded up (255 bits becomes 32 bytes and 256 bits becomes 33
-        # bytes).
-        rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
-        sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
-        return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
+        if rfc6979 is None:
+            rfc6979 = RFC6979_DEFAULT
+        if not rfc6979:
+            # Note: a simple random nonce (some tests rely on distinct transactions for the same operation)
+            return self._sign_many(msgs, [random.randrange(1, SECP256K1_ORDER) for _ in msgs], low_s)
+        keys = [(self.secret, bytes(msg), low_s) for msg in msgs]
+        missing = [i for i, key in enumerate(keys) if key not in signature_cache]
+        new_sigs = self._sign_many([msgs[i] for i in missing], [rfc6979_nonce(self.secret, keys[i][1]) for i in missing], low_s)
+        for i, sig in zip(missing, new_sigs):
+            signature_cache[keys[i]] = sig
+        sigs = []
+        for key in keys:
+            signature_cache.move_to_end(key)
+            sigs.append(signature_cache[key])
+        while len(signature_cache) > SIGNATURE_CACHE_SIZE:
+            signature_cache.popitem(last=False)
+        return sigs
+
+    def _sign_many(self, msgs, ks, low_s):
+        Rs = SECP256K1.affine_many([SECP256K1_G_TABLE.mul(k) for k in ks])
+        k_invs = modinv_many(ks, SECP256K1_ORDER)
+        sigs = []
+        for msg, R, k_inv in zip(msgs, Rs, k_invs):
+            z = int.from_bytes(msg, 'big')
+            r = R[0] % SECP256K1_ORDER
+            s = (k_inv * (z + self.secret * r)) % SECP256K1_ORDER
+            if low_s and s > SECP256K1_ORDER_HALF:
+                s = SECP256K1_ORDER - s
+            # Represent in DER format. The byte representations of r and s have
+            # length rounded up (255 bits becomes 32 bytes and 256 bits becomes 33
+            # bytes).
+            rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
+            sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
+            sigs.append(b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb)
+        return sigs
+
+
+class TestFrameworkKey(unittest.TestCase):
+    def test_fixed_base_table_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "table")
+            built = FixedBaseTable(SECP256K1, SECP256K1_G, window=4, bits=64, cache_path=path)
+            table = built.get_table()
+            for n in (1, 15, 16, 0xdeadbeef, 2**64 - 1):
+                self.assertEqual(SECP256K1.affine(built.mul(n)), SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, n)])))
+            self.assertEqual(FixedBaseTable(SECP256K1, SECP256K1_G, window=4, bits=64, cache_path=path)._load(), table)
+
+            # A different base point, or any damaged byte, makes the table
+            # get rebuilt.
+            other = FixedBaseTable(SECP256K1, table[0][1], window=4, bits=64, cache_path=path)
+            self.assertIsNone(other._load())
+            with open(path, 'rb') as f:
+                data = f.read()
+            for k in (64 * 17 + 5, len(data) - 40, len(data) - 1):
+                with open(path, 'wb') as f:
+                    f.write(data[:k] + bytes([data[k] ^ 1]) + data[k + 1:])
+                reloaded = FixedBaseTable(SECP256K1, SECP256K1_G, window=4, bits=64, cache_path=path)
+                self.assertIsNone(reloaded._load())
+                self.assertEqual(reloaded.get_table(), table)
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), data)
+
+    def test_verify_ecdsa_batch(self):
+        def der(r, s):
+            rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
+            sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
+            return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + rb + bytes([2, len(sb)]) + sb
+
+        keys = []
+        for compressed in (True, False, True):
+            key = ECKey()
+            key.generate(compressed)
+            keys.append(key)
+        bad_pubkey = ECPubKey()
+        bad_pubkey.set(b'\x02' + bytes(32))
+        self.assertFalse(bad_pubkey.is_valid)
+        entries = []
+        for i in range(40):
+            key = keys[i % len(keys)]
+            msg = hashlib.sha256(bytes([i])).digest()
+            sig = key.sign_ecdsa(msg)
+            r, s = parse_der_signature(sig)
+            pubkey = key.get_pubkey()
+            if i % 5 == 1:
+                sig = der(r, SECP256K1_ORDER - s)
+            elif i % 5 == 2:
+                msg = hashlib.sha256(msg).digest()
+            elif i % 5 == 3:
+                pubkey = keys[(i + 1) % len(keys)].get_pubkey()
+            elif i == 4:
+                pubkey = bad_pubkey
+            elif i == 9:
+                sig = sig[:-1]
+            entries.append((pubkey, sig, msg))
+
+        for low_s in (True, False):
+            expected = [i for i, (pubkey, sig, msg) in enumerate(entries)
+                        if not pubkey.is_valid or not pubkey.verify_ecdsa(sig, msg, low_s)]
+            # High-S signatures only fail when low_s is required
+            self.assertEqual(1 in expected, low_s)
+            self.assertIn(2, expected)
+            self.assertIn(4, expected)
+            self.assertNotIn(0, expected)
+            self.assertEqual(verify_ecdsa_batch(entries, low_s), expected)
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                self.assertEqual(verify_ecdsa_batch(entries, low_s, executor, chunk_size=7), expected)
+
+    def test_get_pubkeys_sign_many(self):
+        secrets = [(1).to_bytes(32, 'big'), (SECP256K1_ORDER - 1).to_bytes(32, 'big')]
+        secrets += [random.randrange(1, SECP256K1_ORDER).to_bytes(32, 'big') for _ in range(8)]
+        for compressed in (True, False):
+            pubkeys = ECKey.get_pubkeys(secrets, compressed)
+            self.assertEqual(len(pubkeys), len(secrets))
+            for secret, pubkey in zip(secrets, pubkeys):
+                key = ECKey()
+                key.set(secret, compressed)
+                self.assertEqual(pubkey.get_bytes(), key.get_pubkey().get_bytes())
+
+        key = ECKey()
+        key.generate()
+        pubkey = key.get_pubkey()
+        msgs = [hashlib.sha256(bytes([i])).digest() for i in range(10)]
+        for rfc6979 in (False, True):
+            for low_s in (True, False):
+                sigs = key.sign_many(msgs, low_s, rfc6979)
+                self.assertEqual(len(sigs), len(msgs))
+                for sig, msg in zip(sigs, msgs):
+                    self.assertTrue(pubkey.verify_ecdsa(sig, msg, low_s))
+                    self.assertFalse(pubkey.verify_ecdsa(sig, hashlib.sha256(msg).digest(), low_s))
+
+    def test_rfc6979(self):
+        # secp256k1 with SHA256 message hashes, from the vectors used by
+        # python-ecdsa and Trezor: (secret, message, nonce, r, s)
+        vectors = [
+            (1, b"Satoshi Nakamoto",
+             0x8f8a276c19f4149656b280621e358cce24f5f52542772691ee69063b74f15d15,
+             0x934b1ea10a4b3c1757e2b0c017d0b6143ce3c9a7e6a4a49860d7a6ab210ee3d8,
+             0x2442ce9d2b916064108014783e923ec36b49743e2ffa1c4496f01a512aafd9e5),
+            (1, b"All those moments will be lost in time, like tears in rain. Time to die...",
+             0x38aa22d72376b4dbc472e06c3ba403ee0a394da63fc58d88686c611aba98d6b3,
+             0x8600dbd41e348fe5c9465ab92d23e3db8b98b873beecd930736488696438cb6b,
+             0x547fe64427496db33bf66019dacbf0039c04199abb0122918601db38a72cfc21),
+            (0xf8b8af8ce3c7cca5e300d33939540c10d45ce001b8f252bfbc57ba0342904181, b"Alan Turing",
+             0x525a82b70e67874398067543fd84c83d30c175fdc45fdeee082fe13b1d7cfdf1,
+             0x7063ae83e7f62bbb171798131b4a0564b956930092b33b07b395615d9ec7e15c,
+             0x58dfcc1e00a35e1572f366ffe34ba0fc47db1e7189759b9fb233c5b05ab388ea),
+        ]
+        for secret, message, nonce, r, s in vectors:
+            msg = hashlib.sha256(message).digest()
+            self.assertEqual(rfc6979_nonce(secret, msg), nonce)
+            key = ECKey()
+            key.set(secret.to_bytes(32, 'big'), True)
+            signature_cache.pop((secret, msg, True), None)
+            sig = key.sign_ecdsa(msg, rfc6979=True)
+            self.assertEqual(parse_der_signature(sig), (r, s))
+
+            # Signing again is a cache hit, with the same result as signing
+            # without the cache.
+            self.assertIn((secret, msg, True), signature_cache)
+            self.assertEqual(key.sign_ecdsa(msg, rfc6979=True), sig)
+            self.assertEqual(key._sign_many([msg], [nonce], True), [sig])
+            self.assertEqual(key.sign_many([msg, msg], rfc6979=True), [sig, sig])
@@ -15,17 +15,27 @@ msg_block, msg_tx, msg_headers, etc.:
 
 ser_*, deser_*: functions that handle serialization/deserialization.
 
+codec: class decorator generating serialize()/deserialize() methods from a
+    declarative field schema.
+
 Classes use __slots__ to ensure extraneous attributes aren't accidentally added
 by tests, compromising their intended effect.
 """
+import array
 from codecs import encode
+import collections
 import copy
+import functools
 import hashlib
-from io import BytesIO
+import itertools
+import multiprocessing
+import pickle
 import random
 import socket
 import struct
 import time
+import unittest
+import weakref
 
 import litecoin_scrypt
 from test_framework.siphash import siphash256
@@ -38,6 +48,7 @@ MY_RELAY = 1 # from version 70001 onwards, fRelay should be appended to version
 
 MAX_LOCATOR_SZ = 101
 MAX_BLOCK_BASE_SIZE = 1000000
+WITNESS_SCALE_FACTOR = 4
 
 COIN = 100000000  # 1 btc in satoshis
 
@@ -74,36 +85,29 @@ def ser_compact_size(l):
     return r
 
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
-    if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
-    elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
-    elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
-    return nit
+    if isinstance(f, BufferReader):
+        return f.read_compact_size()
+    return _stream_read(f, BufferReader.read_compact_size)
 
 def deser_string(f):
-    nit = deser_compact_size(f)
-    return f.read(nit)
+    if isinstance(f, BufferReader):
+        return f.read_string()
+    return _stream_read(f, BufferReader.read_string)
 
 def ser_string(s):
     return ser_compact_size(len(s)) + s
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    if isinstance(f, BufferReader):
+        return f.read_uint256()
+    return _stream_read(f, BufferReader.read_uint256)
+
+
+_uint256_mask = (1 << 256) - 1
 
 
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    return (u & _uint256_mask).to_bytes(32, 'little')
 
 
 def uint256_from_str(s):
@@ -114,6 +118,18 @@ def uint256_from_str(s):
     return r
 
 
+# Number of scrypt PoW hashes computed so far, by what needed them: "solve",
+# "is_valid", "access" (reading CBlockHeader.scrypt256) or "batch"
+# (BlockHeaderBatch.scrypt256()). Tests can clear() it and check how many
+# they caused.
+scrypt_evaluations = collections.Counter()
+
+
+def scrypt_pow_hash(s, reason="access"):
+    scrypt_evaluations[reason] += 1
+    return litecoin_scrypt.getPoWHash(s)
+
+
 def uint256_from_compact(c):
     nbytes = (c >> 24) & 0xFF
     v = (c & 0xFFFFFF) << (8 * (nbytes - 3))
@@ -121,63 +137,510 @@ def uint256_from_compact(c):
 
 
 def deser_vector(f, c):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = c()
-        t.deserialize(f)
-        r.append(t)
-    return r
+    if isinstance(f, BufferReader):
+        return f.read_vector(c)
+    return _stream_read(f, BufferReader.read_vector, c)
 
 
 # ser_function_name: Allow for an alternate serialization function on the
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+    r = [ser_compact_size(len(l))]
+    if ser_function_name:
+        r.extend(getattr(i, ser_function_name)() for i in l)
+    else:
+        r.extend(i.serialize() for i in l)
+    return b"".join(r)
+
+
+def _write(buf, offset, data):
+    """Copy data into buf (a bytearray or writable memoryview) at offset,
+    returning the offset just past it."""
+    end = offset + len(data)
+    buf[offset:end] = data
+    return end
+
+
+def _overrides(obj, cls, name):
+    """Whether the class of obj replaces method name of cls, as tests do to
+    send malformed data; the faster paths then defer to the override."""
+    return getattr(type(obj), name) is not getattr(cls, name)
 
 
 def deser_uint256_vector(f):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    if isinstance(f, BufferReader):
+        return f.read_uint256_vector()
+    return _stream_read(f, BufferReader.read_uint256_vector)
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
-    for i in l:
-        r += ser_uint256(i)
-    return r
+    r = [ser_compact_size(len(l))]
+    r.extend(ser_uint256(i) for i in l)
+    return b"".join(r)
 
 
 def deser_string_vector(f):
-    nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = deser_string(f)
-        r.append(t)
-    return r
+    if isinstance(f, BufferReader):
+        return f.read_string_vector()
+    return _stream_read(f, BufferReader.read_string_vector)
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    r = [ser_compact_size(len(l))]
     for sv in l:
-        r += ser_string(sv)
-    return r
+        r.append(ser_compact_size(len(sv)))
+        r.append(sv)
+    return b"".join(r)
+
+
+# Precompiled structs for the fixed-width fields read by BufferReader
+_int8 = struct.Struct("<b")
+_uint8 = struct.Struct("<B")
+_uint16 = struct.Struct("<H")
+_int32 = struct.Struct("<i")
+_uint32 = struct.Struct("<I")
+_int64 = struct.Struct("<q")
+_uint64 = struct.Struct("<Q")
+_bool = struct.Struct("<?")
+_uint48 = struct.Struct("<IH")
+_uint16_be = struct.Struct(">H")
+
+
+class BufferReader:
+    """Offset-based reader over a memoryview of serialized data.
+
+    Fields are decoded in place with struct.unpack_from instead of slicing a
+    new bytes object out of a stream for every field. read() and tell()
+    behave like their BytesIO counterparts, so a BufferReader can be passed
+    to anything that expects a stream."""
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, data, pos=0):
+        self.buf = memoryview(data)
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        pos = self.pos
+        r = bytes(self.buf[pos:] if n < 0 else self.buf[pos:pos + n])
+        self.pos = pos + len(r)
+        return r
+
+    def unpack(self, s):
+        """Unpack the precompiled struct.Struct s at the current position."""
+        r = s.unpack_from(self.buf, self.pos)
+        self.pos += s.size
+        return r
+
+    def peek(self, n):
+        """Return a view of up to n bytes at the current position."""
+        return self.buf[self.pos:self.pos + n]
+
+    def read_compact_size(self):
+        buf = self.buf
+        pos = self.pos
+        nit = buf[pos]
+        if nit < 253:
+            self.pos = pos + 1
+        elif nit == 253:
+            nit = _uint16.unpack_from(buf, pos + 1)[0]
+            self.pos = pos + 3
+        elif nit == 254:
+            nit = _uint32.unpack_from(buf, pos + 1)[0]
+            self.pos = pos + 5
+        else:
+            nit = _uint64.unpack_from(buf, pos + 1)[0]
+            self.pos = pos + 9
+        return nit
+
+    def read_string(self):
+        n = self.read_compact_size()
+        pos = self.pos
+        r = bytes(self.buf[pos:pos + n])
+        self.pos = pos + len(r)
+        return r
+
+    def read_uint256(self):
+        pos = self.pos
+        end = pos + 32
+        if end > len(self.buf):
+            raise struct.error("unpack requires a buffer of 32 bytes")
+        self.pos = end
+        return int.from_bytes(self.buf[pos:end], 'little')
+
+    def read_vector(self, c):
+        # Call the undecorated method directly; we already are a reader.
+        deserialize = getattr(c.deserialize, "__wrapped__", c.deserialize)
+        r = []
+        for i in range(self.read_compact_size()):
+            t = c()
+            deserialize(t, self)
+            r.append(t)
+        return r
+
+    def read_uint256_vector(self):
+        return [self.read_uint256() for i in range(self.read_compact_size())]
+
+    def read_string_vector(self):
+        return [self.read_string() for i in range(self.read_compact_size())]
+
+
+def _stream_read(f, read, *args):
+    """Run read(reader, *args) over the rest of stream f, then advance f past
+    the bytes that were consumed."""
+    start = f.tell()
+    r = BufferReader(f.read())
+    try:
+        return read(r, *args)
+    finally:
+        f.seek(start + r.pos)
+
+
+def deserializer(func):
+    """Decorator for deserialize() methods written against a BufferReader.
+
+    Nested calls hand the reader straight through; any other stream (eg a
+    BytesIO) is wrapped in a BufferReader first."""
+    @functools.wraps(func)
+    def deserialize(self, f, *args, **kwargs):
+        if isinstance(f, BufferReader):
+            return func(self, f, *args, **kwargs)
+        return _stream_read(f, lambda r: func(self, r, *args, **kwargs))
+    return deserialize
+
+
+# Sets an attribute without going through Tracked.__setattr__
+_set = object.__setattr__
+
+
+class Tracked:
+    """Base class for objects that cache data derived from their fields.
+
+    Assigning to an attribute named in _fields, of the object or of any
+    object inside it, resets the _cache slots of the object and of every
+    object containing it, so cached serializations and hashes never go
+    stale. Lists can't report changes made to them in place, so the lists
+    in _lists fields are left as they are (a list the caller keeps a
+    reference to stays the one in the field) and their contents are
+    compared with what they were before a cached value is used instead
+    (see _check()).
+
+    Tracking only starts once an object caches something, or something
+    containing it does (_track()). The object then switches to a subclass
+    of its class that watches assignments. Until then assignments are as
+    cheap as on any other object, so freshly built or deserialized objects
+    pay nothing for tracking."""
+    __slots__ = ("_contents", "_owners", "__weakref__")
+    # Names of the attributes holding serialized data, of those of them
+    # holding lists, and of the slots caching data derived from them
+    _fields = frozenset()
+    _lists = ()
+    _cache = ()
+    # Fields holding Tracked objects or lists of them, and those of them
+    # with lists inside the objects
+    _children = ()
+    _nested = ()
+    # Names of other attributes that copies and pickles keep
+    _state = ()
+    _tracking = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if "_tracking" not in cls.__dict__:
+            cls._untracked = cls
+            cls._tracked = type(cls.__name__, (_Watched, cls), {
+                "__slots__": (),
+                "__module__": cls.__module__,
+                "__qualname__": cls.__qualname__,
+                "_tracking": True,
+            })
+
+    def __getstate__(self):
+        # Caches aren't copied; the copy recomputes them on demand.
+        state = {name: getattr(self, name) for name in itertools.chain(self._fields, self._state)
+                 if hasattr(self, name)}
+        if hasattr(self, "__dict__"):
+            state.update(self.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles start out untracked.
+        return object.__new__, (self._untracked,), self.__getstate__()
+
+    def _track(self, owner=None):
+        """Make changes to our fields, and to the objects in them, reach us,
+        and ours reach the object owner is a weak reference to."""
+        if self._tracking:
+            if owner is not None:
+                self._add_owner(owner)
+            return
+        _set(self, "_owners", () if owner is None else owner)
+        self.__class__ = self._tracked
+        if self._children:
+            ref = weakref.ref(self)
+            for name in self._children:
+                value = getattr(self, name)
+                if type(value) is list:
+                    for x in value:
+                        if isinstance(x, Tracked):
+                            x._track(ref)
+                elif isinstance(value, Tracked):
+                    value._track(ref)
+        if self._lists:
+            _set(self, "_contents", self._list_contents())
+
+    def _link(self, value):
+        """Make changes to value, or to the objects in it if it is a list, reach us."""
+        ref = weakref.ref(self)
+        for x in (value if type(value) is list else (value,)):
+            if isinstance(x, Tracked):
+                x._track(ref)
+
+    def _list_contents(self):
+        return tuple([tuple(getattr(self, name)) for name in self._lists])
+
+    def _check(self, nested=True):
+        """Notice changes made in place to the lists in our fields (and, if
+        nested, to those in the objects in our _nested fields) since they
+        were last looked at, dropping the affected caches."""
+        if self._lists:
+            contents = self._list_contents()
+            if contents != self._contents:
+                _set(self, "_contents", contents)
+                for name in self._lists:
+                    self._link(getattr(self, name))
+                self._invalidate()
+        if nested:
+            for name in self._nested:
+                value = getattr(self, name)
+                for x in (value if isinstance(value, list) else (value,)):
+                    if isinstance(x, Tracked) and x._tracking:
+                        x._check()
+
+    def _cached(self, name, nested=True):
+        """Return the value cached in slot name, or None."""
+        if not self._tracking:
+            return None
+        if self._lists or nested and self._nested:
+            self._check(nested)
+        return getattr(self, name, None)
+
+    def _store(self, name, value):
+        """Cache value in slot name, and return it."""
+        self._track()
+        _set(self, name, value)
+        return value
+
+    def _add_owner(self, ref):
+        owners = self._owners
+        if owners == () or owners is ref:
+            _set(self, "_owners", ref)
+        elif type(owners) is list:
+            if ref not in owners:
+                owners[:] = [r for r in owners if r() is not None]
+                owners.append(ref)
+        else:
+            _set(self, "_owners", [owners, ref])
+
+    def _invalidate(self):
+        for name in self._cache:
+            _set(self, name, None)
+        owners = self._owners
+        if type(owners) is not list:
+            if owners == ():
+                return
+            owners = (owners,)
+        for ref in owners:
+            owner = ref()
+            if owner is not None:
+                owner._invalidate()
+
+
+class _Watched:
+    """Mixin for the classes that Tracked objects switch to once tracked."""
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        _set(self, name, value)
+        if name in self._fields:
+            if name in self._children:
+                self._link(value)
+            if name in self._lists:
+                _set(self, "_contents", self._list_contents())
+            self._invalidate()
+
+
+# Field types that can be serialized by a struct format code
+_fixed_formats = {
+    "int8": "b", "uint8": "B", "bool": "?", "int16": "h", "uint16": "H",
+    "int32": "i", "uint32": "I", "int64": "q", "uint64": "Q", "uint256": "32s",
+}
+
+
+def codec(*schema, serialize="serialize", deserialize="deserialize", cache=None):
+    """Class decorator adding serialize()/deserialize() methods from a schema.
+
+    Each entry of schema is a "<type> <name>" string, in wire order. type is
+    one of int8, uint8, bool, int16, uint16, int32, uint32, int64, uint64,
+    uint256, compact (a CompactSize), string, vector<T> with T uint256,
+    string or a class name, or the name of a class with its own codec.
+    Runs of fixed-width fields are packed and unpacked with one struct.Struct
+    computed here, and variable-length parts are joined once at the end.
+
+    serialize and deserialize are the names to add the methods under, or
+    None to keep a hand-written one. If cache names a slot (see Tracked),
+    the serialization is kept there until the object changes. The added
+    deserialize() calls self._loaded() at the end if the class has one."""
+    def decorate(cls):
+        writers = []
+        readers = []
+        fixed = []
+        for entry in schema + ("",):
+            fields = entry.split()
+            if fields and fields[0] in _fixed_formats:
+                fixed.append(fields)
+                continue
+            if fixed:
+                writer, reader = _fixed_field_codec(fixed)
+                writers.append(writer)
+                readers.append(reader)
+                fixed = []
+            if fields:
+                writer, reader = _field_codec(fields[0], fields[1])
+                writers.append(writer)
+                readers.append(reader)
+
+        if serialize is not None:
+            if cache is None:
+                def serialize_fields(self):
+                    return b"".join([write(self) for write in writers])
+            else:
+                # Only the lists inside the fields serialized here matter
+                nested = any(entry.split()[1] in cls._nested for entry in schema)
+                check = bool(cls._lists) or nested
+
+                def serialize_fields(self):
+                    if self._tracking:
+                        if check:
+                            self._check(nested)
+                        r = getattr(self, cache, None)
+                        if r is not None:
+                            return r
+                    r = b"".join([write(self) for write in writers])
+                    if not self._tracking:
+                        self._track()
+                    _set(self, cache, r)
+                    return r
+            _add_method(cls, serialize, serialize_fields)
+
+        if deserialize is not None:
+            loaded = hasattr(cls, "_loaded")
+
+            def deserialize_fields(self, f):
+                for read in readers:
+                    read(self, f)
+                if loaded:
+                    self._loaded()
+            _add_method(cls, deserialize, deserializer(deserialize_fields))
+        return cls
+    return decorate
+
+
+def _fixed_field_codec(fields):
+    """Return (writer, reader) functions for a run of fixed-width fields."""
+    s = struct.Struct("<" + "".join(_fixed_formats[type_] for type_, _ in fields))
+    size = s.size
+    names = [name for _, name in fields]
+    hashes = [i for i, (type_, _) in enumerate(fields) if type_ == "uint256"]
+
+    if hashes:
+        def write(obj):
+            values = [getattr(obj, name) for name in names]
+            for i in hashes:
+                values[i] = (values[i] & _uint256_mask).to_bytes(32, 'little')
+            return s.pack(*values)
+
+        def read(obj, f):
+            values = list(f.unpack(s))
+            for i in hashes:
+                values[i] = int.from_bytes(values[i], 'little')
+            for name, value in zip(names, values):
+                setattr(obj, name, value)
+    elif len(names) == 1:
+        # The common case of a single integer, eg nSequence
+        name = names[0]
+
+        def write(obj):
+            return s.pack(getattr(obj, name))
+
+        def read(obj, f):
+            pos = f.pos
+            value = s.unpack_from(f.buf, pos)[0]
+            f.pos = pos + size
+            setattr(obj, name, value)
+    else:
+        def write(obj):
+            return s.pack(*[getattr(obj, name) for name in names])
+
+        def read(obj, f):
+            for name, value in zip(names, f.unpack(s)):
+                setattr(obj, name, value)
+    return write, read
+
+
+def _field_codec(type_, name):
+    """Return (writer, reader) functions for a variable-length field."""
+    if type_ == "compact":
+        ser, deser = ser_compact_size, BufferReader.read_compact_size
+    elif type_ == "string":
+        ser, deser = ser_string, BufferReader.read_string
+    elif type_ == "vector<uint256>":
+        ser, deser = ser_uint256_vector, BufferReader.read_uint256_vector
+    elif type_ == "vector<string>":
+        ser, deser = ser_string_vector, BufferReader.read_string_vector
+    elif type_.startswith("vector<"):
+        elem = globals()[type_[7:-1]]
+        ser = ser_vector
+
+        def deser(f):
+            return f.read_vector(elem)
+    else:
+        obj_type = globals()[type_]
+        # Call the undecorated method directly; f already is a reader.
+        deserialize = getattr(obj_type.deserialize, "__wrapped__", obj_type.deserialize)
+
+        def ser(value):
+            return value.serialize()
+
+        def deser(f):
+            value = obj_type()
+            deserialize(value, f)
+            return value
+
+    def write(obj):
+        return ser(getattr(obj, name))
+
+    def read(obj, f):
+        setattr(obj, name, deser(f))
+    return write, read
+
+
+def _add_method(cls, name, func):
+    func.__name__ = name
+    func.__qualname__ = "%s.%s" % (cls.__qualname__, name)
+    setattr(cls, name, func)
 
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(BufferReader(hex_str_to_bytes(hex_string)))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
@@ -197,13 +660,14 @@ class CAddress:
         self.ip = "0.0.0.0"
         self.port = 0
 
+    @deserializer
     def deserialize(self, f, with_time=True):
         if with_time:
-            self.time = struct.unpack("<i", f.read(4))[0]
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
+            self.time = f.unpack(_int32)[0]
+        self.nServices = f.unpack(_uint64)[0]
         self.pchReserved = f.read(12)
         self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.port = f.unpack(_uint16_be)[0]
 
     def serialize(self, with_time=True):
         r = b""
@@ -220,6 +684,7 @@ class CAddress:
                                                          self.ip, self.port)
 
 
+@codec("int32 type", "uint256 hash")
 class CInv:
     __slots__ = ("hash", "type")
 
@@ -236,21 +701,12 @@ class CInv:
         self.type = t
         self.hash = h
 
-    def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
-        self.hash = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.type)
-        r += ser_uint256(self.hash)
-        return r
-
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
             % (self.typemap[self.type], self.hash)
 
 
+@codec("int32 nVersion", "vector<uint256> vHave")
 class CBlockLocator:
     __slots__ = ("nVersion", "vHave")
 
@@ -258,44 +714,31 @@ class CBlockLocator:
         self.nVersion = MY_VERSION
         self.vHave = []
 
-    def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.vHave = deser_uint256_vector(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256_vector(self.vHave)
-        return r
-
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%s)" \
             % (self.nVersion, repr(self.vHave))
 
 
-class COutPoint:
-    __slots__ = ("hash", "n")
+@codec("uint256 hash", "uint32 n", cache="_ser")
+class COutPoint(Tracked):
+    __slots__ = ("hash", "n", "_ser")
+    _fields = frozenset(("hash", "n"))
+    _cache = ("_ser",)
 
     def __init__(self, hash=0, n=0):
         self.hash = hash
         self.n = n
 
-    def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
-
-    def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
-
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
-class CTxIn:
-    __slots__ = ("nSequence", "prevout", "scriptSig")
+@codec("COutPoint prevout", "string scriptSig", "uint32 nSequence", cache="_ser")
+class CTxIn(Tracked):
+    __slots__ = ("nSequence", "prevout", "scriptSig", "_ser")
+    _fields = frozenset(("nSequence", "prevout", "scriptSig"))
+    _cache = ("_ser",)
+    _children = ("prevout",)
 
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
@@ -305,50 +748,32 @@ class CTxIn:
         self.scriptSig = scriptSig
         self.nSequence = nSequence
 
-    def deserialize(self, f):
-        self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
-
-    def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
-
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
             % (repr(self.prevout), bytes_to_hex_str(self.scriptSig),
                self.nSequence)
 
 
-class CTxOut:
-    __slots__ = ("nValue", "scriptPubKey")
+@codec("int64 nValue", "string scriptPubKey", cache="_ser")
+class CTxOut(Tracked):
+    __slots__ = ("nValue", "scriptPubKey", "_ser")
+    _fields = frozenset(("nValue", "scriptPubKey"))
+    _cache = ("_ser",)
 
     def __init__(self, nValue=0, scriptPubKey=b""):
         self.nValue = nValue
         self.scriptPubKey = scriptPubKey
 
-    def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
-
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
             % (self.nValue // COIN, self.nValue % COIN,
                bytes_to_hex_str(self.scriptPubKey))
 
 
-class CScriptWitness:
+class CScriptWitness(Tracked):
     __slots__ = ("stack",)
+    _fields = frozenset(("stack",))
+    _lists = ("stack",)
 
     def __init__(self):
         # stack is a vector of strings
@@ -364,17 +789,25 @@ class CScriptWitness:
         return True
 
 
-class CTxInWitness:
-    __slots__ = ("scriptWitness",)
+class CTxInWitness(Tracked):
+    __slots__ = ("scriptWitness", "_ser")
+    _fields = frozenset(("scriptWitness",))
+    _cache = ("_ser",)
+    _children = ("scriptWitness",)
+    _nested = ("scriptWitness",)
 
     def __init__(self):
         self.scriptWitness = CScriptWitness()
 
+    @deserializer
     def deserialize(self, f):
-        self.scriptWitness.stack = deser_string_vector(f)
+        self.scriptWitness.stack = f.read_string_vector()
 
     def serialize(self):
-        return ser_string_vector(self.scriptWitness.stack)
+        r = self._cached("_ser")
+        if r is None:
+            r = self._store("_ser", ser_string_vector(self.scriptWitness.stack))
+        return r
 
     def __repr__(self):
         return repr(self.scriptWitness)
@@ -383,24 +816,26 @@ class CTxInWitness:
         return self.scriptWitness.is_null()
 
 
-class CTxWitness:
+class CTxWitness(Tracked):
     __slots__ = ("vtxinwit",)
+    _fields = frozenset(("vtxinwit",))
+    _lists = ("vtxinwit",)
+    _children = ("vtxinwit",)
+    _nested = ("vtxinwit",)
 
     def __init__(self):
         self.vtxinwit = []
 
+    @deserializer
     def deserialize(self, f):
         for i in range(len(self.vtxinwit)):
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
-        for x in self.vtxinwit:
-            r += x.serialize()
-        return r
+        return b"".join([x.serialize() for x in self.vtxinwit])
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -413,9 +848,83 @@ class CTxWitness:
         return True
 
 
-class CTransaction:
+def _measure(base_size, total_size):
+    """Return (base size, total size, weight, vsize) for an object whose
+    serialization is base_size bytes without witnesses and total_size bytes
+    with them."""
+    weight = base_size * (WITNESS_SCALE_FACTOR - 1) + total_size
+    vsize = (weight + WITNESS_SCALE_FACTOR - 1) // WITNESS_SCALE_FACTOR
+    return base_size, total_size, weight, vsize
+
+
+def _skip_transaction(f):
+    """Move reader f past a transaction, reading it like
+    CTransaction.deserialize() does but without decoding anything.
+
+    Returns the positions of its start, of its inputs (after the witness
+    marker and flag, if any), of the end of its outputs and of its end."""
+    start = f.pos
+    f.pos += 4
+    io_start = f.pos
+    n_in = f.read_compact_size()
+    _skip_inputs(f, n_in)
+    flags = 0
+    if n_in == 0:
+        flags = f.unpack(_uint8)[0]
+        if flags != 0:
+            io_start = f.pos
+            n_in = f.read_compact_size()
+            _skip_inputs(f, n_in)
+            _skip_outputs(f)
+    else:
+        _skip_outputs(f)
+    io_end = f.pos
+    if flags != 0:
+        for i in range(n_in):
+            for j in range(f.read_compact_size()):
+                size = f.read_compact_size()
+                f.pos += size
+    f.pos += 4
+    if f.pos > len(f.buf):
+        raise struct.error("transaction extends past the end of the buffer")
+    return start, io_start, io_end, f.pos
+
+
+def _skip_inputs(f, n):
+    for i in range(n):
+        f.pos += 36
+        size = f.read_compact_size()
+        f.pos += size + 4
+
+
+def _skip_outputs(f):
+    for i in range(f.read_compact_size()):
+        f.pos += 8
+        size = f.read_compact_size()
+        f.pos += size
+
+
+@codec("int32 nVersion", "vector<CTxIn> vin", "vector<CTxOut> vout", "uint32 nLockTime",
+       serialize="serialize_without_witness", deserialize=None,
+       cache="_ser_without_witness")
+class CTransaction(Tracked):
+    """A transaction.
+
+    The serializations with and without witness, the txid/wtxid hashes and
+    the sizes (base_size, total_size, weight, vsize) are cached, and dropped
+    whenever the transaction (or any input, output or witness inside it) is
+    modified. sha256 and hash are set by calc_sha256()/rehash() as before
+    and are not updated automatically."""
     __slots__ = ("hash", "nLockTime", "nVersion", "sha256", "vin", "vout",
-                 "wit")
+                 "wit", "_ser_with_witness", "_ser_without_witness", "_sizes",
+                 "_txid", "_wtxid")
+    _fields = frozenset(("nLockTime", "nVersion", "vin", "vout", "wit"))
+    _lists = ("vin", "vout")
+    _cache = ("_ser_with_witness", "_ser_without_witness", "_sizes", "_txid",
+              "_wtxid")
+    _children = ("vin", "vout", "wit")
+    _nested = ("wit",)
+    _state = ("hash", "sha256")
 
     def __init__(self, tx=None):
         if tx is None:
@@ -435,80 +944,138 @@ class CTransaction:
             self.hash = tx.hash
             self.wit = copy.deepcopy(tx.wit)
 
+    @deserializer
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.vin = deser_vector(f, CTxIn)
+        self.nVersion = f.unpack(_int32)[0]
+        self.vin = f.read_vector(CTxIn)
         flags = 0
         if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+            flags = f.unpack(_uint8)[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
-                self.vin = deser_vector(f, CTxIn)
-                self.vout = deser_vector(f, CTxOut)
+                self.vin = f.read_vector(CTxIn)
+                self.vout = f.read_vector(CTxOut)
         else:
-            self.vout = deser_vector(f, CTxOut)
+            self.vout = f.read_vector(CTxOut)
         if flags != 0:
             self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
             self.wit.deserialize(f)
         else:
             self.wit = CTxWitness()
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.nLockTime = f.unpack(_uint32)[0]
         self.sha256 = None
         self.hash = None
 
-    def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
-
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        r = self._cached("_ser_with_witness")
+        if r is None:
+            resized = len(self.wit.vtxinwit) != len(self.vin)
+            r = self._serialize_with_witness()
+            self._track()
+            # Don't cache if the witnesses were just resized to match vin:
+            # the next serialization sees them resized.
+            if not resized:
+                _set(self, "_ser_with_witness", r)
+        return r
+
+    def _serialize_with_witness(self):
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = [struct.pack("<i", self.nVersion)]
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            r.append(ser_vector(dummy))
+            r.append(struct.pack("<B", flags))
+        r.append(ser_vector(self.vin))
+        r.append(ser_vector(self.vout))
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
                 self.wit.vtxinwit = self.wit.vtxinwit[:len(self.vin)]
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
-            r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+            r.append(self.wit.serialize())
+        r.append(struct.pack("<I", self.nLockTime))
+        return b"".join(r)
 
     # Regular serialization is with witness -- must explicitly
     # call serialize_without_witness to exclude witness data.
     def serialize(self):
         return self.serialize_with_witness()
 
+    def serialized_size(self, with_witness=True):
+        """Length of the serialization, which is cached along with it."""
+        if with_witness:
+            return len(self.serialize_with_witness())
+        return len(self.serialize_without_witness())
+
+    def serialize_into(self, buf, offset=0, with_witness=True):
+        """Write the serialization into buf (a bytearray or writable
+        memoryview) at offset, returning the offset just past it."""
+        if with_witness:
+            return _write(buf, offset, self.serialize_with_witness())
+        return _write(buf, offset, self.serialize_without_witness())
+
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
         self.sha256 = None
         self.calc_sha256()
         return self.hash
 
-    # We will only cache the serialization without witness in
-    # self.sha256 and self.hash -- those are expected to be the txid.
+    # Only the txid (hash without witness) is stored in self.sha256 and
+    # self.hash. The wtxid is just returned, but is cached internally too.
     def calc_sha256(self, with_witness=False):
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
-
+            wtxid = self._cached("_wtxid")
+            if wtxid is None:
+                wtxid = hash256(self.serialize_with_witness())
+                # Not cached if serializing resized the witnesses, see
+                # serialize_with_witness()
+                if getattr(self, "_ser_with_witness", None) is not None:
+                    _set(self, "_wtxid", wtxid)
+            return uint256_from_str(wtxid)
+
+        txid = self._cached("_txid", False)
+        if txid is None:
+            txid = self._store("_txid", hash256(self.serialize_without_witness()))
         if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize_without_witness())[::-1], 'hex_codec').decode('ascii')
+            self.sha256 = uint256_from_str(txid)
+        self.hash = encode(txid[::-1], 'hex_codec').decode('ascii')
+
+    @property
+    def wtxid(self):
+        return self.calc_sha256(with_witness=True)
+
+    def _calc_sizes(self):
+        """Return (base size, total size, weight, vsize)."""
+        sizes = self._cached("_sizes")
+        if sizes is None:
+            sizes = _measure(len(self.serialize_without_witness()),
+                             len(self.serialize_with_witness()))
+            # Not cached if serializing resized the witnesses, see
+            # serialize_with_witness()
+            if getattr(self, "_ser_with_witness", None) is not None:
+                _set(self, "_sizes", sizes)
+        return sizes
+
+    @property
+    def base_size(self):
+        return self._calc_sizes()[0]
+
+    @property
+    def total_size(self):
+        return self._calc_sizes()[1]
+
+    @property
+    def weight(self):
+        return self._calc_sizes()[2]
+
+    @property
+    def vsize(self):
+        return self._calc_sizes()[3]
 
     def is_valid(self):
         self.calc_sha256()
@@ -522,9 +1089,17 @@ class CTransaction:
             % (self.nVersion, repr(self.vin), repr(self.vout), repr(self.wit), self.nLockTime)
 
 
+@codec("int32 nVersion", "uint256 hashPrevBlock", "uint256 hashMerkleRoot",
+       "uint32 nTime", "uint32 nBits", "uint32 nNonce")
 class CBlockHeader:
+    """A block header.
+
+    sha256 and hash are set by calc_sha256()/rehash(). scrypt256, the scrypt
+    PoW hash of the header as it was then, is only computed when it is first
+    read (by solve(), is_valid() or a test), as scrypt is far slower than
+    SHA256."""
     __slots__ = ("hash", "hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce",
-                 "nTime", "nVersion", "sha256", "scrypt256")
+                 "nTime", "nVersion", "sha256", "_pow_header", "_scrypt256")
 
     def __init__(self, header=None):
         if header is None:
@@ -538,7 +1113,8 @@ class CBlockHeader:
             self.nNonce = header.nNonce
             self.sha256 = header.sha256
             self.hash = header.hash
-            self.scrypt256 = header.scrypt256
+            self._pow_header = header._pow_header
+            self._scrypt256 = header._scrypt256
             self.calc_sha256()
 
     def set_null(self):
@@ -548,47 +1124,38 @@ class CBlockHeader:
         self.nTime = 0
         self.nBits = 0
         self.nNonce = 0
-        self.sha256 = None
-        self.hash = None
-        self.scrypt256 = None
+        self._loaded()
 
-    def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+    def _loaded(self):
         self.sha256 = None
         self.hash = None
-        self.scrypt256 = None
+        self._pow_header = None
+        self._scrypt256 = None
 
-    def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+    @property
+    def scrypt256(self):
+        return self._calc_scrypt256("access")
+
+    @scrypt256.setter
+    def scrypt256(self, value):
+        self._scrypt256 = value
+
+    def _calc_scrypt256(self, reason):
+        if self._scrypt256 is None and self._pow_header is not None:
+            self._scrypt256 = uint256_from_str(scrypt_pow_hash(self._pow_header, reason))
+        return self._scrypt256
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
-            self.scrypt256 = uint256_from_str(litecoin_scrypt.getPoWHash(r))
+            r = CBlockHeader.serialize(self)
+            h = hash256(r)
+            self.sha256 = uint256_from_str(h)
+            self.hash = encode(h[::-1], 'hex_codec').decode('ascii')
+            self._pow_header = r
+            self._scrypt256 = None
 
     def rehash(self):
         self.sha256 = None
-        self.scrypt256 = None
         self.calc_sha256()
         return self.sha256
 
@@ -600,25 +1167,253 @@ class CBlockHeader:
 BLOCK_HEADER_SIZE = len(CBlockHeader().serialize())
 assert_equal(BLOCK_HEADER_SIZE, 80)
 
+# Number of nonces each pool worker tries at a time in CBlock.solve()
+SOLVE_CHUNK_SIZE = 256
+
+
+def _search_nonces(prefix, target, start, count=None):
+    """Try the header made of the 76 byte prefix and each nonce from start
+    on (count of them, or until one works if count is None).
+
+    Returns (nonce, scrypt hash, attempts), with nonce and hash None if no
+    nonce gives a hash at or below target."""
+    get_pow_hash = litecoin_scrypt.getPoWHash
+    pack = _uint32.pack
+    nonces = itertools.count(start) if count is None else range(start, start + count)
+    for nonce in nonces:
+        pow_hash = int.from_bytes(get_pow_hash(prefix + pack(nonce)), 'little')
+        if pow_hash <= target:
+            return nonce, pow_hash, nonce - start + 1
+    return None, None, count
+
+
+class MerkleTree:
+    """A merkle tree that keeps all of its levels.
+
+    update() takes the full list of leaf hashes, compares it with the
+    previous one and only rehashes the nodes on the paths from the leaves
+    that changed (or were added or removed) to the root, so appending,
+    replacing or removing a transaction costs O(log n) hashes. Odd levels
+    pair their last node with itself, as in CBlock.get_merkle_root()."""
+    __slots__ = ("levels",)
+
+    def __init__(self, hashes=()):
+        self.levels = [[]]
+        if hashes:
+            self.update(hashes)
+
+    def update(self, hashes):
+        """Set the leaves to hashes and return the root as an integer."""
+        old = self.levels[0]
+        if len(hashes) == len(old) and hashes == old:
+            return self.root()
+        if not hashes:
+            # Like CBlock.get_merkle_root(), there is no root without leaves
+            raise IndexError("merkle tree without leaves")
+        dirty = {i for i, (a, b) in enumerate(zip(old, hashes)) if a != b}
+        old_size = len(old)
+        level = list(hashes)
+        self.levels[0] = level
+        depth = 0
+        while len(level) > 1:
+            size = len(level)
+            if size != old_size:
+                # The last node (which may be paired with itself) and every
+                # node after it need their parents recomputed.
+                dirty.update(range(max(min(old_size, size) - 1, 0), size))
+            depth += 1
+            if depth < len(self.levels):
+                parents = self.levels[depth]
+            else:
+                parents = []
+                self.levels.append(parents)
+            old_size = len(parents)
+            parent_size = (size + 1) // 2
+            del parents[parent_size:]
+            parents.extend([None] * (parent_size - len(parents)))
+            parent_dirty = set()
+            for i in dirty:
+                j = i >> 1
+                if j not in parent_dirty:
+                    parent_dirty.add(j)
+                    parents[j] = hash256(level[2 * j] + level[min(2 * j + 1, size - 1)])
+            dirty = parent_dirty
+            level = parents
+        del self.levels[depth + 1:]
+        return self.root()
+
+    def root(self):
+        return uint256_from_str(self.levels[-1][0])
+
+
 class CBlock(CBlockHeader):
-    __slots__ = ("vtx",)
+    """A block.
+
+    The merkle trees built by calc_merkle_root() and
+    calc_witness_merkle_root() are kept, so after transactions are added,
+    replaced or removed only the changed paths are rehashed.
+
+    base_size, total_size, weight and vsize add up the sizes cached by the
+    transactions.
+
+    deserialize(f, lazy=True) only parses the header and records where each
+    transaction starts in the raw data. get_tx() then decodes transactions
+    one at a time, the merkle roots are hashed straight from the raw data,
+    and serialize() returns the original bytes as long as nothing was
+    changed. Accessing vtx decodes all remaining transactions and turns the
+    block into a regular one."""
+    __slots__ = ("_lazy_txids", "_lazy_txs", "_merkle_tree", "_raw", "_tx_index",
+                 "_vtx", "_witness_merkle_tree")
 
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
-
-    def deserialize(self, f):
+        self._merkle_tree = MerkleTree()
+        self._witness_merkle_tree = MerkleTree()
+
+    @property
+    def vtx(self):
+        if self._raw is not None:
+            self.vtx = [self.get_tx(i) for i in range(len(self._tx_index))]
+        return self._vtx
+
+    @vtx.setter
+    def vtx(self, vtx):
+        self._vtx = vtx
+        self._raw = None
+        self._tx_index = None
+        self._lazy_txs = None
+        self._lazy_txids = None
+
+    @deserializer
+    def deserialize(self, f, lazy=False):
+        start = f.tell()
         super(CBlock, self).deserialize(f)
-        self.vtx = deser_vector(f, CTransaction)
-
-    def serialize(self, with_witness=False):
-        r = b""
-        r += super(CBlock, self).serialize()
+        if not lazy:
+            self.vtx = f.read_vector(CTransaction)
+            return
+        # (start, inputs, end of outputs, end) of each transaction
+        index = [_skip_transaction(f) for i in range(f.read_compact_size())]
+        self._vtx = None
+        self._raw = bytes(f.buf[start:f.pos])
+        self._tx_index = [tuple(pos - start for pos in entry) for entry in index]
+        self._lazy_txs = [None] * len(index)
+        self._lazy_txids = [None] * len(index)
+
+    def get_tx(self, i):
+        """Return transaction i, decoding only that one for a lazy block."""
+        if self._raw is None:
+            return self.vtx[i]
+        tx = self._lazy_txs[i]
+        if tx is None:
+            tx = CTransaction()
+            tx.deserialize(BufferReader(self._raw, self._tx_index[i][0]))
+            txid = self._lazy_txids[i]
+            if txid is not None:
+                # As if calc_merkle_root() had hashed the decoded transaction
+                tx.sha256 = uint256_from_str(txid)
+                tx.hash = encode(txid[::-1], 'hex_codec').decode('ascii')
+            self._lazy_txs[i] = tx
+        return tx
+
+    def tx_count(self):
+        if self._raw is None:
+            return len(self.vtx)
+        return len(self._tx_index)
+
+    def _raw_tx(self, i, with_witness):
+        start, io_start, io_end, end = self._tx_index[i]
+        if with_witness or (io_start == start + 4 and io_end == end - 4):
+            return self._raw[start:end]
+        raw = self._raw
+        return raw[start:start + 4] + raw[io_start:io_end] + raw[end - 4:end]
+
+    def _serialize_unchanged(self, with_witness):
+        """Serialize a lazy block from its raw data, in parts, or return None
+        if the header or a decoded transaction has changed."""
+        raw = self._raw
+        if CBlockHeader.serialize(self) != raw[:BLOCK_HEADER_SIZE]:
+            return None
+        for i, tx in enumerate(self._lazy_txs):
+            if tx is not None:
+                if with_witness:
+                    r = tx.serialize_with_witness()
+                else:
+                    r = tx.serialize_without_witness()
+                if r != self._raw_tx(i, with_witness):
+                    return None
         if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+            return [raw]
+        first = self._tx_index[0][0] if self._tx_index else len(raw)
+        return [raw[:first]] + [self._raw_tx(i, False) for i in range(len(self._tx_index))]
+
+    def _serialization_parts(self, with_witness):
+        """The pieces serialize() joins: the header, the transaction count
+        and each transaction's (cached) serialization."""
+        if self._raw is not None:
+            parts = self._serialize_unchanged(with_witness)
+            if parts is not None:
+                return parts
+        parts = [super(CBlock, self).serialize(), ser_compact_size(len(self.vtx))]
+        if with_witness:
+            parts.extend(tx.serialize_with_witness() for tx in self.vtx)
         else:
-            r += ser_vector(self.vtx, "serialize_without_witness")
-        return r
+            parts.extend(tx.serialize_without_witness() for tx in self.vtx)
+        return parts
+
+    def serialize(self, with_witness=False):
+        parts = self._serialization_parts(with_witness)
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def serialized_size(self, with_witness=False):
+        if _overrides(self, CBlock, "serialize"):
+            return len(self.serialize(with_witness))
+        return sum(map(len, self._serialization_parts(with_witness)))
+
+    def serialize_into(self, buf, offset=0, with_witness=False):
+        """Write the serialization into buf (a bytearray or writable
+        memoryview) at offset, returning the offset just past it."""
+        if _overrides(self, CBlock, "serialize"):
+            return _write(buf, offset, self.serialize(with_witness))
+        for part in self._serialization_parts(with_witness):
+            offset = _write(buf, offset, part)
+        return offset
+
+    def _calc_sizes(self):
+        """Return (base size, total size, weight, vsize), adding up the
+        cached sizes of the transactions (or, for transactions a lazy block
+        hasn't decoded, the sizes recorded in its index)."""
+        if _overrides(self, CBlock, "serialize"):
+            return _measure(len(self.serialize(False)), len(self.serialize(True)))
+        n = self.tx_count()
+        base_size = total_size = BLOCK_HEADER_SIZE + len(ser_compact_size(n))
+        for i in range(n):
+            tx = self._lazy_txs[i] if self._raw is not None else self.vtx[i]
+            if tx is None:
+                start, io_start, io_end, end = self._tx_index[i]
+                base_size += io_end - io_start + 8
+                total_size += end - start
+            else:
+                sizes = tx._calc_sizes()
+                base_size += sizes[0]
+                total_size += sizes[1]
+        return _measure(base_size, total_size)
+
+    @property
+    def base_size(self):
+        return self._calc_sizes()[0]
+
+    @property
+    def total_size(self):
+        return self._calc_sizes()[1]
+
+    @property
+    def weight(self):
+        return self._calc_sizes()[2]
+
+    @property
+    def vsize(self):
+        return self._calc_sizes()[3]
 
     # Calculate the merkle root given a vector of transaction hashes
     @classmethod
@@ -633,26 +1428,36 @@ class CBlock(CBlockHeader):
 
     def calc_merkle_root(self):
         hashes = []
-        for tx in self.vtx:
-            tx.calc_sha256()
-            hashes.append(ser_uint256(tx.sha256))
-        return self.get_merkle_root(hashes)
+        for i in range(self.tx_count()):
+            tx = self._lazy_txs[i] if self._raw is not None else self.vtx[i]
+            if tx is None:
+                txid = hash256(self._raw_tx(i, False))
+                self._lazy_txids[i] = txid
+                hashes.append(txid)
+            else:
+                tx.calc_sha256()
+                hashes.append(ser_uint256(tx.sha256))
+        return self._merkle_tree.update(hashes)
 
     def calc_witness_merkle_root(self):
         # For witness root purposes, the hash of the
         # coinbase, with witness, is defined to be 0...0
         hashes = [ser_uint256(0)]
 
-        for tx in self.vtx[1:]:
-            # Calculate the hashes with witness data
-            hashes.append(ser_uint256(tx.calc_sha256(True)))
+        for i in range(1, self.tx_count()):
+            tx = self._lazy_txs[i] if self._raw is not None else self.vtx[i]
+            if tx is None:
+                hashes.append(hash256(self._raw_tx(i, True)))
+            else:
+                # Calculate the hashes with witness data
+                hashes.append(ser_uint256(tx.calc_sha256(True)))
 
-        return self.get_merkle_root(hashes)
+        return self._witness_merkle_tree.update(hashes)
 
     def is_valid(self):
         self.calc_sha256()
         target = uint256_from_compact(self.nBits)
-        if self.scrypt256 > target:
+        if self._calc_scrypt256("is_valid") > target:
             return False
         for tx in self.vtx:
             if not tx.is_valid():
@@ -661,12 +1466,41 @@ class CBlock(CBlockHeader):
             return False
         return True
 
-    def solve(self):
+    def solve(self, processes=1):
+        """Find the first nNonce, counting up from the current one, that
+        satisfies nBits.
+
+        Only the nonce is re-encoded for each attempt. With processes > 1
+        ranges of nonces are searched by a multiprocessing pool, which pays
+        off at difficulties needing many attempts; the nonce found is the
+        same either way."""
         self.rehash()
         target = uint256_from_compact(self.nBits)
-        while self.scrypt256 > target:
-            self.nNonce += 1
-            self.rehash()
+        if self._calc_scrypt256("solve") <= target:
+            return
+        prefix = self._pow_header[:76]
+        start = self.nNonce + 1
+        if processes == 1:
+            nonce, pow_hash, attempts = _search_nonces(prefix, target, start)
+            scrypt_evaluations["solve"] += attempts
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                while True:
+                    chunks = [(prefix, target, start + i * SOLVE_CHUNK_SIZE, SOLVE_CHUNK_SIZE)
+                              for i in range(processes)]
+                    results = pool.starmap(_search_nonces, chunks)
+                    scrypt_evaluations["solve"] += sum(r[2] for r in results)
+                    found = [r for r in results if r[0] is not None]
+                    if found:
+                        nonce, pow_hash, _ = found[0]
+                        break
+                    start += processes * SOLVE_CHUNK_SIZE
+        self._set_solution(nonce, pow_hash)
+
+    def _set_solution(self, nonce, pow_hash):
+        self.nNonce = nonce
+        self.rehash()
+        self._scrypt256 = pow_hash
 
     def __repr__(self):
         return "CBlock(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x nTime=%s nBits=%08x nNonce=%08x vtx=%s)" \
@@ -674,6 +1508,286 @@ class CBlock(CBlockHeader):
                time.ctime(self.nTime), self.nBits, self.nNonce, repr(self.vtx))
 
 
+def solve_blocks(blocks, processes=None):
+    """Solve several independent blocks at once, like calling solve() on
+    each, spreading them over a multiprocessing pool of processes workers
+    (by default one per CPU)."""
+    targets = []
+    pending = []
+    for block in blocks:
+        block.rehash()
+        target = uint256_from_compact(block.nBits)
+        if block._calc_scrypt256("solve") > target:
+            pending.append(block)
+            targets.append((block._pow_header[:76], target, block.nNonce + 1))
+    if not pending:
+        return
+    if processes == 1 or len(pending) == 1:
+        results = [_search_nonces(*t) for t in targets]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(_search_nonces, targets)
+    for block, (nonce, pow_hash, attempts) in zip(pending, results):
+        scrypt_evaluations["solve"] += attempts
+        block._set_solution(nonce, pow_hash)
+
+
+class BlockHeaderBatch:
+    """A run of block headers stored column by column.
+
+    The headers are parsed from a buffer of consecutive 80 byte serialized
+    headers (entries may be followed by stride - 80 bytes of padding, such
+    as the transaction count in a headers message) with a single
+    struct.iter_unpack() call. Block hashes are computed for all headers at
+    once the first time they are needed, and scrypt PoW hashes only for the
+    headers they are asked for. header()/headers() turn entries back into
+    CBlockHeader objects."""
+    __slots__ = ("hashMerkleRoot", "hashPrevBlock", "nBits", "nNonce", "nTime",
+                 "nVersion", "_data", "_digests", "_scrypt256", "_stride")
+
+    def __init__(self, data=b"", stride=BLOCK_HEADER_SIZE):
+        if stride < BLOCK_HEADER_SIZE or len(data) % stride:
+            raise ValueError("data is not a whole number of %d byte entries" % stride)
+        self._data = bytes(data)
+        self._stride = stride
+        self._digests = None
+        self._scrypt256 = {}
+        rows = struct.iter_unpack("<i32s32sIII%dx" % (stride - BLOCK_HEADER_SIZE), self._data)
+        columns = tuple(zip(*rows)) or ((),) * 6
+        self.nVersion = list(columns[0])
+        self.hashPrevBlock = [int.from_bytes(x, 'little') for x in columns[1]]
+        self.hashMerkleRoot = [int.from_bytes(x, 'little') for x in columns[2]]
+        self.nTime = list(columns[3])
+        self.nBits = list(columns[4])
+        self.nNonce = list(columns[5])
+
+    @classmethod
+    def from_headers(cls, headers):
+        return cls(b"".join([CBlockHeader.serialize(h) for h in headers]))
+
+    def __len__(self):
+        return len(self.nVersion)
+
+    def raw(self, i):
+        """Return the serialization of header i."""
+        start = i * self._stride
+        return self._data[start:start + BLOCK_HEADER_SIZE]
+
+    def digests(self):
+        """Return the double-SHA256 digests of all headers."""
+        if self._digests is None:
+            view = memoryview(self._data)
+            stride = self._stride
+            self._digests = [hash256(view[start:start + BLOCK_HEADER_SIZE])
+                             for start in range(0, len(self._data), stride)]
+        return self._digests
+
+    def sha256s(self):
+        return [int.from_bytes(d, 'little') for d in self.digests()]
+
+    def hashes(self):
+        return [encode(d[::-1], 'hex_codec').decode('ascii') for d in self.digests()]
+
+    def scrypt256(self, i):
+        """Return the scrypt PoW hash of header i, computing it on first use."""
+        r = self._scrypt256.get(i)
+        if r is None:
+            r = uint256_from_str(scrypt_pow_hash(self.raw(i), "batch"))
+            self._scrypt256[i] = r
+        return r
+
+    def is_chain(self):
+        """Whether every header builds on the one before it."""
+        sha256s = self.sha256s()
+        return all(self.hashPrevBlock[i] == sha256s[i - 1] for i in range(1, len(self)))
+
+    def header(self, i):
+        h = CBlockHeader.__new__(CBlockHeader)
+        h.nVersion = self.nVersion[i]
+        h.hashPrevBlock = self.hashPrevBlock[i]
+        h.hashMerkleRoot = self.hashMerkleRoot[i]
+        h.nTime = self.nTime[i]
+        h.nBits = self.nBits[i]
+        h.nNonce = self.nNonce[i]
+        d = self.digests()[i]
+        h.sha256 = int.from_bytes(d, 'little')
+        h.hash = encode(d[::-1], 'hex_codec').decode('ascii')
+        h._pow_header = self.raw(i)
+        h._scrypt256 = self._scrypt256.get(i)
+        return h
+
+    def headers(self):
+        return [self.header(i) for i in range(len(self))]
+
+    def __repr__(self):
+        return "BlockHeaderBatch(%d headers)" % len(self)
+
+
+class TxBatch:
+    """Many transactions without witnesses, stored column by column.
+
+    Inputs and outputs of all transactions live in flat arrays (prevout
+    hashes, prevout indexes, sequences, values) and all their scripts in one
+    bytearray, addressed by offset and size. A transaction therefore costs a
+    few dozen bytes plus its scripts rather than a tree of CTransaction,
+    CTxIn, COutPoint and CTxOut objects. Transactions are serialized straight
+    from the columns; tx() builds a CTransaction for one when needed."""
+    __slots__ = ("nLockTime", "nSequence", "nValue", "nVersion", "prevout_hash",
+                 "prevout_n", "scripts", "_in_start", "_out_start",
+                 "_script_pubkey_offset", "_script_pubkey_size",
+                 "_script_sig_offset", "_script_sig_size", "_sizes")
+
+    def __init__(self):
+        # Per transaction
+        self.nVersion = array.array("i")
+        self.nLockTime = array.array("I")
+        self._sizes = array.array("Q")
+        # Index of the first input and output of each transaction, and the
+        # number of inputs and outputs in total
+        self._in_start = array.array("Q", [0])
+        self._out_start = array.array("Q", [0])
+        # Per input; prevout_hash holds 32 bytes (little endian) per input
+        self.prevout_hash = bytearray()
+        self.prevout_n = array.array("I")
+        self.nSequence = array.array("I")
+        self._script_sig_offset = array.array("Q")
+        self._script_sig_size = array.array("Q")
+        # Per output
+        self.nValue = array.array("q")
+        self._script_pubkey_offset = array.array("Q")
+        self._script_pubkey_size = array.array("Q")
+        self.scripts = bytearray()
+
+    @classmethod
+    def from_txs(cls, txs):
+        batch = cls()
+        for tx in txs:
+            batch.add_tx(tx)
+        return batch
+
+    def __len__(self):
+        return len(self.nVersion)
+
+    def add(self, vin, vout, nVersion=1, nLockTime=0):
+        """Append a transaction and return its index.
+
+        vin holds (prevout hash, prevout n, scriptSig, nSequence) tuples and
+        vout (nValue, scriptPubKey) pairs."""
+        size = 4 + len(ser_compact_size(len(vin)))
+        for hash, n, script_sig, sequence in vin:
+            self.prevout_hash += (hash & _uint256_mask).to_bytes(32, 'little')
+            self.prevout_n.append(n)
+            self.nSequence.append(sequence)
+            self._script_sig_offset.append(len(self.scripts))
+            self._script_sig_size.append(len(script_sig))
+            self.scripts += script_sig
+            size += 32 + 4 + len(ser_compact_size(len(script_sig))) + len(script_sig) + 4
+        size += len(ser_compact_size(len(vout)))
+        for value, script_pubkey in vout:
+            self.nValue.append(value)
+            self._script_pubkey_offset.append(len(self.scripts))
+            self._script_pubkey_size.append(len(script_pubkey))
+            self.scripts += script_pubkey
+            size += 8 + len(ser_compact_size(len(script_pubkey))) + len(script_pubkey)
+        size += 4
+        self.nVersion.append(nVersion)
+        self.nLockTime.append(nLockTime)
+        self._in_start.append(len(self.prevout_n))
+        self._out_start.append(len(self.nValue))
+        self._sizes.append(size)
+        return len(self) - 1
+
+    def add_tx(self, tx):
+        if not tx.wit.is_null():
+            raise ValueError("TxBatch can't hold witnesses")
+        return self.add([(txin.prevout.hash, txin.prevout.n, txin.scriptSig, txin.nSequence)
+                         for txin in tx.vin],
+                        [(txout.nValue, txout.scriptPubKey) for txout in tx.vout],
+                        tx.nVersion, tx.nLockTime)
+
+    def inputs(self, i):
+        """Return the range of input indexes of transaction i."""
+        return range(self._in_start[i], self._in_start[i + 1])
+
+    def outputs(self, i):
+        """Return the range of output indexes of transaction i."""
+        return range(self._out_start[i], self._out_start[i + 1])
+
+    def script_sig(self, j):
+        offset = self._script_sig_offset[j]
+        return bytes(self.scripts[offset:offset + self._script_sig_size[j]])
+
+    def script_pubkey(self, j):
+        offset = self._script_pubkey_offset[j]
+        return bytes(self.scripts[offset:offset + self._script_pubkey_size[j]])
+
+    def tx_size(self, i):
+        return self._sizes[i]
+
+    def serialize_tx_into(self, i, buf, offset=0):
+        """Write the serialization of transaction i into buf (a bytearray or
+        writable memoryview, which must have room for it) at offset,
+        returning the offset just past it."""
+        with memoryview(self.scripts) as scripts, memoryview(self.prevout_hash) as hashes:
+            _int32.pack_into(buf, offset, self.nVersion[i])
+            inputs = self.inputs(i)
+            offset = _write(buf, offset + 4, ser_compact_size(len(inputs)))
+            for j in inputs:
+                offset = _write(buf, offset, hashes[32 * j:32 * j + 32])
+                _uint32.pack_into(buf, offset, self.prevout_n[j])
+                start = self._script_sig_offset[j]
+                size = self._script_sig_size[j]
+                offset = _write(buf, offset + 4, ser_compact_size(size))
+                offset = _write(buf, offset, scripts[start:start + size])
+                _uint32.pack_into(buf, offset, self.nSequence[j])
+                offset += 4
+            outputs = self.outputs(i)
+            offset = _write(buf, offset, ser_compact_size(len(outputs)))
+            for j in outputs:
+                _int64.pack_into(buf, offset, self.nValue[j])
+                start = self._script_pubkey_offset[j]
+                size = self._script_pubkey_size[j]
+                offset = _write(buf, offset + 8, ser_compact_size(size))
+                offset = _write(buf, offset, scripts[start:start + size])
+            _uint32.pack_into(buf, offset, self.nLockTime[i])
+        return offset + 4
+
+    def serialize_tx(self, i):
+        buf = bytearray(self._sizes[i])
+        self.serialize_tx_into(i, buf)
+        return bytes(buf)
+
+    def serialized_size(self):
+        """Size of the batch serialized as a vector of transactions."""
+        return len(ser_compact_size(len(self))) + sum(self._sizes)
+
+    def serialize_into(self, buf, offset=0):
+        """Write the batch as a vector of transactions (as in a block) into
+        buf at offset, returning the offset just past it."""
+        offset = _write(buf, offset, ser_compact_size(len(self)))
+        for i in range(len(self)):
+            offset = self.serialize_tx_into(i, buf, offset)
+        return offset
+
+    def serialize(self):
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf)
+        return bytes(buf)
+
+    def txid(self, i):
+        return uint256_from_str(hash256(self.serialize_tx(i)))
+
+    def tx(self, i):
+        """Return transaction i as a CTransaction."""
+        tx = CTransaction()
+        tx.deserialize(BufferReader(self.serialize_tx(i)))
+        return tx
+
+    def __repr__(self):
+        return "TxBatch(%d transactions)" % len(self)
+
+
+@codec("compact index", "CTransaction tx", serialize=None)
 class PrefilledTransaction:
     __slots__ = ("index", "tx")
 
@@ -681,11 +1795,6 @@ class PrefilledTransaction:
         self.index = index
         self.tx = tx
 
-    def deserialize(self, f):
-        self.index = deser_compact_size(f)
-        self.tx = CTransaction()
-        self.tx.deserialize(f)
-
     def serialize(self, with_witness=True):
         r = b""
         r += ser_compact_size(self.index)
@@ -718,31 +1827,32 @@ class P2PHeaderAndShortIDs:
         self.prefilled_txn_length = 0
         self.prefilled_txn = []
 
+    @deserializer
     def deserialize(self, f):
         self.header.deserialize(f)
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
-        self.shortids_length = deser_compact_size(f)
+        self.nonce = f.unpack(_uint64)[0]
+        self.shortids_length = f.read_compact_size()
         for i in range(self.shortids_length):
-            # shortids are defined to be 6 bytes in the spec, so append
-            # two zero bytes and read it in as an 8-byte number
-            self.shortids.append(struct.unpack("<Q", f.read(6) + b'\x00\x00')[0])
-        self.prefilled_txn = deser_vector(f, PrefilledTransaction)
+            # shortids are defined to be 6 bytes in the spec, so read them
+            # as a 4-byte and a 2-byte number and combine the two
+            lo, hi = f.unpack(_uint48)
+            self.shortids.append(lo | (hi << 32))
+        self.prefilled_txn = f.read_vector(PrefilledTransaction)
         self.prefilled_txn_length = len(self.prefilled_txn)
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
-        r = b""
-        r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+        r = [self.header.serialize()]
+        r.append(struct.pack("<Q", self.nonce))
+        r.append(ser_compact_size(self.shortids_length))
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            r.append(struct.pack("<Q", x)[0:6])
         if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            r.append(ser_vector(self.prefilled_txn, "serialize_with_witness"))
         else:
-            r += ser_vector(self.prefilled_txn, "serialize_without_witness")
-        return r
+            r.append(ser_vector(self.prefilled_txn, "serialize_without_witness"))
+        return b"".join(r)
 
     def __repr__(self):
         return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
@@ -834,19 +1944,19 @@ class BlockTransactionsRequest:
         self.blockhash = blockhash
         self.indexes = indexes if indexes is not None else []
 
+    @deserializer
     def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
-        indexes_length = deser_compact_size(f)
+        self.blockhash = f.read_uint256()
+        indexes_length = f.read_compact_size()
         for i in range(indexes_length):
-            self.indexes.append(deser_compact_size(f))
+            self.indexes.append(f.read_compact_size())
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+        r = [ser_uint256(self.blockhash)]
+        r.append(ser_compact_size(len(self.indexes)))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            r.append(ser_compact_size(x))
+        return b"".join(r)
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -868,6 +1978,7 @@ class BlockTransactionsRequest:
         return "BlockTransactionsRequest(hash=%064x indexes=%s)" % (self.blockhash, repr(self.indexes))
 
 
+@codec("uint256 blockhash", "vector<CTransaction> transactions", serialize=None)
 class BlockTransactions:
     __slots__ = ("blockhash", "transactions")
 
@@ -875,10 +1986,6 @@ class BlockTransactions:
         self.blockhash = blockhash
         self.transactions = transactions if transactions is not None else []
 
-    def deserialize(self, f):
-        self.blockhash = deser_uint256(f)
-        self.transactions = deser_vector(f, CTransaction)
-
     def serialize(self, with_witness=True):
         r = b""
         r += ser_uint256(self.blockhash)
@@ -900,10 +2007,11 @@ class CPartialMerkleTree:
         self.vHash = []
         self.vBits = []
 
+    @deserializer
     def deserialize(self, f):
-        self.nTransactions = struct.unpack("<i", f.read(4))[0]
-        self.vHash = deser_uint256_vector(f)
-        vBytes = deser_string(f)
+        self.nTransactions = f.unpack(_int32)[0]
+        self.vHash = f.read_uint256_vector()
+        vBytes = f.read_string()
         self.vBits = []
         for i in range(len(vBytes) * 8):
             self.vBits.append(vBytes[i//8] & (1 << (i % 8)) != 0)
@@ -922,6 +2030,7 @@ class CPartialMerkleTree:
         return "CPartialMerkleTree(nTransactions=%d, vHash=%s, vBits=%s)" % (self.nTransactions, repr(self.vHash), repr(self.vBits))
 
 
+@codec("CBlockHeader header", "CPartialMerkleTree txn")
 class CMerkleBlock:
     __slots__ = ("header", "txn")
 
@@ -929,16 +2038,6 @@ class CMerkleBlock:
         self.header = CBlockHeader()
         self.txn = CPartialMerkleTree()
 
-    def deserialize(self, f):
-        self.header.deserialize(f)
-        self.txn.deserialize(f)
-
-    def serialize(self):
-        r = b""
-        r += self.header.serialize()
-        r += self.txn.serialize()
-        return r
-
     def __repr__(self):
         return "CMerkleBlock(header=%s, txn=%s)" % (repr(self.header), repr(self.txn))
 
@@ -960,24 +2059,25 @@ class msg_version:
         self.nStartingHeight = -1
         self.nRelay = MY_RELAY
 
+    @deserializer
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nVersion = f.unpack(_int32)[0]
+        self.nServices = f.unpack(_uint64)[0]
+        self.nTime = f.unpack(_int64)[0]
         self.addrTo = CAddress()
         self.addrTo.deserialize(f, False)
 
         self.addrFrom = CAddress()
         self.addrFrom.deserialize(f, False)
-        self.nNonce = struct.unpack("<Q", f.read(8))[0]
-        self.strSubVer = deser_string(f)
+        self.nNonce = f.unpack(_uint64)[0]
+        self.strSubVer = f.read_string()
 
-        self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+        self.nStartingHeight = f.unpack(_int32)[0]
 
         if self.nVersion >= 70001:
             # Relay field is optional for version 70001 onwards
             try:
-                self.nRelay = struct.unpack("<b", f.read(1))[0]
+                self.nRelay = f.unpack(_int8)[0]
             except:
                 self.nRelay = 0
         else:
@@ -1020,6 +2120,7 @@ class msg_verack:
         return "msg_verack()"
 
 
+@codec("vector<CAddress> addrs")
 class msg_addr:
     __slots__ = ("addrs",)
     command = b"addr"
@@ -1027,16 +2128,11 @@ class msg_addr:
     def __init__(self):
         self.addrs = []
 
-    def deserialize(self, f):
-        self.addrs = deser_vector(f, CAddress)
-
-    def serialize(self):
-        return ser_vector(self.addrs)
-
     def __repr__(self):
         return "msg_addr(addrs=%s)" % (repr(self.addrs))
 
 
+@codec("vector<CInv> inv")
 class msg_inv:
     __slots__ = ("inv",)
     command = b"inv"
@@ -1047,16 +2143,11 @@ class msg_inv:
         else:
             self.inv = inv
 
-    def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
-
-    def serialize(self):
-        return ser_vector(self.inv)
-
     def __repr__(self):
         return "msg_inv(inv=%s)" % (repr(self.inv))
 
 
+@codec("vector<CInv> inv")
 class msg_getdata:
     __slots__ = ("inv",)
     command = b"getdata"
@@ -1064,16 +2155,11 @@ class msg_getdata:
     def __init__(self, inv=None):
         self.inv = inv if inv is not None else []
 
-    def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
-
-    def serialize(self):
-        return ser_vector(self.inv)
-
     def __repr__(self):
         return "msg_getdata(inv=%s)" % (repr(self.inv))
 
 
+@codec("CBlockLocator locator", "uint256 hashstop")
 class msg_getblocks:
     __slots__ = ("locator", "hashstop")
     command = b"getblocks"
@@ -1082,17 +2168,6 @@ class msg_getblocks:
         self.locator = CBlockLocator()
         self.hashstop = 0
 
-    def deserialize(self, f):
-        self.locator = CBlockLocator()
-        self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
-
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
             % (repr(self.locator), self.hashstop)
@@ -1105,12 +2180,25 @@ class msg_tx:
     def __init__(self, tx=CTransaction()):
         self.tx = tx
 
+    @deserializer
     def deserialize(self, f):
         self.tx.deserialize(f)
 
     def serialize(self):
         return self.tx.serialize_without_witness()
 
+    def serialized_size(self):
+        if _overrides(self, msg_tx, "serialize"):
+            return len(self.serialize())
+        return self.tx.serialized_size(with_witness=False)
+
+    def serialize_into(self, buf, offset=0):
+        """Write the payload into buf at offset, returning the offset just
+        past it."""
+        if _overrides(self, msg_tx, "serialize"):
+            return _write(buf, offset, self.serialize())
+        return self.tx.serialize_into(buf, offset, with_witness=False)
+
     def __repr__(self):
         return "msg_tx(tx=%s)" % (repr(self.tx))
 
@@ -1121,6 +2209,16 @@ class msg_witness_tx(msg_tx):
     def serialize(self):
         return self.tx.serialize_with_witness()
 
+    def serialized_size(self):
+        if _overrides(self, msg_witness_tx, "serialize"):
+            return len(self.serialize())
+        return self.tx.serialized_size(with_witness=True)
+
+    def serialize_into(self, buf, offset=0):
+        if _overrides(self, msg_witness_tx, "serialize"):
+            return _write(buf, offset, self.serialize())
+        return self.tx.serialize_into(buf, offset, with_witness=True)
+
 
 class msg_block:
     __slots__ = ("block",)
@@ -1132,12 +2230,26 @@ class msg_block:
         else:
             self.block = block
 
+    @deserializer
     def deserialize(self, f):
-        self.block.deserialize(f)
+        # Transactions are only decoded if the test looks at them
+        self.block.deserialize(f, lazy=True)
 
     def serialize(self):
         return self.block.serialize(with_witness=False)
 
+    def serialized_size(self):
+        if _overrides(self, msg_block, "serialize"):
+            return len(self.serialize())
+        return self.block.serialized_size(with_witness=False)
+
+    def serialize_into(self, buf, offset=0):
+        """Write the payload into buf at offset, returning the offset just
+        past it."""
+        if _overrides(self, msg_block, "serialize"):
+            return _write(buf, offset, self.serialize())
+        return self.block.serialize_into(buf, offset, with_witness=False)
+
     def __repr__(self):
         return "msg_block(block=%s)" % (repr(self.block))
 
@@ -1154,6 +2266,12 @@ class msg_generic:
     def serialize(self):
         return self.data
 
+    def serialized_size(self):
+        return len(self.data)
+
+    def serialize_into(self, buf, offset=0):
+        return _write(buf, offset, self.data)
+
     def __repr__(self):
         return "msg_generic()"
 
@@ -1164,6 +2282,16 @@ class msg_witness_block(msg_block):
         r = self.block.serialize(with_witness=True)
         return r
 
+    def serialized_size(self):
+        if _overrides(self, msg_witness_block, "serialize"):
+            return len(self.serialize())
+        return self.block.serialized_size(with_witness=True)
+
+    def serialize_into(self, buf, offset=0):
+        if _overrides(self, msg_witness_block, "serialize"):
+            return _write(buf, offset, self.serialize())
+        return self.block.serialize_into(buf, offset, with_witness=True)
+
 
 class msg_getaddr:
     __slots__ = ()
@@ -1182,6 +2310,7 @@ class msg_getaddr:
         return "msg_getaddr()"
 
 
+@codec("uint64 nonce")
 class msg_ping:
     __slots__ = ("nonce",)
     command = b"ping"
@@ -1189,18 +2318,11 @@ class msg_ping:
     def __init__(self, nonce=0):
         self.nonce = nonce
 
-    def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
-
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
 
 
+@codec("uint64 nonce")
 class msg_pong:
     __slots__ = ("nonce",)
     command = b"pong"
@@ -1208,14 +2330,6 @@ class msg_pong:
     def __init__(self, nonce=0):
         self.nonce = nonce
 
-    def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
-
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
 
@@ -1237,6 +2351,7 @@ class msg_mempool:
         return "msg_mempool()"
 
 
+@codec("vector<CInv> vec")
 class msg_notfound:
     __slots__ = ("vec", )
     command = b"notfound"
@@ -1244,12 +2359,6 @@ class msg_notfound:
     def __init__(self, vec=None):
         self.vec = vec or []
 
-    def deserialize(self, f):
-        self.vec = deser_vector(f, CInv)
-
-    def serialize(self):
-        return ser_vector(self.vec)
-
     def __repr__(self):
         return "msg_notfound(vec=%s)" % (repr(self.vec))
 
@@ -1275,6 +2384,7 @@ class msg_sendheaders:
 # number of entries
 # vector of hashes
 # hash_stop (hash of last desired block header, 0 to get as many as possible)
+@codec("CBlockLocator locator", "uint256 hashstop")
 class msg_getheaders:
     __slots__ = ("hashstop", "locator",)
     command = b"getheaders"
@@ -1283,17 +2393,6 @@ class msg_getheaders:
         self.locator = CBlockLocator()
         self.hashstop = 0
 
-    def deserialize(self, f):
-        self.locator = CBlockLocator()
-        self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
-
-    def serialize(self):
-        r = b""
-        r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
-
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
             % (repr(self.locator), self.hashstop)
@@ -1308,15 +2407,30 @@ class msg_headers:
     def __init__(self, headers=None):
         self.headers = headers if headers is not None else []
 
+    @deserializer
     def deserialize(self, f):
-        # comment in bitcoind indicates these should be deserialized as blocks
-        blocks = deser_vector(f, CBlock)
-        for x in blocks:
-            self.headers.append(CBlockHeader(x))
+        # comment in bitcoind indicates these should be deserialized as blocks,
+        # which in practice are headers followed by a zero transaction count
+        start = f.tell()
+        n = f.read_compact_size()
+        size = (BLOCK_HEADER_SIZE + 1) * n
+        entries = f.peek(size)
+        if len(entries) == size and entries[BLOCK_HEADER_SIZE::BLOCK_HEADER_SIZE + 1] == bytes(n):
+            f.pos += size
+            self.headers.extend(BlockHeaderBatch(entries, BLOCK_HEADER_SIZE + 1).headers())
+        else:
+            f.pos = start
+            blocks = f.read_vector(CBlock)
+            for x in blocks:
+                self.headers.append(CBlockHeader(x))
 
     def serialize(self):
-        blocks = [CBlock(x) for x in self.headers]
-        return ser_vector(blocks)
+        r = [ser_compact_size(len(self.headers))]
+        for x in self.headers:
+            # Serialized as a block without transactions
+            r.append(CBlockHeader.serialize(x))
+            r.append(b"\x00")
+        return b"".join(r)
 
     def __repr__(self):
         return "msg_headers(headers=%s)" % repr(self.headers)
@@ -1333,13 +2447,14 @@ class msg_reject:
         self.reason = b""
         self.data = 0
 
+    @deserializer
     def deserialize(self, f):
-        self.message = deser_string(f)
-        self.code = struct.unpack("<B", f.read(1))[0]
-        self.reason = deser_string(f)
+        self.message = f.read_string()
+        self.code = f.unpack(_uint8)[0]
+        self.reason = f.read_string()
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
-            self.data = deser_uint256(f)
+            self.data = f.read_uint256()
 
     def serialize(self):
         r = ser_string(self.message)
@@ -1355,6 +2470,7 @@ class msg_reject:
             % (self.message, self.code, self.reason, self.data)
 
 
+@codec("uint64 feerate")
 class msg_feefilter:
     __slots__ = ("feerate",)
     command = b"feefilter"
@@ -1362,18 +2478,11 @@ class msg_feefilter:
     def __init__(self, feerate=0):
         self.feerate = feerate
 
-    def deserialize(self, f):
-        self.feerate = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
-
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
 
 
+@codec("bool announce", "uint64 version")
 class msg_sendcmpct:
     __slots__ = ("announce", "version")
     command = b"sendcmpct"
@@ -1382,20 +2491,11 @@ class msg_sendcmpct:
         self.announce = False
         self.version = 1
 
-    def deserialize(self, f):
-        self.announce = struct.unpack("<?", f.read(1))[0]
-        self.version = struct.unpack("<Q", f.read(8))[0]
-
-    def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
-
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
 
 
+@codec("P2PHeaderAndShortIDs header_and_shortids")
 class msg_cmpctblock:
     __slots__ = ("header_and_shortids",)
     command = b"cmpctblock"
@@ -1403,19 +2503,11 @@ class msg_cmpctblock:
     def __init__(self, header_and_shortids = None):
         self.header_and_shortids = header_and_shortids
 
-    def deserialize(self, f):
-        self.header_and_shortids = P2PHeaderAndShortIDs()
-        self.header_and_shortids.deserialize(f)
-
-    def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize()
-        return r
-
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
 
 
+@codec("BlockTransactionsRequest block_txn_request")
 class msg_getblocktxn:
     __slots__ = ("block_txn_request",)
     command = b"getblocktxn"
@@ -1423,15 +2515,6 @@ class msg_getblocktxn:
     def __init__(self):
         self.block_txn_request = None
 
-    def deserialize(self, f):
-        self.block_txn_request = BlockTransactionsRequest()
-        self.block_txn_request.deserialize(f)
-
-    def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
-
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
 
@@ -1443,6 +2526,7 @@ class msg_blocktxn:
     def __init__(self):
         self.block_transactions = BlockTransactions()
 
+    @deserializer
     def deserialize(self, f):
         self.block_transactions.deserialize(f)
 
@@ -1462,3 +2546,272 @@ class msg_witness_blocktxn(msg_blocktxn):
         r = b""
         r += self.block_transactions.serialize(with_witness=True)
         return r
+
+
+class TestFrameworkMessages(unittest.TestCase):
+    def build_tx(self, n=1, script_sig=b"", values=(5000,), stack=(b"\x01",)):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(0xabcd, 0), b"\x51", 0xfffffffe))
+        tx.vin.append(CTxIn(COutPoint(0x1234, n), script_sig, 0))
+        tx.vout = [CTxOut(value, b"\x51") for value in values]
+        tx.wit.vtxinwit = [CTxInWitness(), CTxInWitness()]
+        tx.wit.vtxinwit[1].scriptWitness.stack = list(stack)
+        return tx
+
+    def assert_same_tx(self, tx, expected):
+        self.assertEqual(tx.serialize(), expected.serialize())
+        self.assertEqual(tx.serialize_without_witness(), expected.serialize_without_witness())
+        self.assertEqual(tx.rehash(), expected.rehash())
+        self.assertEqual(tx.wtxid, expected.wtxid)
+        self.assertEqual(tx.weight, expected.weight)
+
+    def test_nested_changes(self):
+        changes = [
+            (lambda tx: setattr(tx.vin[1].prevout, "n", 7), dict(n=7)),
+            (lambda tx: setattr(tx.vin[1], "prevout", COutPoint(0x1234, 7)), dict(n=7)),
+            (lambda tx: setattr(tx.vin[1], "scriptSig", b"\x52"), dict(script_sig=b"\x52")),
+            (lambda tx: setattr(tx.vout[0], "nValue", 4000), dict(values=(4000,))),
+            (lambda tx: tx.vout.append(CTxOut(5000, b"\x51")), dict(values=(5000, 5000))),
+            (lambda tx: tx.vout.pop(), dict(values=())),
+            (lambda tx: tx.wit.vtxinwit[1].scriptWitness.stack.append(b"\x02"), dict(stack=(b"\x01", b"\x02"))),
+            (lambda tx: tx.wit.vtxinwit[1].scriptWitness.stack.__setitem__(0, b"\x03"), dict(stack=(b"\x03",))),
+            (lambda tx: tx.wit.vtxinwit[1].scriptWitness.stack.clear(), dict(stack=())),
+        ]
+        for change, expected in changes:
+            tx = self.build_tx()
+            self.assert_same_tx(tx, self.build_tx())
+            before = tx.serialize()
+            change(tx)
+            self.assertNotEqual(tx.serialize(), before)
+            self.assert_same_tx(tx, self.build_tx(**expected))
+
+    def test_copies(self):
+        tx = self.build_tx()
+        tx.rehash()
+        copies = [
+            copy.deepcopy(tx),
+            pickle.loads(pickle.dumps(tx)),
+            CTransaction(tx),
+        ]
+        for tx_copy in copies:
+            self.assertEqual(tx_copy.sha256, tx.sha256)
+            self.assertEqual(tx_copy.hash, tx.hash)
+            self.assert_same_tx(tx_copy, tx)
+            tx_copy.vin[1].prevout.n = 7
+            tx_copy.wit.vtxinwit[1].scriptWitness.stack.append(b"\x02")
+            self.assert_same_tx(tx_copy, self.build_tx(n=7, stack=(b"\x01", b"\x02")))
+            self.assert_same_tx(tx, self.build_tx())
+
+        # A shallow copy shares the inputs: changing one through the copy
+        # changes both transactions.
+        tx_copy = copy.copy(tx)
+        self.assert_same_tx(tx_copy, tx)
+        tx_copy.vin[1].prevout.n = 7
+        self.assert_same_tx(tx_copy, self.build_tx(n=7))
+        self.assert_same_tx(tx, self.build_tx(n=7))
+
+    def test_aliases(self):
+        # Caching leaves the lists in place, so changes made through
+        # references taken before the transaction was hashed still count.
+        tx = self.build_tx()
+        vin = tx.vin
+        vout = tx.vout
+        stack = tx.wit.vtxinwit[1].scriptWitness.stack
+        tx.rehash()
+        self.assertIs(tx.vin, vin)
+        self.assertIs(tx.wit.vtxinwit[1].scriptWitness.stack, stack)
+        vin.append(CTxIn(COutPoint(0x5678, 0)))
+        vout.pop()
+        stack.append(b"\x02")
+        expected = self.build_tx(values=(), stack=(b"\x01", b"\x02"))
+        expected.vin.append(CTxIn(COutPoint(0x5678, 0)))
+        expected.wit.vtxinwit.append(CTxInWitness())
+        tx.wit.vtxinwit.append(CTxInWitness())
+        self.assert_same_tx(tx, expected)
+
+        # The same for a stack assigned from outside after serializing
+        tx = self.build_tx()
+        stack = [b"\x01"]
+        tx.serialize()
+        tx.wit.vtxinwit[1].scriptWitness.stack = stack
+        self.assertEqual(tx.serialize(), self.build_tx().serialize())
+        stack.append(b"\x02")
+        self.assertIs(tx.wit.vtxinwit[1].scriptWitness.stack, stack)
+        self.assert_same_tx(tx, self.build_tx(stack=(b"\x01", b"\x02")))
+
+    def test_solve_processes(self):
+        blocks = []
+        for i in range(4):
+            block = CBlock()
+            block.nTime = 1296688602 + i
+            # About one nonce in 512 works, so a parallel search may need
+            # more than one round of chunks.
+            block.nBits = 0x1f7fffff
+            block.vtx = [self.build_tx()]
+            block.hashMerkleRoot = block.calc_merkle_root()
+            blocks.append(block)
+
+        # Every way of solving finds the first nonce after the current one
+        # that works.
+        serial = [copy.deepcopy(block) for block in blocks]
+        for block in serial:
+            block.solve()
+            self.assertTrue(block.is_valid())
+        parallel = [copy.deepcopy(block) for block in blocks]
+        for block in parallel:
+            block.solve(processes=2)
+        batch = [copy.deepcopy(block) for block in blocks]
+        solve_blocks(batch, processes=2)
+        for solved in (parallel, batch):
+            self.assertEqual([block.nNonce for block in solved], [block.nNonce for block in serial])
+            self.assertEqual([block.sha256 for block in solved], [block.sha256 for block in serial])
+            for block in solved:
+                self.assertTrue(block.is_valid())
+
+    def test_tx_batch(self):
+        txs = []
+        for i in range(5):
+            tx = CTransaction()
+            tx.nVersion = i
+            tx.nLockTime = 1000 * i
+            tx.vin = [CTxIn(COutPoint(0x1234 << j, j), b"\x51" * (100 * j), j) for j in range(i + 1)]
+            tx.vout = [CTxOut(j, b"\x52" * (200 * j)) for j in range(5 - i)]
+            tx.rehash()
+            txs.append(tx)
+
+        batch = TxBatch.from_txs(txs)
+        self.assertEqual(len(batch), len(txs))
+        self.assertEqual(batch.serialize(), ser_vector(txs))
+        for i, tx in enumerate(txs):
+            self.assertEqual(batch.serialize_tx(i), tx.serialize())
+            self.assertEqual(batch.tx_size(i), len(tx.serialize()))
+            self.assertEqual(batch.txid(i), tx.sha256)
+            self.assertEqual(batch.tx(i).serialize(), tx.serialize())
+
+        with self.assertRaises(ValueError):
+            batch.add_tx(self.build_tx())
+
+    def test_headers(self):
+        headers = []
+        prev = 0
+        for i in range(5):
+            header = CBlockHeader()
+            header.nVersion = 4
+            header.hashPrevBlock = prev
+            header.hashMerkleRoot = 0x1234 + i
+            header.nTime = 1296688602 + i
+            header.nBits = 0x207fffff
+            header.nNonce = i
+            header.rehash()
+            prev = header.sha256
+            headers.append(header)
+
+        def assert_same_headers(received, expected):
+            self.assertEqual(len(received), len(expected))
+            for header, h in zip(received, expected):
+                self.assertEqual(header.serialize(), h.serialize())
+                self.assertEqual(header.sha256, h.sha256)
+                self.assertEqual(header.hash, h.hash)
+                self.assertEqual(header.scrypt256, h.scrypt256)
+
+        batch = BlockHeaderBatch.from_headers(headers)
+        self.assertTrue(batch.is_chain())
+        self.assertEqual(batch.sha256s(), [h.sha256 for h in headers])
+        assert_same_headers(batch.headers(), headers)
+
+        # Headers with zero transaction counts are parsed as a batch
+        data = msg_headers(headers).serialize()
+        msg = msg_headers()
+        msg.deserialize(BufferReader(data))
+        assert_same_headers(msg.headers, headers)
+        self.assertEqual(msg.serialize(), data)
+
+        # Anything else is parsed as blocks, whose headers are kept
+        block = CBlock(headers[1])
+        block.vtx = [self.build_tx()]
+        data = (ser_compact_size(3) + CBlockHeader.serialize(headers[0]) + b"\x00" +
+                block.serialize() + CBlockHeader.serialize(headers[2]) + b"\x00")
+        msg = msg_headers()
+        msg.deserialize(BufferReader(data))
+        assert_same_headers(msg.headers, headers[:3])
+        self.assertEqual(msg.serialize(), msg_headers(headers[:3]).serialize())
+
+    def test_merkle_tree(self):
+        def expected_roots(block):
+            for tx in block.vtx:
+                tx.calc_sha256()
+            txids = [ser_uint256(tx.sha256) for tx in block.vtx]
+            wtxids = [ser_uint256(0)] + [ser_uint256(tx.calc_sha256(True)) for tx in block.vtx[1:]]
+            return CBlock.get_merkle_root(txids), CBlock.get_merkle_root(wtxids)
+
+        for n in range(1, 10):
+            block = CBlock()
+            block.vtx = [self.build_tx(n=i) for i in range(n)]
+            self.assertEqual((block.calc_merkle_root(), block.calc_witness_merkle_root()), expected_roots(block))
+            changes = [
+                lambda: setattr(block.vtx[-1], "nLockTime", 1),
+                lambda: block.vtx[0].wit.vtxinwit[1].scriptWitness.stack.append(b"\x02"),
+                lambda: block.vtx[n // 2].wit.vtxinwit[1].scriptWitness.stack.append(b"\x02"),
+                lambda: block.vtx.append(self.build_tx(n=n)),
+                lambda: block.vtx.append(self.build_tx(n=n + 1)),
+                lambda: block.vtx.pop(),
+                lambda: block.vtx.pop(0),
+            ]
+            for change in changes:
+                change()
+                self.assertEqual((block.calc_merkle_root(), block.calc_witness_merkle_root()), expected_roots(block))
+
+        # Trees growing and shrinking by several leaves at once
+        tree = MerkleTree()
+        for size in [1, 2, 3, 8, 5, 17, 16, 2, 1, 33]:
+            hashes = [hash256(bytes([size, i])) for i in range(size)]
+            self.assertEqual(tree.update(hashes), CBlock.get_merkle_root(hashes))
+        with self.assertRaises(IndexError):
+            tree.update([])
+
+    def test_lazy_block(self):
+        block = CBlock()
+        block.nTime = 1296688602
+        block.vtx = [self.build_tx(n=i) for i in range(4)]
+        block.vtx[2].wit.vtxinwit = []
+        data = block.serialize(with_witness=True)
+
+        def load():
+            eager = CBlock()
+            eager.deserialize(BufferReader(data))
+            lazy = CBlock()
+            lazy.deserialize(BufferReader(data), lazy=True)
+            return eager, lazy
+
+        eager, lazy = load()
+        self.assertEqual(lazy.serialize(with_witness=True), data)
+        self.assertEqual(lazy.serialize(), eager.serialize())
+        self.assertEqual(lazy.calc_merkle_root(), eager.calc_merkle_root())
+        self.assertEqual(lazy.calc_witness_merkle_root(), eager.calc_witness_merkle_root())
+        self.assertEqual((lazy.weight, lazy.vsize), (eager.weight, eager.vsize))
+        self.assertEqual(lazy.tx_count(), len(eager.vtx))
+        for i, tx in enumerate(eager.vtx):
+            lazy_tx = lazy.get_tx(i)
+            self.assertEqual(lazy_tx.serialize(), tx.serialize())
+            self.assertEqual(lazy_tx.sha256, tx.sha256)
+            self.assertEqual(lazy_tx.calc_sha256(True), tx.calc_sha256(True))
+        self.assertEqual(lazy.serialize(with_witness=True), data)
+        self.assertEqual([tx.serialize() for tx in lazy.vtx], [tx.serialize() for tx in eager.vtx])
+        self.assertEqual(lazy.serialize(with_witness=True), data)
+
+        # Changes to a decoded transaction, or to the header, are serialized
+        # instead of the original bytes, both before and after vtx is used.
+        for change in [
+            lambda block: setattr(block.get_tx(1).vin[1].prevout, "n", 7),
+            lambda block: block.get_tx(3).wit.vtxinwit[1].scriptWitness.stack.append(b"\x02"),
+            lambda block: setattr(block.vtx[2], "nLockTime", 1),
+            lambda block: setattr(block, "nNonce", 1),
+        ]:
+            eager, lazy = load()
+            change(eager)
+            change(lazy)
+            self.assertNotEqual(lazy.serialize(with_witness=True), data)
+            self.assertEqual(lazy.serialize(with_witness=True), eager.serialize(with_witness=True))
+            self.assertEqual(lazy.serialize(), eager.serialize())
+            self.assertEqual(lazy.calc_merkle_root(), eager.calc_merkle_root())
+            self.assertEqual(lazy.calc_witness_merkle_root(), eager.calc_witness_merkle_root())
@@ -15,13 +15,13 @@ P2PDataStore: A p2p interface class that keeps a store of transactions and block
               and can respond correctly to getdata and getheaders messages"""
 import asyncio
 from collections import defaultdict
-from io import BytesIO
 import logging
 import struct
 import sys
 import threading
 
 from test_framework.messages import (
+    BufferReader,
     CBlockHeader,
     MIN_VERSION_SUPPORTED,
     msg_addr,
@@ -179,17 +179,18 @@ class P2PConnection(asyncio.Protocol):
                 checksum = self.recvbuf[4+12+4:4+12+4+4]
                 if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
                     return
-                msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
+                # Parse the payload in place rather than slicing a copy of it
+                # out of the receive buffer.
+                msg = memoryview(self.recvbuf)[4+12+4+4:4+12+4+4+msglen]
                 th = sha256(msg)
                 h = sha256(th)
                 if checksum != h[:4]:
                     raise ValueError("got bad checksum " + repr(self.recvbuf))
                 self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
                 if command not in MESSAGEMAP:
-                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
-                f = BytesIO(msg)
+                    raise ValueError("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(bytes(msg))))
                 t = MESSAGEMAP[command]()
-                t.deserialize(f)
+                t.deserialize(BufferReader(msg))
                 self._log_message("receive", t)
                 self.on_message(t)
         except Exception as e:
@@ -229,17 +230,27 @@ class P2PConnection(asyncio.Protocol):
     # Class utility methods
 
     def build_message(self, message):
-        """Build a serialized P2P message"""
+        """Build a serialized P2P message
+
+        Messages with serialize_into() (blocks and transactions) are written
+        straight into the buffer holding the whole message."""
         command = message.command
-        data = message.serialize()
-        tmsg = self.magic_bytes
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
-        th = sha256(data)
-        h = sha256(th)
-        tmsg += h[:4]
-        tmsg += data
+        prefix = self.magic_bytes + command + b"\x00" * (12 - len(command))
+        header_size = len(prefix) + 4 + 4
+        if hasattr(message, "serialize_into"):
+            tmsg = bytearray(header_size + message.serialized_size())
+            end = message.serialize_into(tmsg, header_size)
+            # Serializing can change a transaction whose witnesses don't
+            # match its inputs, and with it the size.
+            del tmsg[end:]
+        else:
+            data = message.serialize()
+            tmsg = bytearray(header_size + len(data))
+            tmsg[header_size:] = data
+        tmsg[:len(prefix)] = prefix
+        with memoryview(tmsg)[header_size:] as data:
+            struct.pack_into("<I4s", tmsg, header_size - 8, len(data),
+                             sha256(sha256(data))[:4])
         return tmsg
 
     def _log_message(self, direction, msg):
@@ -7,11 +7,25 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .messages import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
-
+from .messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    hash256,
+    ser_compact_size,
+    ser_string,
+    sha256,
+)
+
+import array
 from binascii import hexlify
+import functools
 import hashlib
+import random
 import struct
+import unittest
 
 from .bignum import bn2vch
 
@@ -472,55 +486,15 @@ class CScript(bytes):
         PUSHDATA encodings can be accurately distinguished, as well as
         determining the exact opcode byte indexes. (sop_idx)
         """
-        i = 0
-        while i < len(self):
-            sop_idx = i
-            opcode = self[i]
-            i += 1
-
+        opcodes, offsets, error = script_index(self)
+        for k, opcode in enumerate(opcodes):
+            sop_idx = offsets[k]
             if opcode > OP_PUSHDATA4:
                 yield (opcode, None, sop_idx)
             else:
-                datasize = None
-                pushdata_type = None
-                if opcode < OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA(%d)' % opcode
-                    datasize = opcode
-
-                elif opcode == OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA1'
-                    if i >= len(self):
-                        raise CScriptInvalidError('PUSHDATA1: missing data length')
-                    datasize = self[i]
-                    i += 1
-
-                elif opcode == OP_PUSHDATA2:
-                    pushdata_type = 'PUSHDATA2'
-                    if i + 1 >= len(self):
-                        raise CScriptInvalidError('PUSHDATA2: missing data length')
-                    datasize = self[i] + (self[i+1] << 8)
-                    i += 2
-
-                elif opcode == OP_PUSHDATA4:
-                    pushdata_type = 'PUSHDATA4'
-                    if i + 3 >= len(self):
-                        raise CScriptInvalidError('PUSHDATA4: missing data length')
-                    datasize = self[i] + (self[i+1] << 8) + (self[i+2] << 16) + (self[i+3] << 24)
-                    i += 4
-
-                else:
-                    assert False # shouldn't happen
-
-
-                data = bytes(self[i:i+datasize])
-
-                # Check for truncation
-                if len(data) < datasize:
-                    raise CScriptTruncatedPushDataError('%s: truncated data' % pushdata_type, data)
-
-                i += datasize
-
-                yield (opcode, data, sop_idx)
+                yield (opcode, self[sop_idx + _PUSHDATA_HEADER_SIZES[opcode]:offsets[k + 1]], sop_idx)
+        if error is not None:
+            raise error[0](*error[1])
 
     def __iter__(self):
         """'Cooked' iteration
@@ -531,16 +505,14 @@ class CScript(bytes):
         See raw_iter() if you need to distinguish the different possible
         PUSHDATA encodings.
         """
-        for (opcode, data, sop_idx) in self.raw_iter():
-            if data is not None:
-                yield data
+        opcodes, offsets, error = script_index(self)
+        for k, opcode in enumerate(opcodes):
+            if opcode > OP_PUSHDATA4:
+                yield _COOKED_OPCODES[opcode]
             else:
-                opcode = CScriptOp(opcode)
-
-                if opcode.is_small_int():
-                    yield opcode.decode_op_n()
-                else:
-                    yield CScriptOp(opcode)
+                yield self[offsets[k] + _PUSHDATA_HEADER_SIZES[opcode]:offsets[k + 1]]
+        if error is not None:
+            raise error[0](*error[1])
 
     def __repr__(self):
         def _repr(o):
@@ -576,20 +548,128 @@ class CScript(bytes):
 
         Note that this is consensus-critical.
         """
+        opcodes, offsets, error = script_index(self)
         n = 0
         lastOpcode = OP_INVALIDOPCODE
-        for (opcode, data, sop_idx) in self.raw_iter():
+        for opcode in opcodes:
             if opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
                 n += 1
             elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
                 if fAccurate and (OP_1 <= lastOpcode <= OP_16):
-                    n += opcode.decode_op_n()
+                    n += CScriptOp(lastOpcode).decode_op_n()
                 else:
                     n += 20
             lastOpcode = opcode
+        if error is not None:
+            raise error[0](*error[1])
         return n
 
 
+# Number of bytes before the data of each push opcode
+_PUSHDATA_HEADER_SIZES = bytes([1] * OP_PUSHDATA1 + [2, 3, 5])
+# What iterating over a CScript yields for each opcode that is not a push
+_COOKED_OPCODES = [op.decode_op_n() if op.is_small_int() else op for op in _opcode_instances]
+
+SCRIPT_INDEX_CACHE_SIZE = 1 << 16
+
+@functools.lru_cache(maxsize=SCRIPT_INDEX_CACHE_SIZE)
+def script_index(script):
+    """Tokenize a script, returning (opcodes, offsets, error)
+
+    opcodes holds the opcode bytes of the script, and offsets (one longer)
+    where each of them starts followed by where the last one ends; the data
+    pushed by a push opcode is what follows its PUSHDATA header up to the
+    next offset. If the script ends in an invalid push, error is the
+    (exception class, arguments) for the CScriptInvalidError raised once
+    the opcodes before it are iterated over.
+
+    As scripts are immutable, indexes are cached by script, so iterating over
+    a script or counting its sigops again does not tokenize it again."""
+    opcodes = bytearray()
+    offsets = array.array('I')
+    error = None
+    i = 0
+    n = len(script)
+    while i < n:
+        opcode = script[i]
+        if opcode <= OP_PUSHDATA4:
+            header = _PUSHDATA_HEADER_SIZES[opcode]
+            if opcode < OP_PUSHDATA1:
+                pushdata_type = 'PUSHDATA(%d)' % opcode
+                datasize = opcode
+            else:
+                pushdata_type = 'PUSHDATA%d' % (header - 1)
+                if i + header > n:
+                    error = (CScriptInvalidError, ('%s: missing data length' % pushdata_type,))
+                    break
+                datasize = int.from_bytes(script[i + 1:i + header], 'little')
+            if i + header + datasize > n:
+                error = (CScriptTruncatedPushDataError, ('%s: truncated data' % pushdata_type, bytes(script[i + header:])))
+                break
+            opcodes.append(opcode)
+            offsets.append(i)
+            i += header + datasize
+        else:
+            opcodes.append(opcode)
+            offsets.append(i)
+            i += 1
+    offsets.append(i)
+    return (bytes(opcodes), offsets, error)
+
+
+# Standard output scripts, as (bytes before, bytes after, size) around a
+# pushed hash of the given size; size None pushes data of any length.
+SCRIPT_TEMPLATES = {
+    'p2pkh': (bytes([OP_DUP, OP_HASH160, 20]), bytes([OP_EQUALVERIFY, OP_CHECKSIG]), 20),
+    'p2sh': (bytes([OP_HASH160, 20]), bytes([OP_EQUAL]), 20),
+    'p2wpkh': (bytes([OP_0, 20]), b'', 20),
+    'p2wsh': (bytes([OP_0, 32]), b'', 32),
+    'nulldata': (bytes([OP_RETURN]), b'', None),
+}
+
+SCRIPT_TEMPLATE_CACHE_SIZE = 1 << 16
+
+@functools.lru_cache(maxsize=SCRIPT_TEMPLATE_CACHE_SIZE)
+def _script_from_template(template, data):
+    prefix, suffix, size = SCRIPT_TEMPLATES[template]
+    if size is None:
+        return CScript(prefix + CScriptOp.encode_op_pushdata(data) + suffix)
+    if len(data) != size:
+        raise ValueError('%s script needs %d bytes of data, got %d' % (template, size, len(data)))
+    return CScript(prefix + data + suffix)
+
+def script_from_template(template, data):
+    """Return the script of one of SCRIPT_TEMPLATES for data
+
+    Equal to building it with CScript([...]), but spliced as bytes, and the
+    same CScript instance is returned for the same template and data."""
+    return _script_from_template(template, bytes(data))
+
+def keyhash_to_p2pkh_script(hash):
+    return script_from_template('p2pkh', hash)
+
+def scripthash_to_p2sh_script(hash):
+    return script_from_template('p2sh', hash)
+
+def key_to_p2pkh_script(key):
+    return script_from_template('p2pkh', hash160(key))
+
+def keyhash_to_p2wpkh_script(hash):
+    return script_from_template('p2wpkh', hash)
+
+def key_to_p2wpkh_script(key):
+    return script_from_template('p2wpkh', hash160(key))
+
+def script_to_p2sh_script(script):
+    return script_from_template('p2sh', hash160(script))
+
+def script_to_p2wsh_script(script):
+    return script_from_template('p2wsh', sha256(script))
+
+def null_data_script(data):
+    return script_from_template('nulldata', data)
+
+
 SIGHASH_ALL = 1
 SIGHASH_NONE = 2
 SIGHASH_SINGLE = 3
@@ -597,113 +677,258 @@ SIGHASH_ANYONECANPAY = 0x80
 
 def FindAndDelete(script, sig):
     """Consensus critical, see FindAndDelete() in Satoshi codebase"""
-    r = b''
-    last_sop_idx = sop_idx = 0
+    opcodes, offsets, error = script_index(script)
+    if error is not None:
+        raise error[0](*error[1])
+    r = []
+    last_sop_idx = 0
     skip = True
-    for (opcode, data, sop_idx) in script.raw_iter():
+    for sop_idx in offsets[:-1]:
         if not skip:
-            r += script[last_sop_idx:sop_idx]
+            r.append(script[last_sop_idx:sop_idx])
         last_sop_idx = sop_idx
-        if script[sop_idx:sop_idx + len(sig)] == sig:
-            skip = True
-        else:
-            skip = False
+        skip = script.startswith(sig, sop_idx)
     if not skip:
-        r += script[last_sop_idx:]
-    return CScript(r)
+        r.append(script[last_sop_idx:])
+    return CScript(b''.join(r))
+
 
+HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
 def SignatureHash(script, txTo, inIdx, hashtype):
     """Consensus-correct SignatureHash
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
     the SIGHASH_SINGLE bug. (inIdx is *not* checked for validity)
-    """
-    HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-
-    if inIdx >= len(txTo.vin):
-        return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
 
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx %d out of range (%d)" % (outIdx, len(txtmp.vout)))
-
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
-
-    if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize_without_witness()
-    s += struct.pack(b"<I", hashtype)
-
-    hash = hash256(s)
-
-    return (hash, None)
+    Use SighashCache.signature_hashes() to hash many inputs of the same
+    transaction.
+    """
+    return SighashCache(txTo).signature_hash(script, inIdx, hashtype)
 
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
 # Note that this corresponds to sigversion == 1 in EvalScript, which is used
 # for version 0 witnesses.
 def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
-
-    hashPrevouts = 0
-    hashSequence = 0
-    hashOutputs = 0
-
-    if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
-
-    if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
-
-    if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-    elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
-        serialize_outputs = txTo.vout[inIdx].serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-
-    ss = bytes()
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
-    ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
-    ss += struct.pack("<I", hashtype)
-
-    return hash256(ss)
+    return SighashCache(txTo).segwit_signature_hash(script, inIdx, hashtype, amount)
+
+class SighashCache():
+    """Signature hashes of the inputs of one transaction.
+
+    The BIP143 hashPrevouts, hashSequence and hashOutputs are computed once
+    and reused for all inputs, so signing every input of a transaction
+    hashes it a constant number of times rather than once per input. They
+    are recomputed when the transaction's serialization without witness
+    (which the transaction caches until it is modified) changes."""
+
+    def __init__(self, tx):
+        self.tx = tx
+        self._ser = None
+        self._midstates = {}
+
+    def _get_midstate(self, name):
+        ser = self.tx.serialize_without_witness()
+        if ser is not self._ser:
+            if ser != self._ser:
+                self._midstates = {}
+            self._ser = ser
+        if name not in self._midstates:
+            if name == "legacy":
+                self._midstates[name] = self._legacy_template()
+                return self._midstates[name]
+            if name == "prevouts":
+                data = b"".join(i.prevout.serialize() for i in self.tx.vin)
+            elif name == "sequence":
+                data = b"".join(struct.pack("<I", i.nSequence) for i in self.tx.vin)
+            else:
+                data = b"".join(o.serialize() for o in self.tx.vout)
+            self._midstates[name] = hash256(data)
+        return self._midstates[name]
+
+    def _legacy_template(self):
+        """Serialize the transaction with empty scriptSigs, for signature_hashes()
+
+        Returns (head, inputs, inputs with nSequence 0, offsets, outputs, tail):
+        the inputs are serialized back to back, input i at offsets[i]."""
+        txTo = self.tx
+        inputs = []
+        inputs_no_sequence = []
+        offsets = [0]
+        for txin in txTo.vin:
+            prevout = txin.prevout.serialize()
+            inputs.append(prevout + b"\x00" + struct.pack("<I", txin.nSequence))
+            inputs_no_sequence.append(prevout + b"\x00\x00\x00\x00\x00")
+            offsets.append(offsets[-1] + len(inputs[-1]))
+        head = struct.pack("<i", txTo.nVersion) + ser_compact_size(len(txTo.vin))
+        outputs = ser_compact_size(len(txTo.vout)) + b"".join(o.serialize() for o in txTo.vout)
+        tail = struct.pack("<I", txTo.nLockTime)
+        return (head, b"".join(inputs), b"".join(inputs_no_sequence), offsets, outputs, tail)
+
+    def signature_hash(self, script, inIdx, hashtype):
+        """Legacy signature hash, as SignatureHash()"""
+        return self.signature_hashes([(script, inIdx, hashtype)])[0]
+
+    def signature_hashes(self, items):
+        """Legacy signature hashes of (script, inIdx, hashtype) items, as a list of SignatureHash() results
+
+        Rather than copying and serializing the transaction for each item,
+        the parts of the serialization with empty scriptSigs are spliced
+        around each input's script, and the hashing of the inputs before it
+        is shared between the items (which are hashed in inIdx order): the
+        work is linear in the size of the transaction plus the number of
+        items, apart from the hashing of the serializations themselves."""
+        head, inputs, inputs_no_sequence, offsets, outputs, tail = self._get_midstate("legacy")
+        n_outputs = len(self.tx.vout)
+        # Running hashes of head and the inputs up to some input, and that input
+        prefixes = {
+            False: [hashlib.sha256(head), 0],
+            True: [hashlib.sha256(head), 0],
+        }
+        results = [None] * len(items)
+        for k in sorted(range(len(items)), key=lambda k: items[k][1]):
+            script, inIdx, hashtype = items[k]
+            if inIdx >= len(offsets) - 1:
+                results[k] = (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(offsets) - 1))
+                continue
+            start, end = offsets[inIdx], offsets[inIdx + 1]
+            txin = inputs[start:start + 36] + ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR]))) + inputs[end - 4:end]
+
+            if (hashtype & 0x1f) == SIGHASH_NONE:
+                vout = b"\x00"
+            elif (hashtype & 0x1f) == SIGHASH_SINGLE:
+                if inIdx >= n_outputs:
+                    results[k] = (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, n_outputs))
+                    continue
+                # All outputs before inIdx become CTxOut(-1)
+                vout = ser_compact_size(inIdx + 1) + b"\xff\xff\xff\xff\xff\xff\xff\xff\x00" * inIdx + self.tx.vout[inIdx].serialize()
+            else:
+                vout = outputs
+            rest = vout + tail + struct.pack(b"<I", hashtype)
+
+            if hashtype & SIGHASH_ANYONECANPAY:
+                results[k] = (hash256(head[:4] + b"\x01" + txin + rest), None)
+                continue
+            # The other inputs' nSequence is 0 for SIGHASH_NONE and SIGHASH_SINGLE
+            no_sequence = (hashtype & 0x1f) in (SIGHASH_NONE, SIGHASH_SINGLE)
+            blank_inputs = inputs_no_sequence if no_sequence else inputs
+            prefix = prefixes[no_sequence]
+            with memoryview(blank_inputs) as view:
+                prefix[0].update(view[prefix[1]:start])
+                prefix[1] = start
+                h = prefix[0].copy()
+                h.update(txin)
+                h.update(view[end:])
+            h.update(rest)
+            results[k] = (sha256(h.digest()), None)
+        return results
+
+    def segwit_signature_hash(self, script, inIdx, hashtype, amount):
+        """Segwit v0 (BIP143) signature hash, as SegwitVersion1SignatureHash()"""
+        txTo = self.tx
+        hashPrevouts = b"\x00" * 32
+        hashSequence = b"\x00" * 32
+        hashOutputs = b"\x00" * 32
+
+        if not (hashtype & SIGHASH_ANYONECANPAY):
+            hashPrevouts = self._get_midstate("prevouts")
+
+        if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
+            hashSequence = self._get_midstate("sequence")
+
+        if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
+            hashOutputs = self._get_midstate("outputs")
+        elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
+            hashOutputs = hash256(txTo.vout[inIdx].serialize())
+
+        ss = bytes()
+        ss += struct.pack("<i", txTo.nVersion)
+        ss += hashPrevouts
+        ss += hashSequence
+        ss += txTo.vin[inIdx].prevout.serialize()
+        ss += ser_string(script)
+        ss += struct.pack("<q", amount)
+        ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
+        ss += hashOutputs
+        ss += struct.pack("<i", txTo.nLockTime)
+        ss += struct.pack("<I", hashtype)
+
+        return hash256(ss)
+
+
+class TestFrameworkScript(unittest.TestCase):
+    def legacy_signature_hash(self, script, txTo, inIdx, hashtype):
+        """SignatureHash() as it was before SighashCache: on a modified copy of txTo"""
+        if inIdx >= len(txTo.vin):
+            return (HASH_ONE, "inIdx %d out of range (%d)" % (inIdx, len(txTo.vin)))
+        txtmp = CTransaction(txTo)
+        for txin in txtmp.vin:
+            txin.scriptSig = b''
+        txtmp.vin[inIdx].scriptSig = FindAndDelete(script, CScript([OP_CODESEPARATOR]))
+        if (hashtype & 0x1f) in (SIGHASH_NONE, SIGHASH_SINGLE):
+            if (hashtype & 0x1f) == SIGHASH_NONE:
+                txtmp.vout = []
+            elif inIdx >= len(txtmp.vout):
+                return (HASH_ONE, "outIdx %d out of range (%d)" % (inIdx, len(txtmp.vout)))
+            else:
+                txtmp.vout = [CTxOut(-1) for i in range(inIdx)] + [txtmp.vout[inIdx]]
+            for i in range(len(txtmp.vin)):
+                if i != inIdx:
+                    txtmp.vin[i].nSequence = 0
+        if hashtype & SIGHASH_ANYONECANPAY:
+            txtmp.vin = [txtmp.vin[inIdx]]
+        return (hash256(txtmp.serialize_without_witness() + struct.pack(b"<I", hashtype)), None)
+
+    def segwit_signature_hash(self, script, txTo, inIdx, hashtype, amount):
+        """The BIP143 signature hash, computed from scratch"""
+        base = hashtype & 0x1f
+        anyonecanpay = hashtype & SIGHASH_ANYONECANPAY
+        hashPrevouts = hashSequence = hashOutputs = bytes(32)
+        if not anyonecanpay:
+            hashPrevouts = hash256(b"".join(txin.prevout.serialize() for txin in txTo.vin))
+            if base not in (SIGHASH_NONE, SIGHASH_SINGLE):
+                hashSequence = hash256(b"".join(struct.pack("<I", txin.nSequence) for txin in txTo.vin))
+        if base not in (SIGHASH_NONE, SIGHASH_SINGLE):
+            hashOutputs = hash256(b"".join(txout.serialize() for txout in txTo.vout))
+        elif base == SIGHASH_SINGLE and inIdx < len(txTo.vout):
+            hashOutputs = hash256(txTo.vout[inIdx].serialize())
+        txin = txTo.vin[inIdx]
+        return hash256(struct.pack("<i", txTo.nVersion) + hashPrevouts + hashSequence +
+                       txin.prevout.serialize() + ser_string(script) + struct.pack("<q", amount) +
+                       struct.pack("<I", txin.nSequence) + hashOutputs +
+                       struct.pack("<iI", txTo.nLockTime, hashtype))
+
+    def test_signature_hashes(self):
+        tx = CTransaction()
+        tx.nVersion = 2
+        tx.nLockTime = 1000
+        tx.vin = [CTxIn(COutPoint(0x1234 + i, i), bytes([0x51] * i), 0xfffffffe - i) for i in range(4)]
+        tx.vout = [CTxOut(1000 * (i + 1), CScript([OP_TRUE] * (i + 1))) for i in range(3)]
+        tx.wit.vtxinwit = [CTxInWitness() for _ in range(4)]
+        tx.wit.vtxinwit[1].scriptWitness.stack = [b"\x01"]
+        script = CScript([OP_TRUE, OP_CODESEPARATOR, OP_DROP, OP_CODESEPARATOR, OP_TRUE])
+        hashtypes = [base | anyonecanpay
+                     for base in (0, SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE, 4, 0x1f)
+                     for anyonecanpay in (0, SIGHASH_ANYONECANPAY)]
+        hashtypes.append(0x41)
+        changes = [
+            lambda: None,
+            lambda: setattr(tx.vout[0], "nValue", 1),
+            lambda: setattr(tx.vin[2], "nSequence", 0),
+            lambda: setattr(tx.vin[1], "scriptSig", b""),
+            lambda: setattr(tx.vin[3].prevout, "n", 7),
+            lambda: tx.vout.pop(),
+            lambda: tx.vin.append(CTxIn(COutPoint(0x5678, 0))),
+            lambda: setattr(tx, "nLockTime", 0),
+        ]
+        cache = SighashCache(tx)
+        for change in changes:
+            # The same SighashCache notices each change to the transaction
+            change()
+            items = [(script, inIdx, hashtype) for inIdx in range(len(tx.vin) + 1) for hashtype in hashtypes]
+            random.shuffle(items)
+            self.assertEqual(cache.signature_hashes(items),
+                             [self.legacy_signature_hash(script, tx, inIdx, hashtype) for (script, inIdx, hashtype) in items])
+            self.assertEqual(cache.signature_hash(script, 0, SIGHASH_ALL), self.legacy_signature_hash(script, tx, 0, SIGHASH_ALL))
+            for inIdx in range(len(tx.vin)):
+                for hashtype in hashtypes:
+                    self.assertEqual(cache.segwit_signature_hash(script, inIdx, hashtype, 5000 + inIdx),
+                                     self.segwit_signature_hash(script, tx, inIdx, hashtype, 5000 + inIdx))